@@ -9,6 +9,14 @@
 from .client import OiotClient
 from .job import Job
 from .curator import Curator
+from .pool import ConnectionPool
+from .locktable import LocalLockTable
 from .exceptions import CollectionKeyIsLocked, FailedToComplete, \
         FailedToRollBack, RollbackCausedByException, JobIsFailed, \
-        JobIsCompleted, JobIsRolledBack, JobIsTimedOut
+        JobIsCompleted, JobIsRolledBack, JobIsTimedOut, \
+        CollectionKeyWasModified
+try:
+    from .aio import AsyncOiotClient, AsyncJob, AsyncCurator
+except (ImportError, SyntaxError):
+    # The asyncio variants require Python 3.5+.
+    pass
@@ -0,0 +1,402 @@
+"""
+    oiot.aio
+    ~~~~~~~~~
+    This module implements the AsyncOiotClient, AsyncJob and AsyncCurator
+    classes, asyncio variants of OiotClient, Job and Curator. They run the
+    same operations as the synchronous classes with an asyncio driver, so
+    they have the same locking, journaling and roll back semantics. The
+    transport is thread-backed: requests are sent by porc's FuturesSession
+    on a pool of at most max_workers threads and awaited, so a waiting job
+    holds no thread but every request in flight occupies one. Requires
+    Python 3.5+.
+    :copyright: (c) 2014 by Konstantin Bokarius.
+    :license: MIT, see LICENSE for more details.
+"""
+from concurrent.futures import ThreadPoolExecutor, Future
+from requests.adapters import HTTPAdapter, DEFAULT_POOLSIZE
+from .client import OiotClient
+from .metrics import _get_request_phase
+from .job import Job, _get_lock_wait_delay_in_ms
+from .curator import Curator, _get_next_page
+from .steps import _Return, _Call, _Concurrently, _Sleep, _Locked
+from .exceptions import _CuratorNoLongerActive, _format_exception
+import asyncio, inspect, time, types
+
+async def _gather(coroutines):
+    """
+    Run the specified coroutines concurrently and wait for all of them to
+    finish.
+    :param coroutines: the specified coroutines
+    :return: the results of the coroutines in order, or raise the exception
+    of the first failed coroutine
+    """
+    results = await asyncio.gather(*coroutines, return_exceptions = True)
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    return results
+
+async def _run_steps_async(operation):
+    """
+    Run the specified operation on the event loop, sending the result of
+    each step it yields back into it, or throwing the step's exception into
+    it.
+    :param operation: the operation
+    :return: the operation's return value
+    """
+    result = None
+    error = None
+    while True:
+        try:
+            if error is None:
+                step = operation.send(result)
+            else:
+                step = operation.throw(error)
+        except _Return as e:
+            return e.value
+        except StopIteration:
+            return None
+        try:
+            result, error = await _run_step_async(step), None
+        except BaseException as e:
+            # The operation is given the chance to clean up, or to handle
+            # the exception.
+            result, error = None, e
+
+async def _run_step_async(step):
+    """
+    Run the specified step on the event loop. Requests are awaited through
+    the futures of porc's asynchronous session.
+    :param step: the step
+    :return: the step's result
+    """
+    if isinstance(step, types.GeneratorType):
+        return await _run_steps_async(step)
+    if isinstance(step, _Call):
+        result = step.function(*step.args, **step.kwargs)
+        if isinstance(result, types.GeneratorType):
+            return await _run_steps_async(result)
+        if isinstance(result, Future):
+            return await asyncio.wrap_future(result)
+        if inspect.isawaitable(result):
+            return await result
+        return result
+    if isinstance(step, _Concurrently):
+        return await _gather([_run_step_async(concurrent_step) for
+                concurrent_step in step.steps])
+    if isinstance(step, _Sleep):
+        await asyncio.sleep(step.seconds)
+        return None
+    if isinstance(step, _Locked):
+        async with step.lock:
+            return await _run_steps_async(step.operation)
+    raise TypeError('Unknown step ' + repr(step))
+
+class AsyncOiotClient(OiotClient):
+    """
+    The asyncio implementation of OiotClient. Requests are sent through
+    porc's asynchronous session, whose FuturesSession runs each of them on
+    one of at most max_workers threads, and awaited. A single event loop can
+    therefore drive many concurrent jobs, since jobs waiting for locks or
+    for each other hold no thread, while the number of requests in flight
+    is bounded by max_workers.
+    """
+    _use_async = True
+
+    _run_steps = staticmethod(_run_steps_async)
+
+    def __init__(self, api_key, custom_url = None, max_workers = 64,
+            use_lock_check_fast_path = None, instrumentation = None,
+            connection_pool = None, lock_wait_timeout_in_ms = None,
+            lock_table = None, latency_estimator = None, **kwargs):
+        """
+        Create an AsyncOiotClient instance.
+        :param api_key: the o.io API key
+        :param custom_url: the o.io URL to use instead of the default
+        :param max_workers: the maximum number of concurrent requests, which
+        is the number of threads sending them
+        :param use_lock_check_fast_path: whether single-key operations check
+        for locks instead of taking them, or None to use the default setting.
+        Warning: a fast path put() or delete() is not stopped by a job that
+        locks the key after the check and before the write, and the job's own
+        write then silently replaces it, so use it only where such lost
+        updates are acceptable
+        :param instrumentation: the Instrumentation receiving the backend
+        calls and events of this client and of the jobs using it, or None to
+        disable it
+        :param connection_pool: the ConnectionPool to share with other
+        clients, which replaces the connections sized by max_workers, or None
+        :param lock_wait_timeout_in_ms: the maximum time to wait for a locked
+        collection key to be unlocked before raising CollectionKeyIsLocked,
+        or None to use the default setting
+        :param lock_table: the LocalLockTable checked before locking a
+        collection key for writing in o.io, or None
+        :param latency_estimator: the LatencyEstimator measuring the round
+        trip time of this client's requests, defaults to a new estimator
+        """
+        super(AsyncOiotClient, self).__init__(api_key, custom_url, True,
+                use_lock_check_fast_path, instrumentation, None,
+                lock_wait_timeout_in_ms, lock_table, latency_estimator,
+                **kwargs)
+        self.async_session.executor = ThreadPoolExecutor(
+                max_workers = max_workers)
+        if max_workers > DEFAULT_POOLSIZE:
+            for prefix in ['https://', 'http://']:
+                self.async_session.mount(prefix, HTTPAdapter(
+                        pool_connections = max_workers,
+                        pool_maxsize = max_workers))
+        # The pool replaces the connections sized by max_workers.
+        if connection_pool is not None:
+            connection_pool.mount(self)
+
+    def _request(self, method, path = [], body = None, headers = {}):
+        """
+        Send the specified o.io request, measuring its round trip time and
+        reporting it to the instrumentation if any once it finishes.
+        :param method: the HTTP method
+        :param path: the path as a list of components or a string
+        :param body: the request body
+        :param headers: the request headers
+        :return: the future of the response
+        """
+        # Get the collection before porc prepends the API version to the
+        # path list.
+        collection = path[0] if isinstance(path, list) and path else None
+        start_time = time.time()
+        def report(future):
+            latency_in_seconds = time.time() - start_time
+            status_code = None
+            if not future.cancelled() and future.exception() is None:
+                status_code = future.result().status_code
+                self._latency_estimator.observe(latency_in_seconds * 1000.0)
+            if self._instrumentation is not None:
+                self._instrumentation.on_request(_get_request_phase(method,
+                        collection), method, collection, status_code,
+                        latency_in_seconds)
+        future = self._send(method, path, body, headers)
+        future.add_done_callback(report)
+        return future
+
+    async def _acquire_lock_table_entry(self, lock_collection_key,
+            expiration_in_ms, timeout_in_ms):
+        """
+        Acquire the entry of the specified collection key in the local lock
+        table of this client without blocking the event loop, polling it
+        with a backoff for up to the specified timeout.
+        :param lock_collection_key: the key of the lock in the locks
+        collection
+        :param expiration_in_ms: the time at which the entry expires in
+        milliseconds since the epoch
+        :param timeout_in_ms: the maximum time to wait
+        :return: the token, 0 if the table has no room for the collection
+        key, or None if the collection key is still held
+        """
+        deadline = time.time() + timeout_in_ms / 1000.0
+        retry = 0
+        while True:
+            token = self._lock_table.acquire(lock_collection_key,
+                    expiration_in_ms)
+            remaining = deadline - time.time()
+            if token is not None or remaining <= 0:
+                return token
+            await asyncio.sleep(min(remaining,
+                    _get_lock_wait_delay_in_ms(retry) / 1000.0))
+            retry += 1
+
+    async def list_all(self, collection, **params):
+        """
+        Retrieve all pages of the specified collection without blocking
+        the event loop.
+        :param collection: the collection
+        :return: the list results
+        """
+        pages = self.list(collection, **params)
+        return await asyncio.get_event_loop().run_in_executor(
+                self.async_session.executor, pages.all)
+
+    async def search_all(self, collection, query, **params):
+        """
+        Retrieve all pages of the results of the specified search query
+        without blocking the event loop.
+        :param collection: the collection
+        :param query: the search query
+        :return: the search results
+        """
+        pages = self.search(collection, query, **params)
+        return await asyncio.get_event_loop().run_in_executor(
+                self.async_session.executor, pages.all)
+
+
+class AsyncJob(Job):
+    """
+    The asyncio implementation of Job. All operations are coroutines.
+    """
+    _run_steps = staticmethod(_run_steps_async)
+
+    def __init__(self, client, use_append_only_journal = None,
+            use_optimistic_concurrency = None, use_leases = None,
+            lease_time_in_ms = None, renew_automatically = False,
+            lock_wait_timeout_in_ms = None, use_wait_die = None,
+            use_adaptive_timeouts = None):
+        """
+        Create an AsyncJob instance.
+        :param client: the AsyncOiotClient to use
+        :param use_append_only_journal: whether to store each journal item
+        as its own record
+        :param use_optimistic_concurrency: whether to buffer writes until
+        completion instead of locking
+        :param use_leases: whether to time out when a lease expires
+        :param lease_time_in_ms: the lease time
+        :param renew_automatically: whether to renew the lease in the
+        background
+        :param lock_wait_timeout_in_ms: the maximum time to wait for a lock
+        :param use_wait_die: whether to only wait for locks held by younger
+        jobs
+        :param use_adaptive_timeouts: whether to time out after a budget
+        derived from the measured latency
+        """
+        super(AsyncJob, self).__init__(client, use_append_only_journal,
+                use_optimistic_concurrency, use_leases, lease_time_in_ms,
+                renew_automatically, lock_wait_timeout_in_ms, use_wait_die,
+                use_adaptive_timeouts)
+        # Created on first use so they belong to the running event loop.
+        self._async_job_record_lock = None
+        self._renewal_task = None
+
+    def _start_automatic_renewal(self):
+        """
+        The renewal task is started by the first operation instead, since
+        the event loop may not be running yet when the job is created.
+        """
+
+    def _stop_automatic_renewal(self):
+        """
+        Cancel the renewal task of this job once the job record is removed.
+        """
+        if self._renewal_task is not None:
+            self._renewal_task.cancel()
+
+    def _get_job_record_lock(self):
+        """
+        Get the lock held while writing or removing the job record.
+        :return: the lock
+        """
+        if self._async_job_record_lock is None:
+            self._async_job_record_lock = asyncio.Lock()
+        return self._async_job_record_lock
+
+    def _verify_job_is_active(self):
+        super(AsyncJob, self)._verify_job_is_active()
+        if self._renew_automatically and self._renewal_task is None:
+            self._renewal_task = asyncio.ensure_future(
+                    self._renew_periodically())
+
+    async def _renew_periodically(self):
+        """
+        Renew the lease of this job every third of the lease time until the
+        job is completed or rolled back, or a renewal fails.
+        """
+        while True:
+            await asyncio.sleep(self._lease_time_in_ms / 3000.0)
+            try:
+                if await self.renew() is False:
+                    return
+            except Exception:
+                # The job times out once its lease expires.
+                return
+
+
+class AsyncCurator(Curator):
+    """
+    The asyncio implementation of Curator. The client must be an
+    AsyncOiotClient.
+    """
+    _run_steps = staticmethod(_run_steps_async)
+
+    def __init__(self, client, use_search = None, worker_count = None,
+            shard_count = None, metrics = None, use_adaptive_timeouts = None):
+        """
+        Create an AsyncCurator instance.
+        :param client: the AsyncOiotClient to use
+        :param use_search: whether to search for timed out jobs, locks, and
+        journal items instead of listing the entire collections
+        :param worker_count: the number of records to curate concurrently
+        :param shard_count: the number of shards, each of which has its own
+        active curator
+        :param metrics: the MetricsRegistry recording this curator's metrics
+        :param use_adaptive_timeouts: whether to lengthen the time waited
+        after jobs and curators time out when the client measures long round
+        trips
+        """
+        super(AsyncCurator, self).__init__(client, use_search, worker_count,
+                shard_count, metrics, use_adaptive_timeouts)
+        # Created on first use so it belongs to the running event loop.
+        self._async_heartbeat_lock = None
+
+    def _get_heartbeat_lock(self):
+        """
+        Get the lock held while sending a heartbeat.
+        :return: the lock
+        """
+        if self._async_heartbeat_lock is None:
+            self._async_heartbeat_lock = asyncio.Lock()
+        return self._async_heartbeat_lock
+
+    async def _curate_concurrently(self, curate_record, collection,
+            timestamp_field, description):
+        """
+        Curate the records of the specified collection that may need to be
+        curated one page at a time using a bounded number of tasks, while
+        retrieving the next page in the background. If this curator is no
+        longer active then every remaining task is cancelled.
+        :param curate_record: the operation curating a single record and
+        returning whether it was curated
+        :param collection: the collection
+        :param timestamp_field: the name of the records' timestamp field
+        :param description: the description of the records used in messages
+        :return: whether any record was curated
+        """
+        loop = asyncio.get_event_loop()
+        executor = self._client.async_session.executor
+        pages = self._get_curation_pages(collection, timestamp_field)
+        semaphore = asyncio.Semaphore(self._worker_count)
+        async def curate(record):
+            async with semaphore:
+                try:
+                    return await _run_steps_async(curate_record(record))
+                except _CuratorNoLongerActive:
+                    raise
+                except Exception as e:
+                    self.metrics.increment('oiot_curator_errors_total',
+                            {'kind': description})
+                    print('Caught while processing a ' + description + ': ' +
+                          _format_exception(e))
+                    return False
+        record_count = 0
+        curated_count = 0
+        next_page = loop.run_in_executor(executor, _get_next_page, pages,
+                self.metrics)
+        try:
+            while True:
+                response = await next_page
+                if response is None:
+                    break
+                response.raise_for_status()
+                next_page = loop.run_in_executor(executor, _get_next_page,
+                        pages, self.metrics)
+                tasks = [asyncio.ensure_future(curate(record)) for record in
+                        response['results'] if record is not None]
+                record_count += len(tasks)
+                try:
+                    curated_count += sum(1 for result in
+                            await asyncio.gather(*tasks) if result)
+                except _CuratorNoLongerActive:
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions = True)
+                    raise
+        finally:
+            next_page.cancel()
+        self._record_curation_metrics(description, record_count,
+                curated_count)
+        return curated_count > 0
@@ -0,0 +1,204 @@
+"""
+    oiot.bench
+    ~~~~~~~~~
+    This module implements the per-operation microbenchmark suite. Run it
+    with "python -m oiot.bench" to benchmark OiotClient and Job operations
+    against raw porc.Client using an emulated o.io backend.
+    :copyright: (c) 2014 by Konstantin Bokarius.
+    :license: MIT, see LICENSE for more details.
+"""
+from porc import Client
+from .client import OiotClient
+from .job import Job
+from .emulator import Emulator
+import argparse, json, math, sys, time
+
+# porc.Client operations used as the baseline for each benchmarked operation
+_baseline_operations = {
+    'oiot_client.get': 'porc.get',
+    'oiot_client.put': 'porc.put',
+    'oiot_client.delete': 'porc.delete',
+    'oiot_client_fast_path.get': 'porc.get',
+    'oiot_client_fast_path.put': 'porc.put',
+    'oiot_client_fast_path.delete': 'porc.delete',
+    'job.get': 'porc.get',
+    'job.put': 'porc.put',
+    'job.post': 'porc.put',
+    'job.delete': 'porc.delete'
+}
+
+# collection used by the benchmarked operations
+_bench_collection = 'oiot-bench'
+
+def _get_percentile(sorted_values, percentile):
+    """
+    Get the specified percentile of the specified values using the nearest
+    rank method.
+    :param sorted_values: the sorted values
+    :param percentile: the percentile between 0 and 100
+    :return: the percentile value
+    """
+    if not sorted_values:
+        return None
+    index = int(math.ceil(percentile / 100.0 * len(sorted_values))) - 1
+    return sorted_values[max(0, min(index, len(sorted_values) - 1))]
+
+def _run_benchmark(emulator, iterations, setup, operation):
+    """
+    Run the specified operation and measure its latency and the number of
+    backend calls it makes.
+    :param emulator: the emulator used as the backend
+    :param iterations: the number of times to run the operation
+    :param setup: the function called before each run, excluded from the
+    measurements and returning the operation's arguments
+    :param operation: the operation to benchmark
+    :return: the benchmark results
+    """
+    latencies = []
+    backend_calls = 0
+    for index in range(iterations):
+        args = setup()
+        calls_before = emulator.get_call_count()
+        start_time = time.time()
+        operation(*args)
+        latencies.append((time.time() - start_time) * 1000.0)
+        backend_calls += emulator.get_call_count() - calls_before
+    total_time_in_ms = sum(latencies)
+    latencies.sort()
+    return {
+        'iterations': iterations,
+        'ops_per_second': (iterations / (total_time_in_ms / 1000.0)
+                if total_time_in_ms else None),
+        'p50_latency_in_ms': _get_percentile(latencies, 50),
+        'p99_latency_in_ms': _get_percentile(latencies, 99),
+        'backend_calls_per_operation': float(backend_calls) / iterations
+    }
+
+def _get_benchmarks(porc_client, oiot_client, fast_path_client):
+    """
+    Get the benchmarks to run as (name, setup, operation) tuples.
+    :param porc_client: the porc.Client to benchmark
+    :param oiot_client: the OiotClient to benchmark
+    :param fast_path_client: the OiotClient using the lock check fast path
+    to benchmark
+    :return: the benchmarks
+    """
+    def existing_key():
+        key = Job._generate_key()
+        porc_client.put(_bench_collection, key,
+                {'value': key}).raise_for_status()
+        return key
+
+    def existing_item():
+        return (_bench_collection, existing_key())
+
+    def existing_item_and_value():
+        return (_bench_collection, existing_key(), {'value': 2})
+
+    def new_job_and(setup):
+        return lambda: (Job(oiot_client),) + setup()
+
+    def transaction(job, key1, key2):
+        job.put(_bench_collection, key1, {'value': 2})
+        job.put(_bench_collection, key2, {'value': 2})
+        job.complete()
+
+    def job_with_put():
+        job = Job(oiot_client)
+        job.put(_bench_collection, existing_key(), {'value': 2})
+        return (job,)
+
+    return [
+        ('porc.get', existing_item, porc_client.get),
+        ('porc.put', existing_item_and_value, porc_client.put),
+        ('porc.delete', existing_item, porc_client.delete),
+        ('oiot_client.get', existing_item, oiot_client.get),
+        ('oiot_client.put', existing_item_and_value, oiot_client.put),
+        ('oiot_client.delete', existing_item, oiot_client.delete),
+        ('oiot_client_fast_path.get', existing_item, fast_path_client.get),
+        ('oiot_client_fast_path.put', existing_item_and_value,
+                fast_path_client.put),
+        ('oiot_client_fast_path.delete', existing_item,
+                fast_path_client.delete),
+        ('job.get', new_job_and(existing_item),
+                lambda job, *args: job.get(*args)),
+        ('job.put', new_job_and(existing_item_and_value),
+                lambda job, *args: job.put(*args)),
+        ('job.post', new_job_and(lambda: (_bench_collection, {'value': 1})),
+                lambda job, *args: job.post(*args)),
+        ('job.delete', new_job_and(existing_item),
+                lambda job, *args: job.delete(*args)),
+        ('job.complete', job_with_put, lambda job: job.complete()),
+        ('job.roll_back', job_with_put, lambda job: job.roll_back()),
+        ('job.transaction', lambda: (Job(oiot_client), existing_key(),
+                existing_key()), transaction),
+        ('optimistic_job.transaction', lambda: (Job(oiot_client,
+                use_optimistic_concurrency = True), existing_key(),
+                existing_key()), transaction)
+    ]
+
+def run(rtt_in_ms = 2.0, iterations = 100, seed = None, names = None):
+    """
+    Run the microbenchmark suite against an emulated o.io backend.
+    :param rtt_in_ms: the simulated round trip time of each backend call
+    :param iterations: the number of times to run each operation
+    :param seed: the seed for the emulator's random number generator
+    :param names: the names of the benchmarks to run or None to run all
+    :return: the results of each benchmark keyed by benchmark name
+    """
+    emulator = Emulator(latency = rtt_in_ms, seed = seed)
+    porc_client = emulator.mount(Client('bench-api-key'))
+    oiot_client = emulator.mount(OiotClient('bench-api-key'))
+    fast_path_client = emulator.mount(OiotClient('bench-api-key',
+            use_lock_check_fast_path = True))
+    results = {}
+    for name, setup, operation in _get_benchmarks(porc_client, oiot_client,
+            fast_path_client):
+        if names is None or name in names:
+            results[name] = _run_benchmark(emulator, iterations, setup,
+                    operation)
+    for name, baseline_name in _baseline_operations.items():
+        if name in results and baseline_name in results:
+            baseline = results[baseline_name]
+            result = results[name]
+            result['baseline'] = baseline_name
+            result['backend_calls_relative_to_baseline'] = (
+                    result['backend_calls_per_operation'] /
+                    baseline['backend_calls_per_operation'])
+            result['p50_latency_relative_to_baseline'] = (
+                    result['p50_latency_in_ms'] /
+                    baseline['p50_latency_in_ms']
+                    if baseline['p50_latency_in_ms'] else None)
+    return {'rtt_in_ms': rtt_in_ms, 'iterations': iterations,
+            'results': results}
+
+def main(argv = None):
+    """
+    Run the microbenchmark suite from the command line and write the
+    results as JSON.
+    :param argv: the command line arguments
+    """
+    parser = argparse.ArgumentParser(prog = 'python -m oiot.bench',
+            description = 'Benchmark oiot operations against an emulated '
+            'o.io backend.')
+    parser.add_argument('--rtt-ms', type = float, default = 2.0,
+            help = 'simulated round trip time of each backend call')
+    parser.add_argument('--iterations', type = int, default = 100,
+            help = 'number of times to run each operation')
+    parser.add_argument('--seed', type = int, default = None,
+            help = 'seed for the emulator')
+    parser.add_argument('--benchmark', action = 'append', dest = 'names',
+            help = 'name of a benchmark to run, may be repeated')
+    parser.add_argument('--output', default = None,
+            help = 'file to write the JSON results to instead of stdout')
+    args = parser.parse_args(argv)
+    results = run(args.rtt_ms, args.iterations, args.seed, args.names)
+    output = json.dumps(results, indent = 2, sort_keys = True)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        sys.stdout.write(output + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -7,19 +7,231 @@
 """
 from porc import Client
 from datetime import datetime
-from .settings import _locks_collection 
-from .job import Job
+from .settings import _locks_collection, _use_lock_check_fast_path, \
+        _max_lock_update_attempts, _lock_wait_timeout_in_ms, \
+        _max_job_time_in_ms, _additional_timeout_wait_in_ms
+from .job import Job, _get_timestamp_in_ms, _raise_if_locked
+from .steps import _Return, _Call, _Concurrently, _run_steps
 from .exceptions import CollectionKeyIsLocked
+from .metrics import LatencyEstimator, _get_request_phase
+from .serializer import _has_fast_json_body, _send_request
+import time
 
 class OiotClient(Client):
     """
     The oiot implementation of porc.Client. Used for ensuring that locked
     o.io objects cannot be read or written to.
     """
+    # Whether porc sends the requests of this client asynchronously.
+    _use_async = False
+
+    # The driver running the operations of this client.
+    _run_steps = staticmethod(_run_steps)
+
     def __init__(self, api_key, custom_url = None,
-            use_async = False, **kwargs):
-        super(self.__class__, self).__init__(api_key, custom_url = None,
-                use_async = False, **kwargs)
+            use_async = False, use_lock_check_fast_path = None,
+            instrumentation = None, connection_pool = None,
+            lock_wait_timeout_in_ms = None, lock_table = None,
+            latency_estimator = None, **kwargs):
+        """
+        Create an OiotClient instance.
+        :param api_key: the o.io API key
+        :param custom_url: the o.io URL to use instead of the default
+        :param use_async: ignored, since OiotClient is synchronous and
+        AsyncOiotClient is asynchronous
+        :param use_lock_check_fast_path: whether single-key operations check
+        for locks instead of taking them, or None to use the default setting.
+        Warning: a fast path put() or delete() is not stopped by a job that
+        locks the key after the check and before the write, and the job's own
+        write then silently replaces it, so use it only where such lost
+        updates are acceptable
+        :param instrumentation: the Instrumentation receiving the backend
+        calls and events of this client and of the jobs using it, or None to
+        disable it
+        :param connection_pool: the ConnectionPool to share with other
+        clients, or None
+        :param lock_wait_timeout_in_ms: the maximum time to wait for a locked
+        collection key to be unlocked before raising CollectionKeyIsLocked,
+        or None to use the default setting
+        :param lock_table: the LocalLockTable checked before locking a
+        collection key for writing in o.io, or None
+        :param latency_estimator: the LatencyEstimator measuring the round
+        trip time of this client's requests, defaults to a new estimator
+        """
+        super(OiotClient, self).__init__(api_key, custom_url,
+                self._use_async, **kwargs)
+        self._use_lock_check_fast_path = (_use_lock_check_fast_path
+                if use_lock_check_fast_path is None else
+                use_lock_check_fast_path)
+        # The maximum time to wait for a locked collection key to be
+        # unlocked before raising CollectionKeyIsLocked.
+        self._lock_wait_timeout_in_ms = (_lock_wait_timeout_in_ms
+                if lock_wait_timeout_in_ms is None else
+                lock_wait_timeout_in_ms)
+        # The Instrumentation receiving the backend calls and events of this
+        # client and of the jobs using it, or None to disable it.
+        self._instrumentation = instrumentation
+        # The LocalLockTable checked before locking a collection key for
+        # writing in o.io, shared with the jobs using this client, or None.
+        self._lock_table = lock_table
+        # The LatencyEstimator measuring the round trip time of this client's
+        # requests, which adaptive jobs and curators using this client base
+        # their budgets and timeouts on.
+        self._latency_estimator = (LatencyEstimator() if latency_estimator
+                is None else latency_estimator)
+        # The ConnectionPool shared with other clients, or None to use the
+        # connections of this client's own sessions.
+        if connection_pool is not None:
+            connection_pool.mount(self)
+
+    def _request(self, method, path = [], body = None, headers = {}):
+        """
+        Execute the specified o.io request, measuring its round trip time
+        and reporting it to the instrumentation if any.
+        :param method: the HTTP method
+        :param path: the path as a list of components or a string
+        :param body: the request body
+        :param headers: the request headers
+        :return: the response
+        """
+        # Get the collection before porc prepends the API version to the
+        # path list.
+        collection = path[0] if isinstance(path, list) and path else None
+        start_time = time.time()
+        status_code = None
+        try:
+            response = self._send(method, path, body, headers)
+            status_code = response.status_code
+            return response
+        finally:
+            latency_in_seconds = time.time() - start_time
+            if status_code is not None:
+                self._latency_estimator.observe(latency_in_seconds * 1000.0)
+            if self._instrumentation is not None:
+                self._instrumentation.on_request(_get_request_phase(method,
+                        collection), method, collection, status_code,
+                        latency_in_seconds)
+
+    def _send(self, method, path, body, headers):
+        """
+        Send the specified o.io request, serializing its body with orjson or
+        ujson if either is installed.
+        :param method: the HTTP method
+        :param path: the path as a list of components or a string
+        :param body: the request body
+        :param headers: the request headers
+        :return: the response
+        """
+        if _has_fast_json_body(method, body):
+            return _send_request(self, method, path, body, headers)
+        return super(OiotClient, self)._request(method, path, body, headers)
+
+    def _record_event(self, event):
+        """
+        Report the specified event to the instrumentation, if any.
+        :param event: the event
+        """
+        if self._instrumentation is not None:
+            self._instrumentation.on_event(event)
+
+    def _acquire_lock_table_entry(self, lock_collection_key,
+            expiration_in_ms, timeout_in_ms):
+        """
+        Acquire the entry of the specified collection key in the local lock
+        table of this client, waiting for up to the specified timeout.
+        :param lock_collection_key: the key of the lock in the locks
+        collection
+        :param expiration_in_ms: the time at which the entry expires in
+        milliseconds since the epoch
+        :param timeout_in_ms: the maximum time to wait
+        :return: the token, 0 if the table has no room for the collection
+        key, or None if the collection key is still held
+        """
+        return self._lock_table.acquire(lock_collection_key, expiration_in_ms,
+                timeout_in_ms)
+
+    def list_all(self, collection, **params):
+        """
+        Retrieve all pages of the specified collection.
+        :param collection: the collection
+        :return: the list results
+        """
+        return self.list(collection, **params).all()
+
+    def search_all(self, collection, query, **params):
+        """
+        Retrieve all pages of the results of the specified search query.
+        :param collection: the collection
+        :param query: the search query
+        :return: the search results
+        """
+        return self.search(collection, query, **params).all()
+
+    def _get_lock_and_execute_operation(self, operation, *args):
+        """
+        Retrieve the lock of the collection key concurrently with executing
+        the specified o.io operation.
+        :param operation: the specified o.io operation
+        :param args: the specified o.io operation's arguments
+        :return: the lock retrieval's response and the o.io operation's
+        response
+        """
+        responses = yield _Concurrently([_Call(super(OiotClient, self).get,
+                _locks_collection, Job._get_lock_collection_key(args[0],
+                args[1])), _Call(operation, *args)])
+        raise _Return(responses)
+
+    def _check_lock_and_get(self, collection, key, ref):
+        """
+        Execute a get operation concurrently with checking whether the
+        collection key is locked for writing, which takes a single round
+        trip instead of three.
+        :param collection: the collection
+        :param key: the key
+        :param ref: the ref
+        :return: the get operation's response
+        """
+        lock_response, response = yield self._get_lock_and_execute_operation(
+                super(OiotClient, self).get, collection, key, ref)
+        _raise_if_locked(lock_response, True)
+        raise _Return(response)
+
+    def _check_lock_and_write(self, write, collection, key, ref):
+        """
+        Execute a write operation conditionally on the ref of the collection
+        key that was read concurrently with checking whether the collection
+        key is locked. If the ref changed in the meantime then the lock is
+        checked again, and if the key keeps changing then the write falls
+        back to locking the collection key.
+        :param write: the write operation taking the ref to write against
+        :param collection: the collection
+        :param key: the key
+        :param ref: the ref passed by the caller or None
+        :return: the write operation's response
+        """
+        if ref is not None:
+            # The caller's ref already makes the write conditional.
+            _raise_if_locked((yield _Call(super(OiotClient, self).get,
+                    _locks_collection, Job._get_lock_collection_key(
+                    collection, key))), False)
+            raise _Return((yield _Call(write, ref)))
+        for attempt in range(_max_lock_update_attempts):
+            lock_response, response = (yield
+                    self._get_lock_and_execute_operation(super(OiotClient,
+                    self).get, collection, key))
+            _raise_if_locked(lock_response, False)
+            if response.status_code == 404:
+                current_ref = False
+            else:
+                response.raise_for_status()
+                current_ref = response.ref
+            write_response = yield _Call(write, current_ref)
+            if write_response.status_code != 412:
+                raise _Return(write_response)
+        response = yield self._execute_locked_operation(True,
+                lambda: Job._create_and_add_lock(self, collection, key, None,
+                datetime.utcnow()), write, (None,))
+        raise _Return(response)
 
     def _remove_lock(self, lock):
         """
@@ -29,7 +241,10 @@ class OiotClient(Client):
         try:
             # Ignore exceptions and do not raise for status.
             # If necessary the curator will clean up the orphaned lock.
-            super(self.__class__, self).delete(_locks_collection,
+            if lock.mode == 'read':
+                yield Job._remove_read_lock(self, lock)
+                return
+            yield _Call(super(OiotClient, self).delete, _locks_collection,
                     Job._get_lock_collection_key(lock.collection, lock.key),
                     lock.lock_ref)
         except:
@@ -45,33 +260,178 @@ class OiotClient(Client):
         :param args: the specified o.io operation's arguments
         :return: the o.io operation's response
         """
+        response = yield self._execute_locked_operation(raise_if_locked,
+                lambda: Job._create_and_add_lock(self, args[0], args[1], None,
+                datetime.utcnow()), operation, args)
+        raise _Return(response)
+
+    def _read_lock_key_and_execute_operation(self, raise_if_locked,
+            operation, *args):
+        """
+        Execute the specified o.io operation by first read locking the
+        collection key and then executing the operation. Read locks are
+        shared so concurrent reads of the same key do not conflict.
+        :param raise_if_locked: whether to raise an exception if the key is
+        already locked for writing
+        :param operation: the specified o.io operation
+        :param args: the specified o.io operation's arguments
+        :return: the o.io operation's response
+        """
+        response = yield self._execute_locked_operation(raise_if_locked,
+                lambda: Job._create_and_add_read_lock(self, args[0], args[1],
+                None, datetime.utcnow(), Job._generate_key()), operation, args)
+        raise _Return(response)
+
+    def _execute_locked_operation(self, raise_if_locked, create_lock,
+            operation, args):
+        """
+        Execute the specified o.io operation while holding the lock created
+        by the specified function.
+        :param raise_if_locked: whether to lock the collection key
+        :param create_lock: the function creating the lock
+        :param operation: the specified o.io operation
+        :param args: the specified o.io operation's arguments
+        :return: the o.io operation's response
+        """
         lock = None
         response = None
         if raise_if_locked:
-            lock = Job._create_and_add_lock(self, args[0], args[1], None,
-                    datetime.utcnow())
+            lock = yield _Call(create_lock)
         try:
-            response = operation(*args)
+            response = yield _Call(operation, *args)
         except Exception:
             if raise_if_locked:
-                self._remove_lock(lock)
+                yield self._remove_lock(lock)
             raise
         if raise_if_locked:
-            self._remove_lock(lock)
-        return response
+            yield self._remove_lock(lock)
+        raise _Return(response)
+
+    def _wait_for_lock(self, raise_if_locked, collection, key, operation,
+            is_write_lock = True):
+        """
+        Execute the specified function performing an o.io operation, retrying
+        it while the collection key is locked for up to the lock wait
+        timeout. Writes first acquire the collection key's entry in the local
+        lock table, if any, for the duration of the operation.
+        :param raise_if_locked: whether the operation respects locks
+        :param collection: the collection
+        :param key: the key
+        :param operation: the function performing the o.io operation
+        :param is_write_lock: whether the operation writes the collection key
+        :return: the o.io operation's response
+        """
+        if raise_if_locked is False:
+            raise _Return((yield operation()))
+        if self._lock_table is None or not is_write_lock:
+            raise _Return((yield Job._wait_for_lock(self, collection, key,
+                    operation, self._lock_wait_timeout_in_ms)))
+        lock_collection_key = Job._get_lock_collection_key(collection, key)
+        token = yield _Call(self._acquire_lock_table_entry,
+                lock_collection_key, _get_timestamp_in_ms(datetime.utcnow()) +
+                _max_job_time_in_ms + _additional_timeout_wait_in_ms,
+                self._lock_wait_timeout_in_ms)
+        if token is None:
+            raise CollectionKeyIsLocked
+        try:
+            raise _Return((yield Job._wait_for_lock(self, collection, key,
+                    operation, self._lock_wait_timeout_in_ms)))
+        finally:
+            self._lock_table.release(lock_collection_key, token)
 
     def put(self, collection, key, value, ref = None, raise_if_locked = True):
-        return self._lock_key_and_execute_operation(raise_if_locked,
-                super(self.__class__, self).put, collection, key, value, ref)
+        """
+        Execute a put operation unless the collection key is locked.
+        Warning: with the lock check fast path the key is not locked during
+        the write, so a job that locks the key after the lock check and
+        before the write does not stop the write, and the job's own write
+        then silently replaces it.
+        :param collection: the collection
+        :param key: the key
+        :param value: the value
+        :param ref: the ref
+        :param raise_if_locked: whether to raise CollectionKeyIsLocked if the
+        key is locked instead of ignoring locks
+        :return: the operation's response
+        """
+        return self._run_steps(self._put(collection, key, value, ref,
+                raise_if_locked))
+
+    def _put(self, collection, key, value, ref, raise_if_locked):
+        """
+        The operation implementing put().
+        """
+        def put():
+            if raise_if_locked and self._use_lock_check_fast_path:
+                return self._check_lock_and_write(lambda ref:
+                        super(OiotClient, self).put(collection, key, value,
+                        ref), collection, key, ref)
+            return self._lock_key_and_execute_operation(raise_if_locked,
+                    super(OiotClient, self).put, collection, key, value, ref)
+        try:
+            raise _Return((yield self._wait_for_lock(raise_if_locked,
+                    collection, key, put)))
+        except CollectionKeyIsLocked:
+            self._record_event('lock_conflict')
+            raise
 
     def get(self, collection, key, ref = None, raise_if_locked = True):
-        return self._lock_key_and_execute_operation(raise_if_locked,
-                super(self.__class__, self).get, collection, key, ref)
+        return self._run_steps(self._get(collection, key, ref,
+                raise_if_locked))
+
+    def _get(self, collection, key, ref, raise_if_locked):
+        """
+        The operation implementing get().
+        """
+        def get():
+            if raise_if_locked and self._use_lock_check_fast_path:
+                return self._check_lock_and_get(collection, key, ref)
+            return self._read_lock_key_and_execute_operation(raise_if_locked,
+                    super(OiotClient, self).get, collection, key, ref)
+        try:
+            raise _Return((yield self._wait_for_lock(raise_if_locked,
+                    collection, key, get, False)))
+        except CollectionKeyIsLocked:
+            self._record_event('lock_conflict')
+            raise
 
     def delete(self, collection, key = None, ref = None,
                 raise_if_locked = True):
+        """
+        Execute a delete operation unless the collection key is locked.
+        Warning: with the lock check fast path the key is not locked during
+        the delete, so a job that locks the key after the lock check and
+        before the delete does not stop the delete, and the job's own write
+        then silently replaces it.
+        :param collection: the collection
+        :param key: the key, or None to delete the entire collection
+        :param ref: the ref
+        :param raise_if_locked: whether to raise CollectionKeyIsLocked if the
+        key is locked instead of ignoring locks
+        :return: the operation's response
+        """
+        return self._run_steps(self._delete(collection, key, ref,
+                raise_if_locked))
+
+    def _delete(self, collection, key, ref, raise_if_locked):
+        """
+        The operation implementing delete().
+        """
         # Deleting an entire collection does not lock the collection.
         if key is None:
-            return super(self.__class__, self).delete(collection)
-        return self._lock_key_and_execute_operation(raise_if_locked,
-                super(self.__class__, self).delete, collection, key, ref)
+            raise _Return((yield _Call(super(OiotClient, self).delete,
+                    collection)))
+        def delete():
+            if raise_if_locked and self._use_lock_check_fast_path:
+                # A missing object is deleted unconditionally.
+                return self._check_lock_and_write(lambda ref:
+                        super(OiotClient, self).delete(collection, key,
+                        ref or None), collection, key, ref)
+            return self._lock_key_and_execute_operation(raise_if_locked,
+                    super(OiotClient, self).delete, collection, key, ref)
+        try:
+            raise _Return((yield self._wait_for_lock(raise_if_locked,
+                    collection, key, delete)))
+        except CollectionKeyIsLocked:
+            self._record_event('lock_conflict')
+            raise
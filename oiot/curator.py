@@ -10,50 +10,267 @@ from .settings import _curators_collection, _locks_collection, \
         _active_curator_key, _curator_inactivity_delay_in_ms, \
         _curator_heartbeat_timeout_in_ms, _jobs_collection, \
         _curator_heartbeat_interval_in_ms, _max_job_time_in_ms, \
-        _additional_timeout_wait_in_ms
-from .job import Job, _JournalItem, _Lock, _Encoder
+        _additional_timeout_wait_in_ms, _journal_collection, \
+        _use_curator_search, _curator_worker_count, _max_removed_job_ids, \
+        _removed_job_id_lifetime_in_ms, _curator_shard_count, \
+        _use_adaptive_timeouts
+from .job import Job, _JournalItem, _Lock, _get_timestamp_in_ms, \
+        _get_record_expiration_in_ms
+from .metrics import MetricsRegistry
+from .serializer import _get_wire_value
+from .steps import _Return, _Call, _Sleep, _Locked, _run_steps
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import OrderedDict
 from .exceptions import _format_exception, _CuratorNoLongerActive, \
         _get_httperror_status_code
 
 # TODO: Log unexpected exceptions locally and to 'oiot-errors'
 # TODO: What to do if a job or journal is corrupt and can't be rolled back?
 
-from datetime import datetime
+from datetime import datetime, timedelta
 import dateutil.parser
-import uuid, time, json
+import uuid, time, threading, zlib
 
 class Curator(Client):
     """
     The class used for curating broken jobs and locks.
     """
-    def __init__(self, client):
+    # The driver running the operations of this curator.
+    _run_steps = staticmethod(_run_steps)
+
+    def __init__(self, client, use_search = None, worker_count = None,
+            shard_count = None, metrics = None, use_adaptive_timeouts = None):
         """
         Create a Curator instance.
         :param client: the client to use
+        :param use_search: whether to search for timed out jobs, locks, and
+        journal items instead of listing the entire collections, defaults to
+        _use_curator_search
+        :param worker_count: the number of records to curate concurrently,
+        defaults to _curator_worker_count
+        :param shard_count: the number of shards, each of which has its own
+        active curator, defaults to _curator_shard_count
+        :param metrics: the MetricsRegistry recording this curator's metrics,
+        defaults to a new registry
+        :param use_adaptive_timeouts: whether to lengthen the time waited
+        after jobs and curators time out when the client measures long round
+        trips, defaults to _use_adaptive_timeouts
         """
         self._client = client
+        if use_adaptive_timeouts is None:
+            use_adaptive_timeouts = _use_adaptive_timeouts
+        # The LatencyEstimator of the client if this curator uses adaptive
+        # timeouts, or None.
+        self._latency_estimator = (getattr(client, '_latency_estimator',
+                None) if use_adaptive_timeouts else None)
+        if use_search is None:
+            use_search = _use_curator_search
+        self._use_search = use_search
+        if worker_count is None:
+            worker_count = _curator_worker_count
+        self._worker_count = worker_count
+        if shard_count is None:
+            shard_count = _curator_shard_count
+        self._shard_count = shard_count
+        # The shards this curator is, or is trying to become, the active
+        # curator of.
+        self._shard_indexes = [0]
+        if metrics is None:
+            metrics = MetricsRegistry()
+        self.metrics = metrics
         self._id = uuid.uuid4()
         self._is_active = False
         self._last_heartbeat_time = None
-        self._last_heartbeat_ref = None
+        # The refs of the last heartbeats keyed by shard index.
+        self._last_heartbeat_refs = {}
+        self._last_shard_check_time = None
         self._should_continue_to_run = True
-        self._removed_job_ids = []
+        self._removed_job_ids = _ExpiringSet(_max_removed_job_ids,
+                _removed_job_id_lifetime_in_ms)
+        self._listed_job_ids = set()
+        self._jobs_listing_time_in_ms = None
+        self._heartbeat_lock = threading.Lock()
+        self._is_curation_aborted = False
+
+    def _get_additional_timeout_wait_in_ms(self):
+        """
+        Get the time to wait after a job or curator times out before taking
+        its place, which covers the requests it may still have in flight.
+        Adaptive timeouts are never shorter than _additional_timeout_wait_in_ms
+        since the jobs may measure longer round trips than this curator.
+        :return: the time in milliseconds
+        """
+        if self._latency_estimator is None:
+            return _additional_timeout_wait_in_ms
+        return self._latency_estimator.get_timeout_wait_in_ms(
+                _additional_timeout_wait_in_ms)
+
+    def _get_heartbeat_timeout_in_ms(self):
+        """
+        Get the time since the last heartbeat of the active curator after
+        which it is no longer active. Adaptive timeouts are never shorter
+        than _curator_heartbeat_timeout_in_ms.
+        :return: the time in milliseconds
+        """
+        if self._latency_estimator is None:
+            return _curator_heartbeat_timeout_in_ms
+        return (_curator_heartbeat_interval_in_ms +
+                self._latency_estimator.get_timeout_wait_in_ms(
+                _curator_heartbeat_timeout_in_ms -
+                _curator_heartbeat_interval_in_ms))
 
     def _append_to_removed_job_ids(self, job_id):
         """
-        Append the specified job ID to the list of removed job IDs.
+        Add the specified job ID to the set of recently removed job IDs.
         :param job_id: the specified job ID
         """
-        if len(self._removed_job_ids) > 1000:
-            self._removed_job_ids = self._removed_job_ids[:750]
-        self._removed_job_ids.append(job_id)
+        self._removed_job_ids.add(job_id)
+
+    def _get_active_curator_key(self, shard_index):
+        """
+        Get the key of the active curator object of the specified shard.
+        :param shard_index: the shard index
+        :return: the key
+        """
+        if self._shard_count == 1:
+            return _active_curator_key
+        return '%s-%d' % (_active_curator_key, shard_index)
+
+    def _get_shard_indexes(self):
+        """
+        Get the shard indexes in the order this curator tries to become their
+        active curator. The order starts at a shard derived from the curator
+        ID so that curators spread across the shards.
+        :return: the shard indexes
+        """
+        first_shard_index = self._id.int % self._shard_count
+        return [(first_shard_index + offset) % self._shard_count
+                for offset in range(self._shard_count)]
+
+    def _is_in_shard(self, value):
+        """
+        Determine whether the specified job ID or lock key belongs to one of
+        this curator's shards.
+        :param value: the job ID or lock key
+        :return: whether the value belongs to one of this curator's shards
+        """
+        if self._shard_count == 1:
+            return True
+        # The built-in hash differs between processes so use a stable one.
+        return ((zlib.crc32(value.encode('utf-8')) & 0xffffffff) %
+                self._shard_count in self._shard_indexes)
+
+    @staticmethod
+    def _get_active_curator_details(response):
+        """
+        Get the details stored in an active curator object.
+        :param response: the response retrieving the active curator object
+        :return: the active curator details
+        """
+        return _ActiveCuratorDetails(response.json['curator_id'],
+                dateutil.parser.parse(response.json['timestamp']))
+
+    def _is_heartbeat_timed_out(self, active_curator_details,
+            additional_wait_in_ms = 0):
+        """
+        Determine whether the last heartbeat of an active curator timed out.
+        :param active_curator_details: the active curator details
+        :param additional_wait_in_ms: the time to wait after the heartbeat
+        timeout
+        :return: whether the heartbeat timed out
+        """
+        return ((datetime.utcnow() - active_curator_details.timestamp).
+                total_seconds() * 1000.0 >
+                self._get_heartbeat_timeout_in_ms() + additional_wait_in_ms)
+
+    def _get_abandoned_shard_ref(self, response):
+        """
+        Get the ref to take over a shard against if its active curator
+        stopped, which it did once its heartbeat timed out more than the
+        additional timeout wait ago.
+        :param response: the response retrieving the shard's active curator
+        object
+        :return: the ref, or None if its active curator did not stop
+        """
+        # A shard that never had an active curator is left to curators that
+        # are not active yet, since taking it over would keep curators that
+        # start later from ever becoming active.
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        if self._is_heartbeat_timed_out(
+                Curator._get_active_curator_details(response),
+                self._get_additional_timeout_wait_in_ms()) is False:
+            return None
+        return response.ref
+
+    def _add_taken_over_shard(self, shard_index, response):
+        """
+        Make this curator the active curator of the specified shard once its
+        first heartbeat was stored.
+        :param shard_index: the shard index
+        :param response: the response of the heartbeat
+        """
+        # A 412 error indicates that another curator took over the shard
+        # first.
+        if response.status_code == 412:
+            return
+        response.raise_for_status()
+        self._shard_indexes.append(shard_index)
+        self._last_heartbeat_refs[shard_index] = response.ref
+        self.metrics.increment('oiot_curator_leadership_changes_total',
+                {'change': 'acquired'})
+
+    def _should_check_shards(self):
+        """
+        Determine whether an active curator should check the shards it is
+        not the active curator of, which it does once per heartbeat
+        interval.
+        :return: whether to check the other shards
+        """
+        if len(self._shard_indexes) == self._shard_count:
+            return False
+        now = datetime.utcnow()
+        if (self._last_shard_check_time is not None and
+                (now - self._last_shard_check_time).total_seconds() *
+                1000.0 < _curator_heartbeat_interval_in_ms):
+            return False
+        self._last_shard_check_time = now
+        return True
+
+    def _make_active(self):
+        """
+        Make this curator instance active.
+        """
+        if self._is_active is False:
+            self.metrics.increment('oiot_curator_leadership_changes_total',
+                    {'change': 'acquired'})
+            self.metrics.set_gauge('oiot_curator_active', 1)
+        self._is_active = True
+
+    def _make_inactive(self):
+        """
+        Make this curator instance inactive.
+        """
+        if self._is_active:
+            self.metrics.increment('oiot_curator_leadership_changes_total',
+                    {'change': 'lost'})
+        self._is_active = False
+        self.metrics.set_gauge('oiot_curator_active', 0)
 
     def _make_inactive_and_sleep(self):
         """
         Make this curator instance inactive and sleep for some time.
         """
-        self._is_active = False
-        time.sleep(_curator_inactivity_delay_in_ms / 1000.0)
+        self._make_inactive()
+        yield _Sleep(_curator_inactivity_delay_in_ms / 1000.0)
+
+    def _get_heartbeat_lock(self):
+        """
+        Get the lock held while sending a heartbeat.
+        :return: the lock
+        """
+        return self._heartbeat_lock
 
     def _try_send_heartbeat(self, add_new_record=False):
         """
@@ -63,20 +280,64 @@ class Curator(Client):
         o.io collection
         :return: whether the heartbeat was successfully sent
         """
+        # Records are curated concurrently so heartbeats must be sent one at
+        # a time, and once a heartbeat finds that this curator is no longer
+        # active every record being curated must stop.
+        def send_heartbeat():
+            if self._is_curation_aborted:
+                raise _CuratorNoLongerActive
+            try:
+                raise _Return((yield self._send_heartbeat(add_new_record)))
+            except _CuratorNoLongerActive:
+                self._is_curation_aborted = True
+                raise
+        is_sent = yield _Locked(self._get_heartbeat_lock(), send_heartbeat())
+        raise _Return(is_sent)
+
+    def _send_heartbeat(self, add_new_record):
+        """
+        Send a heartbeat unless one was sent recently.
+        :param add_new_record: whether to add a new object to the curators
+        o.io collection
+        :return: whether the heartbeat was successfully sent
+        """
         # If too little time has passed since the last heartbeat
         # then don't try to send another heartbeat.
-        if (self._is_active and (datetime.utcnow() - self._last_heartbeat_time).
-                total_seconds() * 1000.0 < _curator_heartbeat_interval_in_ms):
-            return True
-        last_ref_value = self._last_heartbeat_ref
-        if add_new_record:
-            last_ref_value = False
+        if self._is_heartbeat_due() is False:
+            raise _Return(True)
         active_curator_details = _ActiveCuratorDetails(self._id,
                 datetime.utcnow())
-        response = self._client.put(_curators_collection,
-                _active_curator_key,
-                json.loads(json.dumps(vars(active_curator_details),
-                cls=_Encoder)), last_ref_value, False)
+        # A heartbeat is sent to every shard of this curator, and once any
+        # of them was taken over this curator is no longer active.
+        for shard_index in self._shard_indexes:
+            last_ref_value = self._last_heartbeat_refs.get(shard_index)
+            if add_new_record:
+                last_ref_value = False
+            response = yield self._put_heartbeat(shard_index,
+                    active_curator_details, last_ref_value)
+            if self._is_heartbeat_accepted(response) is False:
+                raise _Return(False)
+            self._last_heartbeat_refs[shard_index] = response.ref
+        raise _Return(self._finish_heartbeat(active_curator_details))
+
+    def _is_heartbeat_due(self):
+        """
+        Determine whether to send a heartbeat, which an active curator only
+        does once a heartbeat interval passed since its last heartbeat.
+        :return: whether to send a heartbeat
+        """
+        return (self._is_active is False or
+                (datetime.utcnow() - self._last_heartbeat_time).
+                total_seconds() * 1000.0 >= _curator_heartbeat_interval_in_ms)
+
+    def _is_heartbeat_accepted(self, response):
+        """
+        Determine whether a heartbeat was stored in the curators collection.
+        :param response: the response of the heartbeat
+        :return: whether the heartbeat was stored, or raise
+        _CuratorNoLongerActive if this curator is active and another curator
+        has become active
+        """
         try:
             response.raise_for_status()
         except Exception as e:
@@ -87,31 +348,97 @@ class Curator(Client):
                 return False
             else:
                 raise e
+        return True
+
+    def _finish_heartbeat(self, active_curator_details):
+        """
+        Record a heartbeat stored for every shard of this curator.
+        :param active_curator_details: the details stored by the heartbeat
+        :return: whether this curator is the active curator, or raise
+        _CuratorNoLongerActive if this curator is active and its heartbeat
+        took too long
+        """
+        if self._is_active:
+            self.metrics.set_gauge('oiot_curator_heartbeat_lag_seconds',
+                    (active_curator_details.timestamp -
+                    self._last_heartbeat_time).total_seconds())
         self._last_heartbeat_time = active_curator_details.timestamp
-        self._last_heartbeat_ref = response.ref
         # If too much time has passed since the last heartbeat
         # then this curator instance is no longer active.
-        if ((datetime.utcnow() - self._last_heartbeat_time).
-                total_seconds() * 1000.0 > _curator_heartbeat_timeout_in_ms):
+        if self._is_heartbeat_timed_out(active_curator_details):
             if self._is_active:
                 raise _CuratorNoLongerActive
             return False
         return True
 
+    def _put_heartbeat(self, shard_index, active_curator_details,
+            last_ref_value):
+        """
+        Store the specified details as the active curator object of the
+        specified shard.
+        :param shard_index: the shard index
+        :param active_curator_details: the active curator details
+        :param last_ref_value: the ref of the last heartbeat, or False to
+        add a new object
+        :return: the response
+        """
+        with self.metrics.timer('oiot_curator_operation_seconds',
+                {'operation': 'heartbeat'}):
+            response = yield _Call(self._client.put, _curators_collection,
+                    self._get_active_curator_key(shard_index),
+                    active_curator_details._get_wire_dict(), last_ref_value,
+                    False)
+        raise _Return(response)
+
     # Determine whether this instance is the active curator instance.
     def _determine_active_status(self):
         """
-        Determine whether this curator is the active curator.
-        :return: whether this curator is the active curator
+        Determine whether this curator is the active curator of a shard.
+        :return: whether this curator is the active curator of a shard
         """
         if self._is_active:
             # Try to send a heartbeat and return the result indicating
             # whether this curator instance should continue to curate.
-            return self._try_send_heartbeat()
-        # If not active then check to see when the last active curator
-        # heartbeat was sent.
-        response = self._client.get(_curators_collection,
-                _active_curator_key, None, False)
+            if (yield self._try_send_heartbeat()) is False:
+                raise _Return(False)
+            yield self._take_over_abandoned_shards()
+            raise _Return(True)
+        for shard_index in self._get_shard_indexes():
+            self._shard_indexes = [shard_index]
+            self._last_heartbeat_refs = {}
+            if (yield self._try_to_become_active()):
+                raise _Return(True)
+        raise _Return(False)
+
+    def _take_over_abandoned_shards(self):
+        """
+        Become the active curator of the shards whose active curator
+        stopped, so that every shard is still curated when fewer curators
+        than shards are left running.
+        """
+        if self._should_check_shards() is False:
+            return
+        for shard_index in self._get_shard_indexes():
+            if shard_index in self._shard_indexes:
+                continue
+            last_ref_value = self._get_abandoned_shard_ref((yield _Call(
+                    self._client.get, _curators_collection,
+                    self._get_active_curator_key(shard_index), None, False)))
+            if last_ref_value is not None:
+                self._add_taken_over_shard(shard_index,
+                        (yield self._put_heartbeat(shard_index,
+                        _ActiveCuratorDetails(self._id, datetime.utcnow()),
+                        last_ref_value)))
+
+    def _try_to_become_active(self):
+        """
+        Try to become the active curator of this curator's shard.
+        :return: whether this curator became the active curator
+        """
+        # Check to see when the last active curator heartbeat was sent.
+        response = yield _Call(self._client.get, _curators_collection,
+                self._get_active_curator_key(self._shard_indexes[0]), None,
+                False)
         try:
             response.raise_for_status()
         except Exception as e:
@@ -119,103 +446,349 @@ class Curator(Client):
             if (_get_httperror_status_code(e) == 404):
                 # Try to send a heartbeat and return the result indicating
                 # whether this curator instance has become active.
-                return self._try_send_heartbeat(add_new_record=True)
+                raise _Return((yield self._try_send_heartbeat(
+                        add_new_record=True)))
             else:
                 raise e
-        active_curator_details = _ActiveCuratorDetails(
-                response.json['curator_id'],
-                dateutil.parser.parse(response.json['timestamp']))
+        active_curator_details = Curator._get_active_curator_details(
+                response)
         # If the last active curator's heartbeat is timed out then
         # try to become the active curator.
-        if ((datetime.utcnow() - active_curator_details.timestamp).
-                total_seconds() * 1000.0 > _curator_heartbeat_timeout_in_ms):
-            time.sleep(_additional_timeout_wait_in_ms / 1000.0)
-            self._last_heartbeat_ref = response.ref
+        if self._is_heartbeat_timed_out(active_curator_details):
+            yield _Sleep(self._get_additional_timeout_wait_in_ms() / 1000.0)
+            self._last_heartbeat_refs[self._shard_indexes[0]] = response.ref
             self._last_heartbeat_time = active_curator_details.timestamp
-            return self._try_send_heartbeat()
+            raise _Return((yield self._try_send_heartbeat()))
         else:
-            return False
+            raise _Return(False)
 
     def _curate(self):
         """
-        Curate any broken jobs and locks in o.io.
+        Curate any broken jobs and locks in o.io. Timed out jobs are curated
+        first, then locks, and then orphaned journal items, where the records
+        of each are curated concurrently.
+        :return: whether anything was curated
+        """
+        start_time = time.time()
+        self._is_curation_aborted = False
+        self._jobs_listing_time_in_ms = _get_timestamp_in_ms(
+                datetime.utcnow())
+        self._listed_job_ids = set()
+        was_something_curated = yield _Call(self._curate_concurrently,
+                self._curate_job, _jobs_collection, 'timestamp', 'job')
+        if (yield _Call(self._curate_concurrently, self._curate_lock,
+                _locks_collection, 'job_timestamp', 'lock')):
+            was_something_curated = True
+        if (yield _Call(self._curate_concurrently,
+                self._curate_journal_record, _journal_collection,
+                'job_timestamp', 'journal item')):
+            was_something_curated = True
+        self.metrics.observe('oiot_curator_pass_seconds',
+                time.time() - start_time)
+        raise _Return(was_something_curated)
+
+    def _curate_concurrently(self, curate_record, collection,
+            timestamp_field, description):
+        """
+        Curate the records of the specified collection that may need to be
+        curated using a pool of worker threads. Records are taken from the
+        records iterable only as workers become available, so they are
+        curated while later pages are still being retrieved. If this curator
+        is no longer active then the records that are not being curated yet
+        are skipped, and the records being curated stop at their next
+        heartbeat. The numbers of records and of curated records are
+        recorded in the metrics.
+        :param curate_record: the operation curating a single record and
+        returning whether it was curated
+        :param collection: the collection
+        :param timestamp_field: the name of the records' timestamp field
+        :param description: the description of the records used in messages
+        :return: whether any record was curated
         """
-        was_something_curated = False
-        pages = self._client.list(_jobs_collection)
-        jobs = pages.all()
-        for job in jobs:
+        records = self._get_curation_candidates(collection, timestamp_field)
+        def curate(record):
             try:
-                if job is None:
-                    continue
-                if ((datetime.utcnow() - dateutil.parser.parse(
-                        job['value']['timestamp'])).total_seconds() * 1000.0 >
-                        _max_job_time_in_ms + _additional_timeout_wait_in_ms):
-                    was_something_curated = True
-                    # Iterate on the journal items and roll back each one.
-                    for item in job['value']['items']:
-                        journal_item = _JournalItem(item['timestamp'],
-                                item['collection'], item['key'],
-                                item['original_value'],
-                                item['new_value'])
-                        Job._roll_back_journal_item(self._client,
-                                journal_item, self._try_send_heartbeat)
-                    self._append_to_removed_job_ids(job['path']['key'])
-                    self._try_send_heartbeat()
-                    response = self._client.delete(_jobs_collection,
-                            job['path']['key'], None, False)
-                    response.raise_for_status()
+                return self._run_steps(curate_record(record))
             except _CuratorNoLongerActive:
                 raise
             except Exception as e:
-                print('Caught while processing a job: ' +
+                self.metrics.increment('oiot_curator_errors_total',
+                        {'kind': description})
+                print('Caught while processing a ' + description + ': ' +
                       _format_exception(e))
-        pages = self._client.list(_locks_collection)
-        locks = pages.all()
-        for lock in locks:
+                return False
+        record_count = 0
+        curated_count = 0
+        with ThreadPoolExecutor(max_workers = self._worker_count) as executor:
+            futures = set()
             try:
-                if lock is None:
-                    continue
-                is_lock_associated_with_removed_job = (lock['value']['job_id']
-                        in self._removed_job_ids)
-                if (is_lock_associated_with_removed_job or
-                        (datetime.utcnow() - dateutil.parser.parse(
-                        lock['value']['job_timestamp'])).total_seconds() *
-                        1000.0 > _max_job_time_in_ms +
-                        _additional_timeout_wait_in_ms):
-                    if is_lock_associated_with_removed_job is False:
-                        response = self._client.get(_jobs_collection,
-                                lock['value']['job_id'], None, False)
-                        if response.status_code == 404:
-                            is_lock_associated_with_removed_job = True
-                    if is_lock_associated_with_removed_job:
-                        was_something_curated = True
-                        self._try_send_heartbeat()
-                        response = self._client.delete(_locks_collection,
-                                lock['path']['key'], lock['path']['ref'],
-                                False)
-                        response.raise_for_status()
+                for record in records:
+                    if record is None:
+                        continue
+                    record_count += 1
+                    # Keep at most two records per worker in flight.
+                    if len(futures) >= self._worker_count * 2:
+                        done, futures = wait(futures,
+                                return_when = FIRST_COMPLETED)
+                        curated_count += sum(1 for future in done
+                                if future.result())
+                    futures.add(executor.submit(curate, record))
+                curated_count += sum(1 for future in wait(futures).done
+                        if future.result())
             except _CuratorNoLongerActive:
+                for future in futures:
+                    future.cancel()
                 raise
-            except Exception as e:
-                print('Caught while processing a lock: ' +
-                      _format_exception(e))
-        return was_something_curated
+        self._record_curation_metrics(description, record_count,
+                curated_count)
+        return curated_count > 0
+
+    def _record_curation_metrics(self, description, record_count,
+            curated_count):
+        """
+        Record the numbers of records and of curated records of a pass in
+        the metrics.
+        :param description: the description of the records
+        :param record_count: the number of records
+        :param curated_count: the number of curated records
+        """
+        labels = {'kind': description}
+        self.metrics.set_gauge('oiot_curator_last_pass_records',
+                record_count, labels)
+        self.metrics.set_gauge('oiot_curator_last_pass_curated',
+                curated_count, labels)
+        self.metrics.increment('oiot_curator_curated_total', labels,
+                curated_count)
+
+    def _curate_job(self, job):
+        """
+        Roll back and remove the specified job if it is timed out.
+        :param job: the job listed from the jobs collection
+        :return: whether the job was curated
+        """
+        # Locks and journal items of timed out jobs missing from the listing
+        # are orphaned.
+        self._listed_job_ids.add(job['path']['key'])
+        if self._is_in_shard(job['path']['key']) is False:
+            raise _Return(False)
+        if self._is_job_timed_out(job) is False:
+            raise _Return(False)
+        with self.metrics.timer('oiot_curator_operation_seconds',
+                {'operation': 'rollback'}):
+            yield Job._roll_back_journal_items(self._client,
+                    (yield Job._get_journal_items(self._client,
+                    job['path']['key'], job['value'])),
+                    self._try_send_heartbeat)
+        self._append_to_removed_job_ids(job['path']['key'])
+        yield self._try_send_heartbeat()
+        with self.metrics.timer('oiot_curator_operation_seconds',
+                {'operation': 'delete'}):
+            response = yield _Call(self._client.delete, _jobs_collection,
+                    job['path']['key'], None, False)
+        response.raise_for_status()
+        raise _Return(True)
+
+    def _curate_lock(self, lock):
+        """
+        Remove the specified lock, or the readers of a shared read lock, if
+        the jobs holding it were removed.
+        :param lock: the lock listed from the locks collection
+        :return: whether the lock was curated
+        """
+        if self._is_in_shard(lock['path']['key']) is False:
+            raise _Return(False)
+        if lock['value'].get('mode') == 'read':
+            raise _Return((yield self._curate_read_lock(lock)))
+        if (yield self._is_job_removed(lock['value']['job_id'],
+                _get_record_expiration_in_ms(lock['value'],
+                'job_timestamp'))) is False:
+            raise _Return(False)
+        yield self._try_send_heartbeat()
+        with self.metrics.timer('oiot_curator_operation_seconds',
+                {'operation': 'delete'}):
+            response = yield _Call(self._client.delete, _locks_collection,
+                    lock['path']['key'], lock['path']['ref'], False)
+        response.raise_for_status()
+        raise _Return(True)
+
+    def _curate_journal_record(self, journal_record):
+        """
+        Remove the specified journal item if it is orphaned.
+        :param journal_record: the journal item listed from the journal
+        collection
+        :return: whether the journal item was curated
+        """
+        # Journal items of removed jobs and of timed out jobs that no longer
+        # exist are orphaned.
+        if self._is_in_shard(journal_record['value']['job_id']) is False:
+            raise _Return(False)
+        if (yield self._is_job_removed(journal_record['value']['job_id'],
+                _get_record_expiration_in_ms(journal_record['value'],
+                'job_timestamp'))) is False:
+            raise _Return(False)
+        yield self._try_send_heartbeat()
+        with self.metrics.timer('oiot_curator_operation_seconds',
+                {'operation': 'delete'}):
+            response = yield _Call(self._client.delete, _journal_collection,
+                    journal_record['path']['key'],
+                    journal_record['path']['ref'], False)
+        response.raise_for_status()
+        raise _Return(True)
+
+    def _get_curation_candidates(self, collection, timestamp_field):
+        """
+        Get the records of the specified collection that may need to be
+        curated, retrieving the pages lazily.
+        :param collection: the collection
+        :param timestamp_field: the name of the records' timestamp field
+        :return: the records iterator
+        """
+        return _iterate_records(self._get_curation_pages(collection,
+                timestamp_field), self.metrics)
+
+    def _get_curation_pages(self, collection, timestamp_field):
+        """
+        Get the pages of the records of the specified collection that may
+        need to be curated. When searching, only the records whose timestamp
+        field is older than the job timeout are retrieved, otherwise the
+        entire collection is listed.
+        :param collection: the collection
+        :param timestamp_field: the name of the records' timestamp field
+        :return: the pages
+        """
+        if self._use_search is False:
+            return self._client.list(collection)
+        return self._client.search(collection,
+                self._get_timed_out_query(timestamp_field))
+
+    def _get_timed_out_query(self, timestamp_field):
+        """
+        Get the search query matching the records whose jobs may have timed
+        out more than the additional timeout wait ago, going by the stored
+        expiration of records of jobs using leases or adaptive budgets and
+        of shared read locks, and by the timestamp field otherwise.
+        :param timestamp_field: the name of the records' timestamp field
+        :return: the search query
+        """
+        timeout_wait_in_ms = self._get_additional_timeout_wait_in_ms()
+        now = datetime.utcnow()
+        expiration_in_ms = _get_timestamp_in_ms(now) - timeout_wait_in_ms
+        # The per-record checks decide whether a matched record is curated,
+        # so records matched by their timestamp field although their lease
+        # was renewed are merely skipped. ISO 8601 timestamps sort
+        # chronologically.
+        return ('value.lease_expiration_in_ms:[* TO %d] OR '
+                'value.reader_expiration_in_ms:[* TO %d] OR '
+                'value.%s:[* TO "%s"]') % (expiration_in_ms,
+                expiration_in_ms, timestamp_field, (now - timedelta(
+                milliseconds = _max_job_time_in_ms +
+                timeout_wait_in_ms)).isoformat())
+
+    def _is_job_timed_out(self, job):
+        """
+        Determine whether the specified job timed out more than the
+        additional timeout wait ago.
+        :param job: the job listed from the jobs collection
+        :return: whether the job timed out
+        """
+        return (_get_timestamp_in_ms(datetime.utcnow()) -
+                _get_record_expiration_in_ms(job['value'], 'timestamp') >
+                self._get_additional_timeout_wait_in_ms())
+
+    def _is_job_missing_from_listing(self, job_id, job_expiration_in_ms):
+        """
+        Determine whether the job holding a lock or owning a journal item
+        had timed out when the jobs were listed but was not listed.
+        :param job_id: the job ID
+        :param job_expiration_in_ms: the time at which the job times out in
+        milliseconds since the epoch
+        :return: whether the job is missing from the listing
+        """
+        # A job that was already timed out when the jobs were listed cannot
+        # have been added afterwards, so it no longer exists if it was not
+        # listed.
+        return (self._jobs_listing_time_in_ms is not None and
+                self._jobs_listing_time_in_ms - job_expiration_in_ms >
+                self._get_additional_timeout_wait_in_ms() and
+                job_id not in self._listed_job_ids)
+
+    def _is_job_removed(self, job_id, job_expiration_in_ms):
+        """
+        Determine whether the job holding a lock or owning a journal item was
+        removed, either by this curator or because it timed out and no longer
+        exists.
+        :param job_id: the job ID
+        :param job_expiration_in_ms: the time at which the job times out in
+        milliseconds since the epoch
+        :return: whether the job was removed
+        """
+        if job_id in self._removed_job_ids:
+            raise _Return(True)
+        if self._is_job_missing_from_listing(job_id,
+                job_expiration_in_ms) is False:
+            raise _Return(False)
+        if self._use_search:
+            # Search results may lag behind so make sure that the job no
+            # longer exists.
+            response = yield _Call(self._client.get, _jobs_collection,
+                    job_id, None, False)
+            raise _Return(response.status_code == 404)
+        raise _Return(True)
+
+    def _curate_read_lock(self, lock):
+        """
+        Remove the readers of the specified shared read lock whose jobs were
+        removed, and remove the read lock itself if no readers remain.
+        :param lock: the read lock listed from the locks collection
+        :return: whether any readers were removed
+        """
+        readers = lock['value']['readers']
+        remaining_readers = {}
+        for reader_id, reader in readers.items():
+            if not (yield self._is_job_removed(reader['job_id'],
+                    _get_record_expiration_in_ms(reader, 'job_timestamp'))):
+                remaining_readers[reader_id] = reader
+        if len(remaining_readers) == len(readers):
+            raise _Return(False)
+        yield self._try_send_heartbeat()
+        with self.metrics.timer('oiot_curator_operation_seconds',
+                {'operation': 'delete'}):
+            if remaining_readers:
+                response = yield _Call(self._client.put, _locks_collection,
+                        lock['path']['key'], Job._create_read_lock_value(
+                        lock['value']['collection'], lock['value']['key'],
+                        remaining_readers), lock['path']['ref'], False)
+            else:
+                response = yield _Call(self._client.delete,
+                        _locks_collection, lock['path']['key'],
+                        lock['path']['ref'], False)
+        # A 412 error indicates that the readers changed in the meantime,
+        # in which case the read lock is curated again on the next pass.
+        if response.status_code != 412:
+            response.raise_for_status()
+        raise _Return(True)
 
     def run(self):
         """
         Run this curator instance.
         """
+        return self._run_steps(self._curate_until_stopped())
+
+    def _curate_until_stopped(self):
+        """
+        The operation implementing run().
+        """
         while (self._should_continue_to_run):
             try:
-                if self._determine_active_status():
-                    self._is_active = True
-                    if self._curate() is False:
-                        time.sleep(_curator_heartbeat_interval_in_ms
+                if (yield self._determine_active_status()):
+                    self._make_active()
+                    if (yield self._curate()) is False:
+                        yield _Sleep(_curator_heartbeat_interval_in_ms
                                 / 2.0 / 1000.0)
                     continue
             except _CuratorNoLongerActive:
                 pass
-            self._make_inactive_and_sleep()
+            yield self._make_inactive_and_sleep()
 
 
 class _ActiveCuratorDetails(object):
@@ -230,3 +803,99 @@ class _ActiveCuratorDetails(object):
         """
         self.curator_id = curator_id
         self.timestamp = timestamp
+
+    def _get_wire_dict(self):
+        """
+        Get the object stored in the curators collection for these details.
+        :return: the active curator object
+        """
+        return {'curator_id': _get_wire_value(self.curator_id),
+                'timestamp': _get_wire_value(self.timestamp)}
+
+
+def _get_next_page(pages, metrics):
+    """
+    Get the next page of the specified pages.
+    :param pages: the pages
+    :param metrics: the MetricsRegistry recording the retrieval latency
+    :return: the next page response or None if there are no more pages
+    """
+    start_time = time.time()
+    try:
+        response = next(pages)
+    except StopIteration:
+        return None
+    metrics.observe('oiot_curator_operation_seconds',
+            time.time() - start_time, {'operation': 'list'})
+    return response
+
+def _iterate_records(pages, metrics):
+    """
+    Iterate the records of the specified pages, retrieving the next page in
+    the background while the records of the current page are consumed.
+    :param pages: the pages
+    :param metrics: the MetricsRegistry recording the retrieval latencies
+    :return: the records iterator
+    """
+    with ThreadPoolExecutor(max_workers = 1) as executor:
+        next_page = executor.submit(_get_next_page, pages, metrics)
+        while True:
+            response = next_page.result()
+            if response is None:
+                return
+            response.raise_for_status()
+            next_page = executor.submit(_get_next_page, pages, metrics)
+            for record in response['results']:
+                yield record
+
+
+class _ExpiringSet(object):
+    """
+    A thread-safe set holding a bounded number of items, each of which
+    expires some time after it was added.
+    """
+    def __init__(self, max_size, lifetime_in_ms):
+        """
+        Create an ExpiringSet instance.
+        :param max_size: the maximum number of items, beyond which the oldest
+        items are evicted
+        :param lifetime_in_ms: the time after which an item expires
+        """
+        self._max_size = max_size
+        self._lifetime_in_ms = lifetime_in_ms
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remove_expired_items(self, now):
+        """
+        Remove the expired items and the oldest items beyond the maximum
+        number of items.
+        :param now: the current time in seconds
+        """
+        while self._items:
+            item, added_time = next(iter(self._items.items()))
+            if (len(self._items) <= self._max_size and
+                    (now - added_time) * 1000.0 <= self._lifetime_in_ms):
+                break
+            self._items.popitem(last = False)
+
+    def add(self, item):
+        """
+        Add the specified item, renewing it if it is already present.
+        :param item: the item
+        """
+        with self._lock:
+            now = time.time()
+            self._items.pop(item, None)
+            self._items[item] = now
+            self._remove_expired_items(now)
+
+    def __contains__(self, item):
+        with self._lock:
+            self._remove_expired_items(time.time())
+            return item in self._items
+
+    def __len__(self):
+        with self._lock:
+            self._remove_expired_items(time.time())
+            return len(self._items)
@@ -0,0 +1,529 @@
+"""
+    oiot.emulator
+    ~~~~~~~~~
+    This module implements the Emulator class, an in-process stand-in for
+    the o.io service with configurable latency and fault injection.
+    :copyright: (c) 2014 by Konstantin Bokarius.
+    :license: MIT, see LICENSE for more details.
+"""
+from collections import OrderedDict, defaultdict
+from requests import Response
+from requests.adapters import BaseAdapter
+from requests.exceptions import ConnectionError
+from requests.structures import CaseInsensitiveDict
+import json, random, re, threading, time
+
+try:
+    # python 2
+    from urllib import quote, unquote
+    from urlparse import urlparse, parse_qs
+    from httplib import responses as _reasons
+except ImportError:
+    # python 3
+    from urllib.parse import quote, unquote, urlparse, parse_qs
+    from http.client import responses as _reasons
+
+# default number of results returned per page by list operations
+_default_page_size = 10
+
+# maximum number of results o.io returns per page by list operations
+_max_page_size = 100
+
+# the subset of the search query syntax supported by the emulator, a range
+# query on a single field of the value such as value.timestamp:[* TO "..."],
+# any number of which may be joined by OR
+_range_query_pattern = re.compile(
+        r'^value\.([\w.]+):\[(\*|"[^"]*"|\S+) TO (\*|"[^"]*"|\S+)\]$')
+
+def constant_latency(latency_in_ms):
+    """
+    Create a latency distribution that always returns the same latency.
+    :param latency_in_ms: the latency in milliseconds
+    :return: the latency distribution
+    """
+    return lambda rng, method, collection: latency_in_ms
+
+def uniform_latency(min_latency_in_ms, max_latency_in_ms):
+    """
+    Create a latency distribution that returns uniformly distributed
+    latencies.
+    :param min_latency_in_ms: the minimum latency in milliseconds
+    :param max_latency_in_ms: the maximum latency in milliseconds
+    :return: the latency distribution
+    """
+    return lambda rng, method, collection: rng.uniform(min_latency_in_ms,
+            max_latency_in_ms)
+
+def lognormal_latency(median_latency_in_ms, sigma = 0.5):
+    """
+    Create a latency distribution that returns log-normally distributed
+    latencies, which approximates real network round trip times and their
+    long tail.
+    :param median_latency_in_ms: the median latency in milliseconds
+    :param sigma: the standard deviation of the underlying normal
+    distribution
+    :return: the latency distribution
+    """
+    import math
+    mu = math.log(median_latency_in_ms)
+    return lambda rng, method, collection: rng.lognormvariate(mu, sigma)
+
+
+class Emulator(object):
+    """
+    An in-process emulation of the o.io key/value API. Mounting an emulator
+    on a porc.Client or OiotClient instance routes all of the client's
+    requests to the emulator instead of the network.
+    """
+    def __init__(self, latency = None, failure_rate = 0.0,
+                failure_status_code = 500, seed = None):
+        """
+        Create an Emulator instance.
+        :param latency: the latency distribution used for each call, either
+        None, a number of milliseconds, or a callable accepting a random
+        number generator, the HTTP method, and the collection and returning
+        milliseconds
+        :param failure_rate: the probability that any call fails
+        :param failure_status_code: the status code returned by randomly
+        failed calls, or None to raise a ConnectionError instead
+        :param seed: the seed for the random number generator
+        """
+        if latency is not None and not callable(latency):
+            latency = constant_latency(latency)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.failure_status_code = failure_status_code
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._collections = defaultdict(dict)
+        self._injected_failures = []
+        self.call_counts = defaultdict(int)
+
+    def mount(self, client):
+        """
+        Route all requests made by the specified client to this emulator.
+        :param client: the porc.Client or OiotClient instance
+        :return: the specified client
+        """
+        adapters = OrderedDict([(client.uri, _EmulatorAdapter(self))])
+        # Pages instances create their own sessions from the client options.
+        client.opts['adapters'] = adapters
+        for session in [client.session, client.async_session]:
+            session.adapters = adapters
+        return client
+
+    def inject_failure(self, method = None, collection = None,
+                status_code = 500, count = 1):
+        """
+        Fail the next matching calls.
+        :param method: the HTTP method to match or None to match all methods
+        :param collection: the collection to match or None to match all
+        collections
+        :param status_code: the status code to return, or None to raise a
+        ConnectionError instead
+        :param count: the number of calls to fail
+        """
+        with self._lock:
+            self._injected_failures.append(_InjectedFailure(method,
+                    collection, status_code, count))
+
+    def get_call_count(self, method = None, collection = None):
+        """
+        Get the number of calls received by this emulator.
+        :param method: the HTTP method to count or None to count all methods
+        :param collection: the collection to count or None to count all
+        collections
+        :return: the number of matching calls
+        """
+        with self._lock:
+            return sum(count for (call_method, call_collection), count in
+                    self.call_counts.items() if
+                    (method is None or method == call_method) and
+                    (collection is None or collection == call_collection))
+
+    def reset_call_counts(self):
+        """
+        Reset the call counts of this emulator.
+        """
+        with self._lock:
+            self.call_counts = defaultdict(int)
+
+    def clear(self):
+        """
+        Remove all collections from this emulator.
+        """
+        with self._lock:
+            self._collections = defaultdict(dict)
+
+    def _generate_ref(self):
+        """
+        Generate a random 16 character hexadecimal ref.
+        :return: the generated ref
+        """
+        return '%016x' % self._random.getrandbits(64)
+
+    def _pop_injected_failure(self, method, collection):
+        """
+        Get the status code of the injected failure matching the specified
+        call, if any, and decrement its remaining count.
+        :param method: the HTTP method
+        :param collection: the collection
+        :return: a tuple indicating whether the call should fail and the
+        status code to fail with
+        """
+        for failure in self._injected_failures:
+            if ((failure.method is None or failure.method == method) and
+                    (failure.collection is None or
+                    failure.collection == collection)):
+                failure.count -= 1
+                if failure.count <= 0:
+                    self._injected_failures.remove(failure)
+                return True, failure.status_code
+        if self.failure_rate and self._random.random() < self.failure_rate:
+            return True, self.failure_status_code
+        return False, None
+
+    def _handle(self, request):
+        """
+        Handle the specified request.
+        :param request: the prepared request
+        :return: the response
+        """
+        url = urlparse(request.url)
+        path = [unquote(elem) for elem in url.path.split('/') if elem]
+        if path and path[0] == 'v0':
+            path = path[1:]
+        params = dict((name, values[-1]) for name, values in
+                parse_qs(url.query).items())
+        method = request.method.upper()
+        collection = path[0] if path else None
+        with self._lock:
+            self.call_counts[(method, collection)] += 1
+            latency_in_ms = (self.latency(self._random, method, collection)
+                    if self.latency else 0)
+            should_fail, status_code = self._pop_injected_failure(method,
+                    collection)
+        if latency_in_ms > 0:
+            time.sleep(latency_in_ms / 1000.0)
+        if should_fail:
+            if status_code is None:
+                raise ConnectionError('Injected connection failure',
+                        request = request)
+            return _build_response(request, status_code,
+                    _error('injected_failure', 'Injected failure.'))
+        body = request.body
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+        with self._lock:
+            if method == 'HEAD' and not path:
+                return _build_response(request, 200)
+            elif len(path) == 1 and method == 'GET' and 'query' in params:
+                return self._search(request, collection, params)
+            elif len(path) == 1 and method == 'GET':
+                return self._list(request, collection, params)
+            elif len(path) == 1 and method == 'POST':
+                return self._put(request, collection,
+                        self._generate_ref(), body, None, None)
+            elif len(path) == 1 and method == 'DELETE':
+                self._collections.pop(collection, None)
+                return _build_response(request, 204)
+            elif len(path) == 2 and method in ['GET', 'HEAD']:
+                return self._get(request, collection, path[1], None)
+            elif len(path) == 4 and path[2] == 'refs' and method == 'GET':
+                return self._get(request, collection, path[1], path[3])
+            elif len(path) == 2 and method == 'PUT':
+                return self._put(request, collection, path[1], body,
+                        _get_if_match(request),
+                        request.headers.get('If-None-Match'))
+            elif len(path) == 2 and method == 'DELETE':
+                return self._delete(request, collection, path[1],
+                        _get_if_match(request))
+        return _build_response(request, 405,
+                _error('api_bad_request', 'Unsupported operation.'))
+
+    def _get(self, request, collection, key, ref):
+        """
+        Handle a get operation.
+        """
+        item = self._collections[collection].get(key)
+        if item is None or (ref is not None and ref not in item.history):
+            return _build_response(request, 404, _error('items_not_found',
+                    'The requested items could not be found.'))
+        if ref is None:
+            ref = item.ref
+        return _build_response(request, 200, item.history[ref],
+                {'ETag': '"' + ref + '"', 'Content-Location':
+                _get_ref_path(collection, key, ref)})
+
+    def _put(self, request, collection, key, body, if_match, if_none_match):
+        """
+        Handle a put or post operation.
+        """
+        try:
+            json.loads(body)
+        except Exception:
+            return _build_response(request, 400, _error('api_bad_request',
+                    'The request body is not valid JSON.'))
+        items = self._collections[collection]
+        item = items.get(key)
+        if ((if_match is not None and (item is None or item.ref != if_match))
+                or (if_none_match is not None and item is not None)):
+            return _build_response(request, 412,
+                    _error('item_version_mismatch',
+                    'The version of the item does not match.'))
+        if item is None:
+            item = items[key] = _EmulatedItem()
+        item.ref = self._generate_ref()
+        item.reftime = int(time.time() * 1000)
+        item.history[item.ref] = body
+        return _build_response(request, 201, None,
+                {'ETag': '"' + item.ref + '"', 'Location':
+                _get_ref_path(collection, key, item.ref)})
+
+    def _delete(self, request, collection, key, if_match):
+        """
+        Handle a delete operation.
+        """
+        items = self._collections[collection]
+        item = items.get(key)
+        if if_match is not None and (item is None or item.ref != if_match):
+            return _build_response(request, 412,
+                    _error('item_version_mismatch',
+                    'The version of the item does not match.'))
+        items.pop(key, None)
+        return _build_response(request, 204)
+
+    def _list(self, request, collection, params):
+        """
+        Handle a list operation. Results are ordered by key, bounded by the
+        startKey, afterKey and endKey parameters, and paged using afterKey.
+        """
+        limit = min(int(params.get('limit', _default_page_size)),
+                _max_page_size)
+        items = self._collections[collection]
+        keys = sorted(items)
+        if 'afterKey' in params:
+            keys = [key for key in keys if key > params['afterKey']]
+        elif 'startKey' in params:
+            keys = [key for key in keys if key >= params['startKey']]
+        if 'endKey' in params:
+            keys = [key for key in keys if key <= params['endKey']]
+        results = []
+        for key in keys[:limit]:
+            item = items[key]
+            results.append({'path': {'collection': collection, 'key': key,
+                    'ref': item.ref, 'reftime': item.reftime},
+                    'value': json.loads(item.history[item.ref]),
+                    'reftime': item.reftime})
+        body = {'count': len(results), 'results': results}
+        headers = {}
+        if len(keys) > limit:
+            next_path = ('/v0/' + quote(collection, '') + '?limit=' +
+                    str(limit) + '&afterKey=' + quote(keys[limit - 1], ''))
+            if 'endKey' in params:
+                next_path += '&endKey=' + quote(params['endKey'], '')
+            body['next'] = next_path
+            headers['Link'] = '<' + next_path + '>; rel="next"'
+        return _build_response(request, 200, body, headers)
+
+
+    def _search(self, request, collection, params):
+        """
+        Handle a search operation. Only range queries on fields of the value
+        joined by OR are supported. Numbers are compared numerically with
+        unquoted numeric bounds and everything else is compared as strings
+        lexicographically, so that ISO 8601 timestamps compare
+        chronologically. Results are ordered by key and paged using offset.
+        """
+        ranges = []
+        for clause in params['query'].strip().split(' OR '):
+            match = _range_query_pattern.match(clause.strip())
+            if match is None:
+                return _build_response(request, 400,
+                        _error('search_query_malformed',
+                        'Unsupported search query.'))
+            ranges.append((match.group(1).split('.'),
+                    [_get_search_bound(bound)
+                    for bound in match.group(2, 3)]))
+        limit = min(int(params.get('limit', _default_page_size)),
+                _max_page_size)
+        offset = int(params.get('offset', 0))
+        items = self._collections[collection]
+        matches = []
+        for key in sorted(items):
+            item = items[key]
+            value = json.loads(item.history[item.ref])
+            if any(_is_in_search_range(value, field_path, bounds)
+                    for field_path, bounds in ranges):
+                matches.append({'path': {'collection': collection,
+                        'key': key, 'ref': item.ref, 'reftime': item.reftime},
+                        'value': value, 'score': 1.0,
+                        'reftime': item.reftime})
+        results = matches[offset:offset + limit]
+        body = {'count': len(results), 'total_count': len(matches),
+                'results': results}
+        headers = {}
+        if offset + limit < len(matches):
+            next_path = ('/v0/' + quote(collection, '') + '?query=' +
+                    quote(params['query'], '') + '&limit=' + str(limit) +
+                    '&offset=' + str(offset + limit))
+            body['next'] = next_path
+            headers['Link'] = '<' + next_path + '>; rel="next"'
+        return _build_response(request, 200, body, headers)
+
+
+class _EmulatorAdapter(BaseAdapter):
+    """
+    A requests transport adapter that sends requests to an emulator.
+    """
+    def __init__(self, emulator):
+        """
+        Create an _EmulatorAdapter instance.
+        :param emulator: the emulator to send requests to
+        """
+        super(_EmulatorAdapter, self).__init__()
+        self.emulator = emulator
+
+    def send(self, request, **kwargs):
+        response = self.emulator._handle(request)
+        response.connection = self
+        return response
+
+    def close(self):
+        pass
+
+
+class _EmulatedItem(object):
+    """
+    Represents an emulated o.io item and the values of all of its refs.
+    """
+    def __init__(self):
+        """
+        Create an _EmulatedItem instance.
+        """
+        self.ref = None
+        self.reftime = None
+        self.history = {}
+
+
+class _InjectedFailure(object):
+    """
+    Represents a failure injected into an emulator.
+    """
+    def __init__(self, method = None, collection = None, status_code = None,
+                count = 1):
+        """
+        Create an _InjectedFailure instance.
+        :param method: the HTTP method to match
+        :param collection: the collection to match
+        :param status_code: the status code to fail with
+        :param count: the number of calls to fail
+        """
+        self.method = method
+        self.collection = collection
+        self.status_code = status_code
+        self.count = count
+
+def _get_if_match(request):
+    """
+    Get the unquoted If-Match ref of the specified request.
+    :param request: the specified request
+    :return: the ref or None
+    """
+    if_match = request.headers.get('If-Match')
+    if if_match is None:
+        return None
+    return if_match.strip('"')
+
+def _get_ref_path(collection, key, ref):
+    """
+    Get the o.io path of the specified ref.
+    :param collection: the collection
+    :param key: the key
+    :param ref: the ref
+    :return: the ref path
+    """
+    return ('/v0/' + quote(collection, '') + '/' + quote(key, '') +
+            '/refs/' + ref)
+
+def _get_search_bound(bound):
+    """
+    Parse a bound of a search range query.
+    :param bound: the bound as it appears in the query
+    :return: None for *, otherwise the bound as a string and, if it is an
+    unquoted number, as a number or else None
+    """
+    if bound == '*':
+        return None
+    number = None
+    if not bound.startswith('"'):
+        try:
+            number = float(bound)
+        except ValueError:
+            pass
+    return bound.strip('"'), number
+
+def _is_in_search_range(value, field_path, bounds):
+    """
+    Determine whether the specified field of a value is within the bounds
+    of a search range query.
+    :param value: the value
+    :param field_path: the names leading to the field
+    :param bounds: the lower and upper bounds, either of which may be None
+    :return: whether the field is within the bounds
+    """
+    field_value = value
+    for name in field_path:
+        field_value = (field_value.get(name)
+                if isinstance(field_value, dict) else None)
+    if field_value is None:
+        return False
+    is_number = (isinstance(field_value, (int, float)) and
+            not isinstance(field_value, bool))
+    for index, bound in enumerate(bounds):
+        if bound is None:
+            continue
+        # Numbers compare numerically with unquoted numeric bounds and
+        # everything else compares as strings.
+        if is_number and bound[1] is not None:
+            compared_value, bound = field_value, bound[1]
+        else:
+            compared_value, bound = str(field_value), bound[0]
+        if (compared_value < bound if index == 0 else
+                compared_value > bound):
+            return False
+    return True
+
+def _error(code, message):
+    """
+    Create an o.io error body.
+    :param code: the error code
+    :param message: the error message
+    :return: the error body
+    """
+    return {'code': code, 'message': message}
+
+def _build_response(request, status_code, body = None, headers = None):
+    """
+    Build a requests response for the specified request.
+    :param request: the prepared request
+    :param status_code: the status code
+    :param body: the body, either a JSON string or an object to encode
+    :param headers: the headers
+    :return: the response
+    """
+    response = Response()
+    response.status_code = status_code
+    response.reason = _reasons.get(status_code)
+    response.headers = CaseInsensitiveDict(headers or {})
+    if body is None:
+        response._content = b''
+    else:
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        response._content = body.encode('utf-8')
+        response.headers['Content-Type'] = 'application/json'
+    response.encoding = 'utf-8'
+    response.url = request.url
+    response.request = request
+    return response
@@ -15,22 +15,34 @@ class CollectionKeyIsLocked(Exception):
     pass
 
 
+class CollectionKeyWasModified(Exception):
+    """
+    Raised when an optimistic job finds that a key it accessed was
+    modified by someone else before the job completed.
+    """
+    pass
+
+
 class FailedToComplete(Exception):
     """
     Raised when a job fails to complete.
     """
     def __init__(self, exception_failing_completion=None,
-                stacktrace_failing_completion=None):
+                stacktrace_failing_completion=None,
+                locks_failing_removal=None):
         """
         Create a FailedToComplete instance.
         :param exception_failing_completion: the exception that caused the
         job completion to fail
         :param stacktrace_failing_completion: the stacktrace that caused the
         job completion to fail
+        :param locks_failing_removal: the (collection, key, exception)
+        tuples of the locks that could not be removed
         """
         super(FailedToComplete, self).__init__()
         self.exception_failing_completion = exception_failing_completion
         self.stacktrace_failing_completion = stacktrace_failing_completion
+        self.locks_failing_removal = locks_failing_removal
 
 
 class FailedToRollBack(Exception):
@@ -105,6 +117,22 @@ class JobIsTimedOut(Exception):
     pass
 
 
+class _FailedToRemoveLocks(Exception):
+    """
+    Raised when some of a job's locks could not be removed.
+    """
+    def __init__(self, locks_failing_removal=None):
+        """
+        Create a _FailedToRemoveLocks instance.
+        :param locks_failing_removal: the (collection, key, exception)
+        tuples of the locks that could not be removed
+        """
+        super(_FailedToRemoveLocks, self).__init__(
+                'Failed to remove ' + str(len(locks_failing_removal or [])) +
+                ' lock(s)')
+        self.locks_failing_removal = locks_failing_removal
+
+
 class _CuratorNoLongerActive(Exception):
     """
     Raised when an active curator is no longer active.
@@ -7,34 +7,211 @@
 """
 
 import os, sys, traceback, binascii, json, random, string, \
-        datetime, uuid
+        datetime, uuid, threading, time
+import dateutil.parser
 from datetime import datetime
+from collections import OrderedDict
 from .settings import _locks_collection, _jobs_collection, \
-        _max_job_time_in_ms, _deleted_object_value
+        _journal_collection, _max_job_time_in_ms, _deleted_object_value, \
+        _use_append_only_journal, \
+        _max_lock_update_attempts, _use_optimistic_concurrency, \
+        _use_leases, _lease_time_in_ms, _fencing_tokens_collection, \
+        _additional_timeout_wait_in_ms, _lock_wait_timeout_in_ms, \
+        _initial_lock_wait_backoff_in_ms, _max_lock_wait_backoff_in_ms, \
+        _use_wait_die, _use_adaptive_timeouts
 from .exceptions import JobIsRolledBack, JobIsFailed, FailedToComplete, \
         FailedToRollBack, RollbackCausedByException, JobIsTimedOut, \
-        CollectionKeyIsLocked, JobIsCompleted, _get_httperror_status_code    
+        CollectionKeyIsLocked, JobIsCompleted, CollectionKeyWasModified, \
+        _FailedToRemoveLocks
+from .serializer import _get_wire_value
+from .steps import _Return, _Call, _Concurrently, _Sleep, _Locked, \
+        _run_steps
+
+# start of the epoch of millisecond timestamps
+_epoch = datetime(1970, 1, 1)
+
+# number of sequential round trips a job needs to roll back after an
+# operation, which an adaptive budget must leave room for
+_roll_back_round_trips = 4
+
+def _get_timestamp_in_ms(timestamp):
+    """
+    Get the number of milliseconds between the epoch and the specified UTC
+    timestamp. Records store it next to their ISO 8601 timestamps so
+    curators can compare timestamps without parsing them.
+    :param timestamp: the UTC timestamp
+    :return: the number of milliseconds
+    """
+    delta = timestamp - _epoch
+    return ((delta.days * 86400 + delta.seconds) * 1000 +
+            delta.microseconds // 1000)
+
+def _get_record_timestamp_in_ms(value, timestamp_field):
+    """
+    Get the specified timestamp field of a record in milliseconds since the
+    epoch. Records written by older versions of oiot only have the ISO 8601
+    timestamp, which is parsed instead.
+    :param value: the record value
+    :param timestamp_field: the name of the ISO 8601 timestamp field
+    :return: the timestamp in milliseconds
+    """
+    timestamp_in_ms = value.get(timestamp_field + '_in_ms')
+    if timestamp_in_ms is not None:
+        return timestamp_in_ms
+    return _get_timestamp_in_ms(dateutil.parser.parse(value[timestamp_field]))
+
+def _get_record_expiration_in_ms(value, timestamp_field):
+    """
+    Get the time at which the job of a record times out in milliseconds
+    since the epoch, which is the lease expiration of jobs using leases or
+    adaptive budgets and _max_job_time_in_ms after the job timestamp
+    otherwise.
+    :param value: the record value
+    :param timestamp_field: the name of the ISO 8601 job timestamp field
+    :return: the expiration in milliseconds
+    """
+    lease_expiration_in_ms = value.get('lease_expiration_in_ms')
+    if lease_expiration_in_ms is not None:
+        return lease_expiration_in_ms
+    return (_get_record_timestamp_in_ms(value, timestamp_field) +
+            _max_job_time_in_ms)
+
+def _get_lock_wait_delay_in_ms(retry):
+    """
+    Get the time to wait before the specified retry of a lock acquisition,
+    which is a random time of up to a backoff that doubles with every retry
+    and is capped at _max_lock_wait_backoff_in_ms. The randomness spreads out
+    the retries of clients waiting for the same collection key.
+    :param retry: the number of retries so far
+    :return: the time to wait in milliseconds
+    """
+    return random.uniform(0, min(_max_lock_wait_backoff_in_ms,
+            _initial_lock_wait_backoff_in_ms * 2 ** min(retry, 32)))
+
+def _raise_if_locked(lock_response, allow_readers):
+    """
+    Raise CollectionKeyIsLocked if the specified response of a lock
+    retrieval contains a lock.
+    :param lock_response: the response of the lock retrieval
+    :param allow_readers: whether shared read locks are ignored
+    """
+    if lock_response.status_code == 404:
+        return
+    lock_response.raise_for_status()
+    if allow_readers and lock_response.json.get('mode') == 'read':
+        return
+    raise CollectionKeyIsLocked
 
 class Job:
     """
     A class used for executing o.io operations as a single atomic
     transaction by utilizing locking and journaling mechanisms.
     """
-    def __init__(self, client):
+    # The driver running the operations of this job.
+    _run_steps = staticmethod(_run_steps)
+
+    def __init__(self, client, use_append_only_journal = None,
+            use_optimistic_concurrency = None, use_leases = None,
+            lease_time_in_ms = None, renew_automatically = False,
+            lock_wait_timeout_in_ms = None, use_wait_die = None,
+            use_adaptive_timeouts = None):
         """
         Create a Job instance.
         :param client: the client to use
+        :param use_append_only_journal: whether to store each journal item
+        as its own record instead of rewriting the entire journal in the job
+        record for every operation, defaults to _use_append_only_journal
+        :param use_optimistic_concurrency: whether to buffer writes without
+        locking and apply them at completion conditionally on the refs of
+        the objects accessed, defaults to _use_optimistic_concurrency
+        :param use_leases: whether the job times out when its lease expires
+        instead of after _max_job_time_in_ms, and takes fencing tokens for
+        its write locks, defaults to _use_leases
+        :param lease_time_in_ms: the time after the job starts or renews its
+        lease at which the lease expires, defaults to _lease_time_in_ms
+        :param renew_automatically: whether to renew the lease from a
+        background thread every third of the lease time until the job is
+        completed or rolled back
+        :param lock_wait_timeout_in_ms: the maximum time to wait for a locked
+        collection key to be unlocked before rolling back with
+        CollectionKeyIsLocked, defaults to _lock_wait_timeout_in_ms
+        :param use_wait_die: whether to roll back with CollectionKeyIsLocked
+        instead of waiting for a collection key locked by an older job,
+        defaults to _use_wait_die
+        :param use_adaptive_timeouts: whether a job not using leases times
+        out after a budget derived from the latency measured by its client
+        instead of after _max_job_time_in_ms, and rolls back operations the
+        rest of its budget cannot cover, defaults to _use_adaptive_timeouts
         """
         self._job_id = Job._generate_key()
         self._timestamp = datetime.utcnow()
+        self._timestamp_in_ms = _get_timestamp_in_ms(self._timestamp)
         self._client = client
+        if use_append_only_journal is None:
+            use_append_only_journal = _use_append_only_journal
+        self._use_append_only_journal = use_append_only_journal
+        if use_optimistic_concurrency is None:
+            use_optimistic_concurrency = _use_optimistic_concurrency
+        self._use_optimistic_concurrency = use_optimistic_concurrency
+        if use_leases is None:
+            use_leases = _use_leases
+        self._use_leases = use_leases
+        if lease_time_in_ms is None:
+            lease_time_in_ms = _lease_time_in_ms
+        self._lease_time_in_ms = lease_time_in_ms
+        # The time in milliseconds since the epoch at which the lease
+        # expires, or None if the job does not use leases.
+        self._lease_expiration_in_ms = (self._timestamp_in_ms +
+                lease_time_in_ms if use_leases else None)
+        if use_adaptive_timeouts is None:
+            use_adaptive_timeouts = _use_adaptive_timeouts
+        # The LatencyEstimator of the client if the job uses an adaptive
+        # budget, or None.
+        self._latency_estimator = (getattr(client, '_latency_estimator',
+                None) if use_adaptive_timeouts and not use_leases else None)
+        # The time after the job starts at which it times out unless it uses
+        # leases.
+        self._job_time_in_ms = _max_job_time_in_ms
+        if self._latency_estimator is not None:
+            self._job_time_in_ms = self._latency_estimator.get_job_time_in_ms()
+            # The budget is stored in the job's records like a lease that is
+            # never renewed, so curators time the job out when it does.
+            self._lease_expiration_in_ms = (self._timestamp_in_ms +
+                    self._job_time_in_ms)
+        # Held while writing or removing the job record so a renewal
+        # neither overwrites a newer journal nor adds back a removed job.
+        self._job_record_lock = threading.Lock()
+        self._is_job_record_removed = False
+        if renew_automatically and use_leases is False:
+            raise ValueError('Only jobs using leases can be renewed')
+        self._renew_automatically = renew_automatically
+        if lock_wait_timeout_in_ms is None:
+            lock_wait_timeout_in_ms = _lock_wait_timeout_in_ms
+        self._lock_wait_timeout_in_ms = lock_wait_timeout_in_ms
+        if use_wait_die is None:
+            use_wait_die = _use_wait_die
+        # Jobs are ordered by their timestamps and IDs, and a job only
+        # waits for locks held by younger jobs so waits cannot form a cycle.
+        self._wait_die_priority = ((self._timestamp_in_ms, self._job_id)
+                if use_wait_die else None)
         self._locks = []
+        # The tokens of the entries this job holds in the local lock table
+        # of its client, keyed by (collection, key) tuples.
+        self._local_lock_tokens = {}
         self._journal = []
+        # The refs and values read and the writes buffered by an optimistic
+        # job, keyed by (collection, key) tuples.
+        self._read_objects = OrderedDict()
+        self._buffered_writes = OrderedDict()
+        # The responses returned for the buffered writes, keyed by
+        # (collection, key) tuples.
+        self._buffered_write_responses = {}
         self.is_completed = False
         self.is_rolled_back = False
         # A job should fail only in the event of an exception during
         # completion or roll-back.
         self.is_failed = False
+        self._start_automatic_renewal()
 
     @staticmethod
     def _generate_key():
@@ -42,7 +219,7 @@ class Job:
         Generate a random 16 character alphanumeric string.
         :return: a random 16 character alphanumeric string.
         """
-        return str(binascii.b2a_hex(os.urandom(8)))
+        return binascii.b2a_hex(os.urandom(8)).decode('ascii')
 
     @staticmethod
     def _get_lock_collection_key(collection_to_lock, key_to_lock):
@@ -56,7 +233,60 @@ class Job:
         return collection_to_lock + "-" + str(key_to_lock)
 
     @staticmethod
-    def _create_and_add_lock(client, collection, key, job_id, timestamp):
+    def _get_journal_collection_key(job_id, index):
+        """
+        Get the key used for the journal collection based on the specified
+        job ID and journal item index.
+        :param job_id: the job ID
+        :param index: the journal item index
+        :return: the formatted journal collection key
+        """
+        return job_id + "-" + "%08d" % index
+
+    @staticmethod
+    def _get_journal_collection_key_range(job_id):
+        """
+        Get the first and last possible journal collection keys of the
+        specified job ID. Keys of the job's journal items sort in the
+        order the items were added.
+        :param job_id: the job ID
+        :return: the start and end keys
+        """
+        return job_id + "-", job_id + "-~"
+
+    @staticmethod
+    def _get_journal_items(client, job_id, job_value):
+        """
+        Get the journal items of the specified job in the order they
+        were added.
+        :param client: the client to use
+        :param job_id: the job ID
+        :param job_value: the job object stored in the jobs collection
+        :return: the journal items
+        """
+        items = job_value['items']
+        if job_value.get('use_append_only_journal'):
+            start_key, end_key = Job._get_journal_collection_key_range(job_id)
+            items = [record['value']['item'] for record in (yield _Call(
+                    client.list_all, _journal_collection, startKey =
+                    start_key, endKey = end_key))]
+        raise _Return(Job._create_journal_items(items))
+
+    @staticmethod
+    def _create_journal_items(items):
+        """
+        Create the journal items stored in a job object or in the records of
+        an append-only journal.
+        :param items: the stored journal item objects
+        :return: the journal items
+        """
+        return [_JournalItem(item['timestamp'], item['collection'],
+                item['key'], item['original_value'], item['new_value'])
+                for item in items]
+
+    @staticmethod
+    def _create_and_add_lock(client, collection, key, job_id, timestamp,
+            lease_expiration_in_ms = None):
         """
         Create and add a lock to the locks collection. This will instantiate a
         lock object, add its details to the locks collection in o.io, and return
@@ -66,91 +296,630 @@ class Job:
         :param key: the key
         :param job_id: the job ID
         :param timestamp: the timestamp
+        :param lease_expiration_in_ms: the lease expiration of the job or
+        None
         :return: the created lock
         """
         lock = _Lock(job_id, timestamp, datetime.utcnow(),
-                collection, key, None)
-        lock_response = client.put(_locks_collection,
+                collection, key, None,
+                lease_expiration_in_ms = lease_expiration_in_ms)
+        lock_response = yield _Call(client.put, _locks_collection,
                 Job._get_lock_collection_key(collection, key),
-                json.loads(json.dumps(vars(lock), cls=_Encoder)),
+                lock._get_wire_dict(),
                 False, False)
+        raise _Return(Job._get_added_lock(lock, lock_response))
+
+    @staticmethod
+    def _get_added_lock(lock, lock_response):
+        """
+        Get the specified lock once its object was added to the locks
+        collection.
+        :param lock: the lock
+        :param lock_response: the response of the addition, which raises
+        CollectionKeyIsLocked if the collection key was already locked
+        :return: the lock
+        """
         if lock_response.status_code == 412:
             raise CollectionKeyIsLocked
         lock_response.raise_for_status()
         lock.lock_ref = lock_response.ref
         return lock
 
+    @staticmethod
+    def _create_read_lock_value(collection, key, readers):
+        """
+        Create the object stored in the locks collection for a shared read
+        lock held by the specified readers.
+        :param collection: the collection name
+        :param key: the key
+        :param readers: the readers' job IDs and job timestamps keyed by
+        reader ID
+        :return: the read lock object
+        """
+        # The job timestamp of a read lock is that of its newest reader and
+        # its reader expiration, which curators search by, is that of the
+        # reader that times out first. ISO 8601 timestamps sort
+        # chronologically.
+        value = {'mode': 'read', 'job_id': None,
+                'job_timestamp': max(reader['job_timestamp']
+                for reader in readers.values()),
+                'reader_expiration_in_ms': min(_get_record_expiration_in_ms(
+                reader, 'job_timestamp') for reader in readers.values()),
+                'timestamp': datetime.utcnow(), 'collection': collection,
+                'key': key, 'readers': readers}
+        # Readers added by older versions only have ISO 8601 timestamps.
+        if all('job_timestamp_in_ms' in reader for reader in
+                readers.values()):
+            value['job_timestamp_in_ms'] = max(reader['job_timestamp_in_ms']
+                    for reader in readers.values())
+        return _get_wire_value(value)
+
+    @staticmethod
+    def _create_reader_value(job_id, timestamp, lease_expiration_in_ms):
+        """
+        Create the entry of a reader in a shared read lock.
+        :param job_id: the job ID
+        :param timestamp: the job timestamp
+        :param lease_expiration_in_ms: the lease expiration of the job or
+        None
+        :return: the reader entry
+        """
+        reader = {'job_id': job_id, 'job_timestamp': timestamp,
+                'job_timestamp_in_ms': _get_timestamp_in_ms(timestamp)}
+        if lease_expiration_in_ms is not None:
+            reader['lease_expiration_in_ms'] = lease_expiration_in_ms
+        return _get_wire_value(reader)
+
+    @staticmethod
+    def _create_and_add_read_lock(client, collection, key, job_id, timestamp,
+            reader_id, lease_expiration_in_ms = None):
+        """
+        Create a shared read lock or join an existing one in the locks
+        collection and return the lock instance. Any number of readers may
+        hold a read lock at the same time, but not while the key is locked
+        for writing.
+        :param client: the client to use
+        :param collection: the collection name
+        :param key: the key
+        :param job_id: the job ID
+        :param timestamp: the timestamp
+        :param reader_id: the ID identifying the reader in the lock
+        :param lease_expiration_in_ms: the lease expiration of the job or
+        None
+        :return: the created lock
+        """
+        lock = _Lock(job_id, timestamp, datetime.utcnow(), collection, key,
+                None, 'read', reader_id,
+                lease_expiration_in_ms = lease_expiration_in_ms)
+        reader = Job._create_reader_value(job_id, timestamp,
+                lease_expiration_in_ms)
+        lock_collection_key = Job._get_lock_collection_key(collection, key)
+        readers = {}
+        ref = False
+        for attempt in range(_max_lock_update_attempts):
+            readers[reader_id] = reader
+            lock_response = yield _Call(client.put, _locks_collection,
+                    lock_collection_key, Job._create_read_lock_value(
+                    collection, key, readers), ref, False)
+            if lock_response.status_code != 412:
+                lock_response.raise_for_status()
+                lock.lock_ref = lock_response.ref
+                lock.readers = readers
+                raise _Return(lock)
+            # The lock was added or changed by another client so join it if
+            # it is a read lock.
+            readers, ref = Job._get_readers_to_join((yield _Call(client.get,
+                    _locks_collection, lock_collection_key, None, False)))
+        raise CollectionKeyIsLocked
+
+    @staticmethod
+    def _get_readers_to_join(get_response):
+        """
+        Get the readers of a lock retrieved in order to join it and the ref
+        to update it against.
+        :param get_response: the response of the retrieval of the lock,
+        which raises CollectionKeyIsLocked if the lock is a write lock
+        :return: the readers and the ref, which are empty and False if the
+        lock no longer exists
+        """
+        if get_response.status_code == 404:
+            return {}, False
+        get_response.raise_for_status()
+        if get_response.json.get('mode') != 'read':
+            raise CollectionKeyIsLocked
+        return get_response.json['readers'], get_response.ref
+
+    @staticmethod
+    def _get_remaining_readers(readers, reader_id):
+        """
+        Get the readers of a shared read lock other than the specified one.
+        :param readers: the readers keyed by reader ID
+        :param reader_id: the reader ID
+        :return: the remaining readers keyed by reader ID
+        """
+        return dict((other_reader_id, reader) for other_reader_id, reader in
+                readers.items() if other_reader_id != reader_id)
+
+    @staticmethod
+    def _is_reader(get_response, reader_id):
+        """
+        Determine whether the specified reader holds a shared read lock.
+        :param get_response: the response of the retrieval of the lock
+        :param reader_id: the reader ID
+        :return: whether the lock is a read lock held by the reader
+        """
+        if get_response.status_code == 404:
+            return False
+        get_response.raise_for_status()
+        return (get_response.json.get('mode') == 'read' and
+                reader_id in get_response.json['readers'])
+
+    @staticmethod
+    def _is_writer(get_response, job_id):
+        """
+        Determine whether the specified job holds a write lock.
+        :param get_response: the response of the retrieval of the lock
+        :param job_id: the job ID
+        :return: whether the lock is a write lock held by the job
+        """
+        if get_response.status_code == 404:
+            return False
+        get_response.raise_for_status()
+        return (get_response.json.get('mode') != 'read' and
+                get_response.json.get('job_id') == job_id)
+
+    @staticmethod
+    def _is_only_reader(lock_value, reader_id):
+        """
+        Determine whether the specified reader is the only reader of a
+        shared read lock, in which case the lock can be upgraded.
+        :param lock_value: the lock object
+        :param reader_id: the reader ID
+        :return: whether the lock is a read lock held by the reader alone
+        """
+        return (lock_value.get('mode') == 'read' and
+                list(lock_value['readers']) == [reader_id])
+
+    @staticmethod
+    def _remove_read_lock(client, lock):
+        """
+        Remove the specified reader's entry from a shared read lock, removing
+        the read lock itself if it has no other readers.
+        :param client: the client to use
+        :param lock: the read lock
+        """
+        lock_collection_key = Job._get_lock_collection_key(lock.collection,
+                lock.key)
+        readers, ref = lock.readers, lock.lock_ref
+        for attempt in range(_max_lock_update_attempts):
+            remaining_readers = Job._get_remaining_readers(readers,
+                    lock.reader_id)
+            if remaining_readers:
+                response = yield _Call(client.put, _locks_collection,
+                        lock_collection_key, Job._create_read_lock_value(
+                        lock.collection, lock.key, remaining_readers), ref,
+                        False)
+            else:
+                response = yield _Call(client.delete, _locks_collection,
+                        lock_collection_key, ref, False)
+            if response.status_code != 412:
+                response.raise_for_status()
+                return
+            # The readers changed so retry using the current readers.
+            get_response = yield _Call(client.get, _locks_collection,
+                    lock_collection_key, None, False)
+            if Job._is_reader(get_response, lock.reader_id) is False:
+                return
+            readers, ref = get_response.json['readers'], get_response.ref
+        # If necessary the curator will clean up the reader's entry.
+
+    @staticmethod
+    def _upgrade_read_lock(client, lock, job_id, timestamp,
+            lease_expiration_in_ms = None):
+        """
+        Upgrade the specified read lock to a write lock, which is only
+        possible if the lock has no other readers.
+        :param client: the client to use
+        :param lock: the read lock
+        :param job_id: the job ID
+        :param timestamp: the timestamp
+        :param lease_expiration_in_ms: the lease expiration of the job or
+        None
+        """
+        lock_collection_key = Job._get_lock_collection_key(lock.collection,
+                lock.key)
+        readers, ref = lock.readers, lock.lock_ref
+        for attempt in range(_max_lock_update_attempts):
+            if list(readers) == [lock.reader_id]:
+                write_lock = _Lock(job_id, timestamp, datetime.utcnow(),
+                        lock.collection, lock.key, None,
+                        lease_expiration_in_ms = lease_expiration_in_ms)
+                response = yield _Call(client.put, _locks_collection,
+                        lock_collection_key, write_lock._get_wire_dict(),
+                        ref, False)
+                if response.status_code != 412:
+                    response.raise_for_status()
+                    lock._set_upgraded(response.ref)
+                    return
+            # The known readers may be stale so retry using the current
+            # readers.
+            get_response = yield _Call(client.get, _locks_collection,
+                    lock_collection_key, None, False)
+            get_response.raise_for_status()
+            if Job._is_only_reader(get_response.json, lock.reader_id) is False:
+                raise CollectionKeyIsLocked
+            readers, ref = get_response.json['readers'], get_response.ref
+        raise CollectionKeyIsLocked
+
+    @staticmethod
+    def _get_next_fencing_token(token_response):
+        """
+        Get the fencing token following the last fencing token of a
+        collection key and the ref to update the last fencing token against.
+        :param token_response: the response of the retrieval of the last
+        fencing token from the fencing tokens collection
+        :return: the next fencing token and the ref
+        """
+        if token_response.status_code == 404:
+            return 1, False
+        token_response.raise_for_status()
+        return token_response.json['fencing_token'] + 1, token_response.ref
+
+    @staticmethod
+    def _assign_fencing_token(client, lock, token_response):
+        """
+        Assign the next fencing token of the collection key to the specified
+        write lock. The token is stored in the lock and, conditionally on
+        the last fencing token not having changed, in the fencing tokens
+        collection, so the fencing tokens of a collection key increase every
+        time it is locked for writing.
+        :param client: the client to use
+        :param lock: the write lock
+        :param token_response: the response of the retrieval of the last
+        fencing token from the fencing tokens collection
+        :return: whether the lock is still held, which it is not if a
+        curator removed it after the job's lease expired
+        """
+        lock_collection_key = Job._get_lock_collection_key(lock.collection,
+                lock.key)
+        for attempt in range(_max_lock_update_attempts):
+            lock.fencing_token, ref = Job._get_next_fencing_token(
+                    token_response)
+            lock_response, token_update_response = yield _Concurrently([
+                    _Call(client.put, _locks_collection, lock_collection_key,
+                    lock._get_wire_dict(), lock.lock_ref, False),
+                    _Call(client.put, _fencing_tokens_collection,
+                    lock_collection_key, {'fencing_token':
+                    lock.fencing_token}, ref, False)])
+            if lock_response.status_code == 412:
+                # A renewal of the job's lease may have updated the lock in
+                # the meantime, in which case a newer token is assigned.
+                get_response = yield Job._get_held_lock(client, lock)
+                if get_response is None:
+                    raise _Return(False)
+                lock.lock_ref = get_response.ref
+                token_response = yield _Call(client.get,
+                        _fencing_tokens_collection, lock_collection_key,
+                        None, False)
+                continue
+            lock_response.raise_for_status()
+            lock.lock_ref = lock_response.ref
+            if token_update_response.status_code != 412:
+                token_update_response.raise_for_status()
+                raise _Return(True)
+            # Another job took a fencing token since the last one was
+            # retrieved so retry using the current one.
+            token_response = yield _Call(client.get,
+                    _fencing_tokens_collection, lock_collection_key, None,
+                    False)
+        raise CollectionKeyIsLocked
+
+    @staticmethod
+    def _get_held_lock(client, lock):
+        """
+        Retrieve the specified lock of a job from the locks collection after
+        a conditional update of it failed, which it also does when a renewal
+        of the job's lease updated the lock in the meantime.
+        :param client: the client to use
+        :param lock: the write lock or read lock
+        :return: the response of the retrieval, or None if the job no
+        longer holds the lock
+        """
+        get_response = yield _Call(client.get, _locks_collection,
+                Job._get_lock_collection_key(lock.collection, lock.key), None,
+                False)
+        if lock.mode == 'read':
+            is_held = Job._is_reader(get_response, lock.reader_id)
+        else:
+            is_held = Job._is_writer(get_response, lock.job_id)
+        raise _Return(get_response if is_held else None)
+
+    @staticmethod
+    def _renew_lock(client, lock, lease_expiration_in_ms):
+        """
+        Store the specified lease expiration in the specified write lock of
+        a job, or in the job's entry of a shared read lock, so that the
+        expiration stored in the lock follows the job's renewed lease.
+        :param client: the client to use
+        :param lock: the write lock or read lock
+        :param lease_expiration_in_ms: the renewed lease expiration
+        :return: whether the lease expiration was stored, which it is not if
+        the job no longer holds the lock
+        """
+        lock_collection_key = Job._get_lock_collection_key(lock.collection,
+                lock.key)
+        lock.lease_expiration_in_ms = lease_expiration_in_ms
+        readers, ref = lock.readers, lock.lock_ref
+        for attempt in range(_max_lock_update_attempts):
+            # The lock may have been upgraded in the meantime.
+            if lock.mode == 'read':
+                readers = dict(readers)
+                readers[lock.reader_id] = dict(readers[lock.reader_id],
+                        lease_expiration_in_ms = lease_expiration_in_ms)
+                value = Job._create_read_lock_value(lock.collection, lock.key,
+                        readers)
+            else:
+                value = lock._get_wire_dict()
+            response = yield _Call(client.put, _locks_collection,
+                    lock_collection_key, value, ref, False)
+            if response.status_code != 412:
+                response.raise_for_status()
+                lock.lock_ref = response.ref
+                if lock.mode == 'read':
+                    lock.readers = readers
+                raise _Return(True)
+            # The lock was updated by another reader or by the job itself so
+            # retry using the current lock.
+            get_response = yield Job._get_held_lock(client, lock)
+            if get_response is None:
+                raise _Return(False)
+            ref = get_response.ref
+            if lock.mode == 'read':
+                readers = get_response.json['readers']
+        raise _Return(False)
+
+    @staticmethod
+    def _remove_lock_if_orphaned(client, collection, key):
+        """
+        Retrieve the lock of the specified collection key and remove it if
+        it is orphaned, which it is once the job holding it timed out more
+        than _additional_timeout_wait_in_ms ago and no longer exists, the
+        same way a curator would.
+        :param client: the client to use
+        :param collection: the collection
+        :param key: the key
+        :return: the lock object, or None if the key is no longer locked
+        """
+        lock_collection_key = Job._get_lock_collection_key(collection, key)
+        lock_response = yield _Call(client.get, _locks_collection,
+                lock_collection_key, None, False)
+        if lock_response.status_code == 404:
+            raise _Return(None)
+        lock_response.raise_for_status()
+        if Job._is_lock_timed_out(lock_response.json) is False:
+            raise _Return(lock_response.json)
+        # A timed out job that still exists must be rolled back by a curator
+        # before its locks can be removed.
+        job_id = lock_response.json.get('job_id')
+        if job_id is not None:
+            job_response = yield _Call(client.get, _jobs_collection, job_id,
+                    None, False)
+            if job_response.status_code != 404:
+                job_response.raise_for_status()
+                raise _Return(lock_response.json)
+        delete_response = yield _Call(client.delete, _locks_collection,
+                lock_collection_key, lock_response.ref, False)
+        if delete_response.status_code != 412:
+            delete_response.raise_for_status()
+        raise _Return(None)
+
+    @staticmethod
+    def _is_lock_timed_out(lock_value):
+        """
+        Determine whether the job holding the specified write lock timed out
+        more than _additional_timeout_wait_in_ms ago.
+        :param lock_value: the lock object
+        :return: whether the job timed out, which is never the case for
+        shared read locks whose readers are left to the curators
+        """
+        return (lock_value.get('mode') != 'read' and
+                _get_timestamp_in_ms(datetime.utcnow()) -
+                _get_record_expiration_in_ms(lock_value, 'job_timestamp') >
+                _additional_timeout_wait_in_ms)
+
+    @staticmethod
+    def _should_retrieve_lock(lock_expiration_in_ms, wait_die_priority):
+        """
+        Determine whether a job waiting for a lock should retrieve it to
+        find out whether it is orphaned or held by an older job.
+        :param lock_expiration_in_ms: the expiration of the job holding the
+        lock when it was last retrieved, or None if it was not retrieved yet
+        :param wait_die_priority: the wait-die priority of the waiting job
+        or None
+        :return: whether to retrieve the lock
+        """
+        # The lock is only retrieved when it is first found and once the job
+        # holding it timed out, so waiting adds few requests.
+        return (wait_die_priority is not None or
+                lock_expiration_in_ms is None or
+                _get_timestamp_in_ms(datetime.utcnow()) -
+                lock_expiration_in_ms > _additional_timeout_wait_in_ms)
+
+    @staticmethod
+    def _is_locked_by_older_job(lock_value, wait_die_priority):
+        """
+        Determine whether the specified lock is held by a job that is older
+        than the job with the specified wait-die priority. Locks taken by
+        OiotClient for single operations have no job and are always waited
+        for.
+        :param lock_value: the lock object
+        :param wait_die_priority: the timestamp in milliseconds and ID of
+        the waiting job, or None
+        :return: whether the lock is held by an older job
+        """
+        if wait_die_priority is None:
+            return False
+        holders = ([lock_value] if lock_value.get('mode') != 'read' else
+                list(lock_value['readers'].values()))
+        for holder in holders:
+            # The waiting job may be upgrading its own read lock.
+            if (holder['job_id'] is not None and
+                    holder['job_id'] != wait_die_priority[1] and
+                    (_get_record_timestamp_in_ms(holder, 'job_timestamp'),
+                    holder['job_id']) < wait_die_priority):
+                return True
+        return False
+
+    @staticmethod
+    def _wait_for_lock(client, collection, key, acquire,
+            lock_wait_timeout_in_ms, raise_if_timed_out = None,
+            wait_die_priority = None):
+        """
+        Run the step returned by the specified function acquiring a lock of
+        the specified collection key until it no longer raises
+        CollectionKeyIsLocked or the lock wait timeout expires. Retries back
+        off exponentially with jitter, except that an orphaned lock is
+        removed and retried immediately.
+        :param client: the client to use
+        :param collection: the collection
+        :param key: the key
+        :param acquire: the function returning the step acquiring the lock
+        :param lock_wait_timeout_in_ms: the maximum time to wait, or 0 to
+        raise CollectionKeyIsLocked without waiting
+        :param raise_if_timed_out: the function raising an exception if the
+        waiting job timed out, or None
+        :param wait_die_priority: the timestamp in milliseconds and ID of
+        the waiting job if CollectionKeyIsLocked is raised instead of waiting
+        for an older job, or None
+        :return: the result of the step
+        """
+        if not lock_wait_timeout_in_ms:
+            raise _Return((yield acquire()))
+        deadline = time.time() + lock_wait_timeout_in_ms / 1000.0
+        lock_expiration_in_ms = None
+        retry = 0
+        while True:
+            try:
+                result = yield acquire()
+                raise _Return(result)
+            except CollectionKeyIsLocked:
+                if time.time() >= deadline:
+                    raise
+            if Job._should_retrieve_lock(lock_expiration_in_ms,
+                    wait_die_priority):
+                lock_value = yield Job._remove_lock_if_orphaned(client,
+                        collection, key)
+                if lock_value is None:
+                    continue
+                if Job._is_locked_by_older_job(lock_value,
+                        wait_die_priority):
+                    raise CollectionKeyIsLocked
+                lock_expiration_in_ms = _get_record_expiration_in_ms(
+                        lock_value, 'job_timestamp')
+            yield _Sleep(min(_get_lock_wait_delay_in_ms(retry) / 1000.0,
+                    max(0, deadline - time.time())))
+            retry += 1
+            if raise_if_timed_out is not None:
+                raise_if_timed_out()
+
     @staticmethod
     def _roll_back_journal_item(client, journal_item, raise_if_timed_out):
         """
         Roll back the specified journal item.
         :param client: the client to use
         :param journal_item: the journal item to roll back
-        :param raise_if_timed_out: the method to call if the roll back times out
+        :param raise_if_timed_out: the method or operation to call if the
+        roll back times out
         """
         # Don't attempt to roll-back if the original value and the
         # new value are the same.
         if journal_item.original_value == journal_item.new_value:
             return
-        raise_if_timed_out()
-        was_objected_deleted = journal_item.new_value == _deleted_object_value
-        get_response = client.get(journal_item.collection,
+        yield _Call(raise_if_timed_out)
+        get_response = yield _Call(client.get, journal_item.collection,
                 journal_item.key, None, False)
-        try:
-            get_response.raise_for_status()
-        except Exception as e:
-            if _get_httperror_status_code(e) == 404:
-                if was_objected_deleted is False:
-                    return
-            else:
-                raise e
-        # Don't attempt to roll-back if the new value does not match
-        # unless the record was deleted by the job.
-        if (was_objected_deleted is False and
-                get_response.json != journal_item.new_value):
+        roll_back_write = Job._get_roll_back_write(journal_item, get_response)
+        if roll_back_write is None:
             return
-        # Was there an original value?
-        if journal_item.original_value:
-            # Put back the original value only if the new
-            # value matches or if the record was deleted by
-            # the job.
-            if ((was_objected_deleted and
-                    get_response.status_code == 404) or
-                    (was_objected_deleted is False and
-                    get_response.json == journal_item.new_value)):
-                original_ref = False
-                if was_objected_deleted is False:
-                    original_ref = get_response.ref
-                raise_if_timed_out()
-                try:
-                    put_response = client.put(
-                            journal_item.collection,
-                            journal_item.key,
-                            journal_item.original_value,
-                            original_ref, False)
-                    put_response.raise_for_status()
-                except Exception as e:
-                    # Ignore 412 error if the ref did not match.
-                    if (_get_httperror_status_code(e) == 412):
-                        return
-                    else:
-                        raise e
-        # No original value indicates that a new record was
-        # added and should be deleted.
+        value, ref = roll_back_write
+        yield _Call(raise_if_timed_out)
+        if value is None:
+            response = yield _Call(client.delete, journal_item.collection,
+                    journal_item.key, ref, False)
         else:
-            raise_if_timed_out()
-            try:
-                delete_response = client.delete(
-                        journal_item.collection,
-                        journal_item.key,
-                        get_response.ref, False)
-                delete_response.raise_for_status()
-            except Exception as e:
-                # Ignore 412 error if the ref did not match.
-                if (_get_httperror_status_code(e) == 412):
-                    return
-                else:
-                    raise e
+            response = yield _Call(client.put, journal_item.collection,
+                    journal_item.key, value, ref, False)
+        # Ignore 412 error if the ref did not match.
+        if response.status_code != 412:
+            response.raise_for_status()
+
+    @staticmethod
+    def _get_roll_back_write(journal_item, get_response):
+        """
+        Get the write rolling back the specified journal item given the
+        current state of its object. The original value is only put back if
+        the object still has the new value or if the job deleted it and it
+        was not added again, and an object added by the job is deleted.
+        :param journal_item: the journal item to roll back
+        :param get_response: the response of the retrieval of the object
+        :return: the value to put, or None to delete the object, and the ref
+        to write against, or None if nothing needs to be rolled back
+        """
+        was_objected_deleted = journal_item.new_value == _deleted_object_value
+        if get_response.status_code == 404:
+            if was_objected_deleted is False:
+                return None
+        else:
+            get_response.raise_for_status()
+            # Don't attempt to roll-back if the new value does not match
+            # unless the record was deleted by the job.
+            if (was_objected_deleted is False and
+                    get_response.json != journal_item.new_value):
+                return None
+        # No original value indicates that a new record was added and
+        # should be deleted.
+        if not journal_item.original_value:
+            return None, get_response.ref
+        if was_objected_deleted:
+            if get_response.status_code != 404:
+                return None
+            return journal_item.original_value, False
+        return journal_item.original_value, get_response.ref
+
+    @staticmethod
+    def _group_journal_items(journal_items):
+        """
+        Group the specified journal items by collection key. The journal
+        items of different groups can be rolled back concurrently, while
+        those of each group must be rolled back one at a time.
+        :param journal_items: the journal items in the order they were added
+        :return: the groups, each of which lists its journal items from the
+        newest to the oldest
+        """
+        groups = OrderedDict()
+        for journal_item in journal_items:
+            groups.setdefault((journal_item.collection, journal_item.key),
+                    []).append(journal_item)
+        return [list(reversed(group)) for group in groups.values()]
+
+    @staticmethod
+    def _roll_back_journal_items(client, journal_items, raise_if_timed_out):
+        """
+        Roll back the specified journal items. Journal items are grouped by
+        collection key and the groups are rolled back concurrently, while
+        the journal items of each group are rolled back one at a time from
+        the newest to the oldest.
+        :param client: the client to use
+        :param journal_items: the journal items to roll back
+        :param raise_if_timed_out: the method or operation to call if the
+        roll back times out, which must be thread-safe
+        """
+        def roll_back_group(group):
+            for journal_item in group:
+                yield Job._roll_back_journal_item(client, journal_item,
+                        raise_if_timed_out)
+        yield _Concurrently([roll_back_group(group) for group in
+                Job._group_journal_items(journal_items)])
 
     def _verify_job_is_active(self):
         """
@@ -169,49 +938,530 @@ class Job:
         Verify that this job is not timed out and raise an exception
         if it is.
         """
+        if self._use_leases:
+            expired_milliseconds = (_get_timestamp_in_ms(datetime.utcnow()) -
+                    self._lease_expiration_in_ms)
+            if expired_milliseconds > 0:
+                self._record_event('timeout')
+                raise JobIsTimedOut('Lease expired ' +
+                        str(expired_milliseconds) + 'ms ago')
+            return
         elapsed_milliseconds = (datetime.utcnow() -
                 self._timestamp).total_seconds() * 1000.0
-        if elapsed_milliseconds > _max_job_time_in_ms:
+        if elapsed_milliseconds > self._job_time_in_ms:
+            self._record_event('timeout')
             raise JobIsTimedOut('Ran for ' + str(elapsed_milliseconds) + 'ms')
 
+    def _raise_if_budget_is_insufficient(self, round_trip_count):
+        """
+        Raise an exception if this job uses an adaptive budget and the rest
+        of its budget cannot cover the specified number of round trips and a
+        roll back at the average round trip time of its client, in which case
+        the operation would time out anyway.
+        :param round_trip_count: the number of sequential round trips of the
+        operation
+        """
+        if self._latency_estimator is None:
+            return
+        expected_milliseconds = self._latency_estimator.\
+                get_expected_time_in_ms(round_trip_count +
+                _roll_back_round_trips)
+        if expected_milliseconds is None:
+            return
+        remaining_milliseconds = (self._get_expiration_in_ms() -
+                _get_timestamp_in_ms(datetime.utcnow()))
+        if remaining_milliseconds < expected_milliseconds:
+            self._record_event('timeout')
+            raise JobIsTimedOut(str(remaining_milliseconds) + 'ms left of ' +
+                    str(self._job_time_in_ms) + 'ms budget but ' +
+                    str(int(expected_milliseconds)) + 'ms expected')
+
+    def _start_automatic_renewal(self):
+        """
+        Start renewing the lease of this job from a background thread if the
+        job renews its lease automatically.
+        """
+        if self._renew_automatically:
+            thread = threading.Thread(target = self._renew_periodically)
+            thread.daemon = True
+            thread.start()
+
+    def _renew_periodically(self):
+        """
+        Renew the lease of this job every third of the lease time until the
+        job is completed or rolled back, or a renewal fails.
+        """
+        while True:
+            time.sleep(self._lease_time_in_ms / 3000.0)
+            try:
+                if self.renew() is False:
+                    return
+            except Exception:
+                # The job times out once its lease expires.
+                return
+
+    def _stop_automatic_renewal(self):
+        """
+        Stop renewing the lease of this job once the job record is removed.
+        The renewal thread stops by itself once renew() returns False.
+        """
+
+    def _get_job_record_lock(self):
+        """
+        Get the lock held while writing or removing the job record.
+        :return: the lock
+        """
+        return self._job_record_lock
+
+    def _record_event(self, event):
+        """
+        Report the specified event to the instrumentation of this job's
+        client, if any.
+        :param event: the event
+        """
+        instrumentation = getattr(self._client, '_instrumentation', None)
+        if instrumentation is not None:
+            instrumentation.on_event(event)
+
+    def _record_rollback(self, exception_causing_rollback):
+        """
+        Report a rollback of this job and the conflict that caused it, if
+        any, to the instrumentation of this job's client.
+        :param exception_causing_rollback: the exception and stacktrace that
+        caused the roll back or None
+        """
+        self._record_event('rollback')
+        if exception_causing_rollback:
+            if isinstance(exception_causing_rollback[0],
+                    CollectionKeyIsLocked):
+                self._record_event('lock_conflict')
+            elif isinstance(exception_causing_rollback[0],
+                    CollectionKeyWasModified):
+                self._record_event('write_conflict')
+
     def _remove_locks(self):
         """
-        Remove all locks associated with this job from o.io.
+        Concurrently remove all locks associated with this job from o.io.
+        This must be called after the job is removed, at which point the
+        locks no longer protect anything and are removed regardless of
+        whether the job is timed out.
         """
-        for lock in self._locks:
-            self._raise_if_job_is_timed_out()
-            response = self._client.delete(_locks_collection,
-                    Job._get_lock_collection_key(lock.collection, lock.key),
-                    lock.lock_ref, False)
-            response.raise_for_status()
-        self._locks = []
+        def remove_lock(lock):
+            try:
+                if lock.mode == 'read':
+                    yield Job._remove_read_lock(self._client, lock)
+                    return
+                response = yield _Call(self._client.delete,
+                        _locks_collection, Job._get_lock_collection_key(
+                        lock.collection, lock.key), lock.lock_ref, False)
+                response.raise_for_status()
+            except Exception as e:
+                raise _Return(e)
+        self._finish_lock_removal((yield _Concurrently([remove_lock(lock)
+                for lock in self._locks])))
+
+    def _renew_locks(self, lease_expiration_in_ms):
+        """
+        Concurrently store the specified lease expiration in all locks of
+        this job and in its entries in the local lock table of its client.
+        The job record remains the authority on whether the job timed out,
+        so the locks are renewed on a best effort basis.
+        :param lease_expiration_in_ms: the renewed lease expiration
+        """
+        lock_table = getattr(self._client, '_lock_table', None)
+        if lock_table is not None:
+            for (collection, key), token in list(
+                    self._local_lock_tokens.items()):
+                lock_table.renew(Job._get_lock_collection_key(collection,
+                        key), token, lease_expiration_in_ms +
+                        _additional_timeout_wait_in_ms)
+        def renew_lock(lock):
+            try:
+                yield Job._renew_lock(self._client, lock,
+                        lease_expiration_in_ms)
+            except Exception:
+                # A lock left with an earlier expiration is still not
+                # curated while the job record exists.
+                pass
+        yield _Concurrently([renew_lock(lock) for lock in list(self._locks)])
+
+    def _finish_lock_removal(self, exceptions):
+        """
+        Release the entries of this job in the local lock table of its
+        client and keep the locks that could not be removed.
+        :param exceptions: the exceptions raised removing each of this job's
+        locks, or None for the removed locks
+        """
+        # Local waiters go to o.io once the entries are released, where
+        # locks that could not be removed are left to the curators.
+        for collection, key in list(self._local_lock_tokens):
+            self._release_local_lock(collection, key)
+        failures = [(lock, exception) for lock, exception in
+                zip(self._locks, exceptions) if exception is not None]
+        # Keep the locks that could not be removed.
+        self._locks = [lock for lock, exception in failures]
+        if failures:
+            raise _FailedToRemoveLocks([(lock.collection, lock.key,
+                    exception) for lock, exception in failures])
 
     def _remove_job(self):
         """
         Remove this job from o.io.
         """
         self._raise_if_job_is_timed_out()
-        response = self._client.delete(_jobs_collection, self._job_id,
-                None, False)
+        def delete_job_record():
+            # Renewals must not add the job back once it is removed.
+            self._is_job_record_removed = True
+            response = yield _Call(self._client.delete, _jobs_collection,
+                    self._job_id, None, False)
+            raise _Return(response)
+        response = yield _Locked(self._get_job_record_lock(),
+                delete_job_record())
+        self._stop_automatic_renewal()
         response.raise_for_status()
+        if self._use_append_only_journal:
+            def remove_journal_record(index):
+                try:
+                    # Ignore exceptions and do not raise for status.
+                    # If necessary the curator will clean up the orphaned
+                    # journal item.
+                    yield _Call(self._client.delete, _journal_collection,
+                            Job._get_journal_collection_key(self._job_id,
+                            index), None, False)
+                except Exception:
+                    pass
+            yield _Concurrently([remove_journal_record(index) for index in
+                    range(len(self._journal))])
         self._journal = []
 
-    def _get_lock(self, collection, key):
+    def _get_expiration_in_ms(self):
+        """
+        Get the time at which this job times out.
+        :return: the time in milliseconds since the epoch
+        """
+        if self._use_leases:
+            return self._lease_expiration_in_ms
+        return self._timestamp_in_ms + self._job_time_in_ms
+
+    def _get_local_lock_timeout_in_ms(self, wait):
+        """
+        Get the maximum time to wait for an entry of the local lock table.
+        Jobs using wait-die do not wait locally since the table does not
+        know the age of the holder.
+        :param wait: whether to wait if the key is locked
+        :return: the time in milliseconds
+        """
+        if wait is False or self._wait_die_priority is not None:
+            return 0
+        return max(0, min(self._lock_wait_timeout_in_ms,
+                self._get_expiration_in_ms() -
+                _get_timestamp_in_ms(datetime.utcnow())))
+
+    def _add_local_lock_token(self, collection, key, token, wait):
+        """
+        Keep the token of the entry of the local lock table acquired for the
+        specified collection key, or raise CollectionKeyIsLocked if it is
+        held by another job or client of this host.
+        :param collection: the collection
+        :param key: the key
+        :param token: the token returned by LocalLockTable.acquire()
+        :param wait: whether to wait if the key is locked
+        :return: whether the entry was acquired
+        """
+        if token is not None:
+            self._local_lock_tokens[(collection, key)] = token
+            return True
+        # A waiting job using wait-die decides whether to wait in o.io.
+        if wait is False or self._wait_die_priority is None:
+            raise CollectionKeyIsLocked
+        return False
+
+    def _acquire_local_lock(self, collection, key, wait):
+        """
+        Acquire the entry of the specified collection key in the local lock
+        table of this job's client, if any, so that the other jobs and
+        clients of this host using the table wait for this job locally
+        instead of in o.io.
+        :param collection: the collection
+        :param key: the key
+        :param wait: whether to wait if the key is locked
+        :return: whether an entry was acquired
+        """
+        lock_table = getattr(self._client, '_lock_table', None)
+        if lock_table is None or (collection, key) in self._local_lock_tokens:
+            raise _Return(False)
+        token = yield _Call(self._client._acquire_lock_table_entry,
+                Job._get_lock_collection_key(collection, key),
+                self._get_expiration_in_ms() + _additional_timeout_wait_in_ms,
+                self._get_local_lock_timeout_in_ms(wait))
+        raise _Return(self._add_local_lock_token(collection, key, token,
+                wait))
+
+    def _release_local_lock(self, collection, key):
+        """
+        Release the entry of the specified collection key in the local lock
+        table of this job's client, if this job holds it.
+        :param collection: the collection
+        :param key: the key
         """
-        Create a lock for the specified collection and key and add
-        it to o.io.
+        token = self._local_lock_tokens.pop((collection, key), None)
+        if token is not None:
+            self._client._lock_table.release(Job._get_lock_collection_key(
+                    collection, key), token)
+
+    def _acquire_lock(self, collection, key, acquire, wait = True,
+            is_write_lock = True):
+        """
+        Run the step returned by the specified function acquiring a lock of
+        the specified collection key for this job, waiting for the key to be
+        unlocked for up to this job's lock wait timeout. Write locks are
+        first acquired in the local lock table of this job's client, if any.
+        :param collection: the collection
+        :param key: the key
+        :param acquire: the function returning the step acquiring the lock
+        :param wait: whether to wait if the key is locked
+        :param is_write_lock: whether the lock is a write lock
+        :return: the result of the step
+        """
+        has_local_lock = (is_write_lock and
+                (yield self._acquire_local_lock(collection, key, wait)))
+        try:
+            result = yield Job._wait_for_lock(self._client, collection, key,
+                    acquire, self._lock_wait_timeout_in_ms if wait else 0,
+                    self._raise_if_job_is_timed_out, self._wait_die_priority)
+        except Exception:
+            if has_local_lock:
+                self._release_local_lock(collection, key)
+            raise
+        raise _Return(result)
+
+    def _get_lock(self, collection, key, wait = True):
+        """
+        Create a write lock for the specified collection and key and add
+        it to o.io, or upgrade this job's read lock to a write lock.
         :param collection: the specified collection to lock
         :param key: the specified key to lock
+        :param wait: whether to wait if the key is locked
         :return: the created lock
         """
         for lock in self._locks:
             if lock.collection == collection and lock.key == key:
-                return lock
+                if lock.mode == 'read':
+                    self._raise_if_job_is_timed_out()
+                    yield self._acquire_lock(collection, key,
+                            lambda: Job._upgrade_read_lock(self._client,
+                            lock, self._job_id, self._timestamp,
+                            self._lease_expiration_in_ms), wait)
+                    if self._use_leases:
+                        yield self._take_fencing_token(lock, (yield _Call(
+                                self._client.get, _fencing_tokens_collection,
+                                Job._get_lock_collection_key(collection, key),
+                                None, False)))
+                raise _Return(lock)
         self._raise_if_job_is_timed_out()
-        lock = Job._create_and_add_lock(self._client, collection, key,
-                self._job_id, self._timestamp)
+        if self._use_leases is False:
+            lock = yield self._acquire_lock(collection, key,
+                    lambda: Job._create_and_add_lock(self._client,
+                    collection, key, self._job_id, self._timestamp,
+                    self._lease_expiration_in_ms), wait)
+            self._locks.append(lock)
+            raise _Return(lock)
+        # The last fencing token is retrieved concurrently with locking.
+        lock, token_response = yield self._acquire_lock(collection, key,
+                lambda: _Concurrently([Job._create_and_add_lock(
+                self._client, collection, key, self._job_id,
+                self._timestamp, self._lease_expiration_in_ms),
+                _Call(self._client.get, _fencing_tokens_collection,
+                Job._get_lock_collection_key(collection, key), None,
+                False)]), wait)
         self._locks.append(lock)
-        return lock
+        yield self._take_fencing_token(lock, token_response)
+        raise _Return(lock)
+
+    def _take_fencing_token(self, lock, token_response):
+        """
+        Assign the next fencing token to the specified write lock of this
+        job, forgetting the lock if it turns out to have been removed.
+        :param lock: the write lock
+        :param token_response: the response of the retrieval of the last
+        fencing token
+        """
+        if (yield Job._assign_fencing_token(self._client, lock,
+                token_response)) is False:
+            self._locks.remove(lock)
+            self._release_local_lock(lock.collection, lock.key)
+            raise CollectionKeyIsLocked
+
+    def _get_read_lock(self, collection, key):
+        """
+        Create a shared read lock for the specified collection and key and
+        add it to o.io, unless this job already holds a lock for them.
+        :param collection: the specified collection to lock
+        :param key: the specified key to lock
+        :return: the created lock
+        """
+        for lock in self._locks:
+            if lock.collection == collection and lock.key == key:
+                raise _Return(lock)
+        self._raise_if_job_is_timed_out()
+        lock = yield self._acquire_lock(collection, key,
+                lambda: Job._create_and_add_read_lock(self._client,
+                collection, key, self._job_id, self._timestamp, self._job_id,
+                self._lease_expiration_in_ms), is_write_lock = False)
+        self._locks.append(lock)
+        raise _Return(lock)
+
+    @staticmethod
+    def _get_original_value(response, must_exist):
+        """
+        Get the original value of an object retrieved before writing it.
+        :param response: the response of the retrieval
+        :param must_exist: whether the object must exist, which it must in
+        order to delete it
+        :return: the original value, or None if a new object will be added
+        """
+        # Indicates a new record will be created.
+        if response.status_code == 404 and must_exist is False:
+            return None
+        response.raise_for_status()
+        return response.json
+
+    @staticmethod
+    def _get_batch_entries(entries, length):
+        """
+        Get the entries of a batch operation padded with None refs, making
+        sure that no collection key is repeated since the operations of a
+        batch are executed concurrently.
+        :param entries: the entries passed to the batch operation
+        :param length: the length of an entry including the ref
+        :return: the padded entries
+        """
+        entries = [tuple(entry) + (None,) * (length - len(entry))
+                for entry in entries]
+        collection_keys = set()
+        for entry in entries:
+            if entry[:2] in collection_keys:
+                raise ValueError('Collection key ' + repr(entry[:2]) +
+                        ' is repeated in the batch')
+            collection_keys.add(entry[:2])
+        return entries
+
+    @staticmethod
+    def _get_ordered_collection_keys(collection_keys):
+        """
+        Get the unique collection keys of the specified collection keys in
+        the canonical order in which jobs lock them, which is the order of
+        their keys in the locks collection.
+        :param collection_keys: the (collection, key) tuples
+        :return: the ordered (collection, key) tuples
+        """
+        return sorted(OrderedDict.fromkeys(collection_keys),
+                key = lambda collection_key:
+                Job._get_lock_collection_key(*collection_key))
+
+    def _release_lock(self, lock):
+        """
+        Remove the specified write lock, which must not protect any journal
+        item yet, from o.io and from this job.
+        :param lock: the write lock
+        """
+        ref = lock.lock_ref
+        for attempt in range(_max_lock_update_attempts):
+            response = yield _Call(self._client.delete, _locks_collection,
+                    Job._get_lock_collection_key(lock.collection, lock.key),
+                    ref, False)
+            if response.status_code != 412:
+                break
+            # A renewal of this job's lease may have updated the lock in the
+            # meantime.
+            get_response = yield Job._get_held_lock(self._client, lock)
+            if get_response is None:
+                break
+            ref = get_response.ref
+        response.raise_for_status()
+        self._locks.remove(lock)
+        self._release_local_lock(lock.collection, lock.key)
+
+    def _get_locks(self, collection_keys):
+        """
+        Create write locks for the specified collection keys and add them to
+        o.io in their canonical order, so that jobs locking overlapping keys
+        cannot wait for each other in a cycle. All of the keys are first
+        locked concurrently without waiting. If any of them is locked then
+        the locks acquired after the first locked key in the canonical order
+        are released, and the remaining keys are locked one at a time.
+        :param collection_keys: the (collection, key) tuples to lock
+        """
+        ordered_collection_keys = Job._get_ordered_collection_keys(
+                collection_keys)
+        held_collection_keys = set((lock.collection, lock.key) for lock in
+                self._locks)
+        def try_get_lock(collection, key):
+            try:
+                yield self._get_lock(collection, key, False)
+            except CollectionKeyIsLocked:
+                raise _Return(False)
+            raise _Return(True)
+        # Every acquired lock is kept by _get_lock so it is removed on roll
+        # back even if acquiring another lock fails.
+        were_acquired = yield _Concurrently([try_get_lock(collection, key)
+                for collection, key in ordered_collection_keys])
+        first_locked_index = next((index for index, was_acquired in
+                enumerate(were_acquired) if was_acquired is False), None)
+        if first_locked_index is None:
+            return
+        if not self._lock_wait_timeout_in_ms:
+            raise CollectionKeyIsLocked
+        remaining_collection_keys = ordered_collection_keys[
+                first_locked_index:]
+        yield _Concurrently([self._release_lock(lock) for lock in
+                self._locks if (lock.collection, lock.key) in
+                remaining_collection_keys and (lock.collection, lock.key) not
+                in held_collection_keys])
+        for collection, key in remaining_collection_keys:
+            yield self._get_lock(collection, key)
+
+    def _get_job_record_value(self, lease_expiration_in_ms):
+        """
+        Get the object stored in the jobs collection for this job.
+        :param lease_expiration_in_ms: the lease expiration to store or None
+        :return: the job object
+        """
+        value = {'timestamp': self._timestamp,
+                'timestamp_in_ms': self._timestamp_in_ms}
+        if self._use_append_only_journal:
+            value['items'] = []
+            value['use_append_only_journal'] = True
+        else:
+            value['items'] = self._journal
+        if lease_expiration_in_ms is not None:
+            value['lease_expiration_in_ms'] = lease_expiration_in_ms
+        return _get_wire_value(value)
+
+    def _get_journal_record_value(self, journal_item):
+        """
+        Get the object stored in the journal collection for the specified
+        journal item of this job's append-only journal.
+        :param journal_item: the journal item
+        :return: the journal item object
+        """
+        value = {'job_id': self._job_id, 'job_timestamp': self._timestamp,
+                'job_timestamp_in_ms': self._timestamp_in_ms,
+                'item': journal_item}
+        if self._lease_expiration_in_ms is not None:
+            value['lease_expiration_in_ms'] = self._lease_expiration_in_ms
+        return _get_wire_value(value)
+
+    def _put_job_record(self, lease_expiration_in_ms):
+        """
+        Add or update this job's record in the jobs collection. Must be
+        called while holding the job record lock.
+        :param lease_expiration_in_ms: the lease expiration to store or None
+        """
+        job_response = yield _Call(self._client.put, _jobs_collection,
+                self._job_id, self._get_job_record_value(
+                lease_expiration_in_ms), None, False)
+        job_response.raise_for_status()
 
     def _add_journal_item(self, collection, key, new_value, original_value):
         """
@@ -222,47 +1472,254 @@ class Job:
         :param original_value: the original value
         :return: the created journal item
         """
+        journal_items = yield self._add_journal_items([(collection, key,
+                new_value, original_value)])
+        raise _Return(journal_items[0])
+
+    def _append_journal_items(self, entries):
+        """
+        Create journal items and append them to this job's journal before
+        they are stored.
+        :param entries: the (collection, key, new value, original value)
+        tuples to journal
+        :return: the created journal items and the index of the first one
+        """
+        self._raise_if_job_is_timed_out()
+        journal_items = [_JournalItem(datetime.utcnow(), collection, key,
+                original_value, new_value) for collection, key, new_value,
+                original_value in entries]
+        first_index = len(self._journal)
+        self._journal.extend(journal_items)
+        return journal_items, first_index
+
+    def _add_journal_items(self, entries):
+        """
+        Add journal items to this job using a single journal update.
+        :param entries: the (collection, key, new value, original value)
+        tuples to journal
+        :return: the created journal items
+        """
+        journal_items, first_index = self._append_journal_items(entries)
+        if self._use_append_only_journal is False:
+            yield _Locked(self._get_job_record_lock(), self._put_job_record(
+                    self._lease_expiration_in_ms))
+            raise _Return(journal_items)
+        # Only the first journal item creates the job object, afterwards
+        # each journal item is added as its own record.
+        if first_index == 0:
+            yield _Locked(self._get_job_record_lock(), self._put_job_record(
+                    self._lease_expiration_in_ms))
+            self._raise_if_job_is_timed_out()
+        def add_journal_record(index, journal_item):
+            journal_response = yield _Call(self._client.put,
+                    _journal_collection, Job._get_journal_collection_key(
+                    self._job_id, index), self._get_journal_record_value(
+                    journal_item), None, False)
+            journal_response.raise_for_status()
+        yield _Concurrently([add_journal_record(index, journal_item) for
+                index, journal_item in enumerate(journal_items, first_index)])
+        raise _Return(journal_items)
+
+    def _buffer_write(self, collection, key, new_value, ref):
+        """
+        Buffer a write of this optimistic job until the job is completed.
+        A later write of the same collection key replaces the earlier one.
+        :param collection: the collection
+        :param key: the key
+        :param new_value: the new value or _deleted_object_value
+        :param ref: the ref the object must have when the write is applied,
+        False if the object must not exist, or None to use the ref read by
+        this job or retrieved at completion
+        :return: the response standing in for the write's response
+        """
+        previous_write = self._buffered_writes.get((collection, key))
+        # The condition of the first write refers to the object as it was
+        # before this job so it also applies to later writes.
+        if previous_write is not None and previous_write[1] is not None:
+            ref = previous_write[1]
+        self._buffered_writes[(collection, key)] = (new_value, ref)
+        response = _BufferedWriteResponse(collection, key)
+        self._buffered_write_responses.setdefault((collection, key),
+                []).append(response)
+        return response
+
+    def _set_buffered_write_refs(self, collection, key, response):
+        """
+        Set the ref of the responses returned for the buffered writes of the
+        specified collection key once the put writing them was applied.
+        :param collection: the collection
+        :param key: the key
+        :param response: the response of the put
+        """
+        for buffered_write_response in self._buffered_write_responses.get(
+                (collection, key), []):
+            buffered_write_response.ref = response.ref
+
+    def _get_buffered_writes(self):
+        """
+        Get the writes buffered by this optimistic job and the objects that
+        must be retrieved before applying them, which are the objects
+        written but not read and the objects read but not written.
+        :return: the (collection, key, new value, ref) tuples of the writes
+        and the (collection, key, must exist) tuples of the objects to
+        retrieve
+        """
+        writes = [(collection, key, new_value, ref) for (collection, key),
+                (new_value, ref) in self._buffered_writes.items()
+                # An object added and then deleted by this job never existed.
+                if not (ref is False and new_value == _deleted_object_value)]
+        collection_keys_to_get = [(collection, key, new_value ==
+                _deleted_object_value) for collection, key, new_value, ref
+                in writes if ref is not False and (collection, key) not in
+                self._read_objects]
+        collection_keys_to_get.extend((collection, key, True) for
+                collection, key in self._read_objects if (collection, key)
+                not in self._buffered_writes)
+        return writes, collection_keys_to_get
+
+    def _get_buffered_write_entries(self, writes, current_objects):
+        """
+        Validate that the objects read but not written by this optimistic
+        job were not modified and get the journal entries of the writes.
+        :param writes: the (collection, key, new value, ref) tuples of the
+        writes
+        :param current_objects: the current (ref, value) tuples of the
+        retrieved objects keyed by (collection, key) tuples
+        :return: the (collection, key, new value, original value, ref)
+        tuples of the writes
+        """
+        for collection_key, (ref, value) in self._read_objects.items():
+            if (collection_key in current_objects and
+                    current_objects[collection_key][0] != ref):
+                raise CollectionKeyWasModified
+        entries = []
+        for collection, key, new_value, ref in writes:
+            current_ref, original_value = self._read_objects.get(
+                    (collection, key), current_objects.get((collection, key),
+                    (False, None)))
+            entries.append((collection, key, new_value, original_value,
+                    current_ref if ref is None else ref))
+        return entries
+
+    def _apply_buffered_writes(self):
+        """
+        Apply the writes buffered by this optimistic job. The objects the
+        job did not both read and write and the locks of the objects it
+        writes are retrieved concurrently, a single journal update covering
+        all of the writes is added, and then the writes are applied
+        concurrently and conditionally on the refs of the objects.
+        CollectionKeyIsLocked is raised if any of the written objects is
+        locked by a pessimistic job or an OiotClient, and
+        CollectionKeyWasModified is raised if any of the objects was
+        modified by someone else in the meantime.
+        """
+        writes, collection_keys_to_get = self._get_buffered_writes()
+        def get_object(collection, key, must_exist):
+            self._raise_if_job_is_timed_out()
+            response = yield _Call(self._client.get, collection, key, None,
+                    False)
+            if response.status_code == 404 and must_exist is False:
+                raise _Return((False, None))
+            # The record must be present in order to delete it.
+            response.raise_for_status()
+            raise _Return((response.ref, response.json))
+        def get_lock(collection, key):
+            self._raise_if_job_is_timed_out()
+            response = yield _Call(self._client.get, _locks_collection,
+                    Job._get_lock_collection_key(collection, key), None, False)
+            raise _Return(response)
+        results = yield _Concurrently([get_object(*collection_key) for
+                collection_key in collection_keys_to_get] + [get_lock(
+                collection, key) for collection, key, new_value, ref in
+                writes])
+        # Writes, like those of the lock check fast path, are not applied
+        # to objects that are locked for reading or writing.
+        for lock_response in results[len(collection_keys_to_get):]:
+            _raise_if_locked(lock_response, False)
+        current_objects = dict(((collection, key), current_object) for
+                (collection, key, must_exist), current_object in
+                zip(collection_keys_to_get, results))
+        entries = self._get_buffered_write_entries(writes, current_objects)
+        if not entries:
+            return
+        yield self._add_journal_items([(collection, key, new_value,
+                original_value) for collection, key, new_value,
+                original_value, ref in entries])
+        def apply_write(collection, key, new_value, original_value, ref):
+            self._raise_if_job_is_timed_out()
+            if new_value == _deleted_object_value:
+                response = yield _Call(self._client.delete, collection, key,
+                        ref, False)
+            else:
+                response = yield _Call(self._client.put, collection, key,
+                        new_value, ref, False)
+            if response.status_code == 412:
+                raise CollectionKeyWasModified
+            response.raise_for_status()
+            if new_value != _deleted_object_value:
+                self._set_buffered_write_refs(collection, key, response)
+        yield _Concurrently([apply_write(*entry) for entry in entries])
         self._raise_if_job_is_timed_out()
-        journal_item = _JournalItem(datetime.utcnow(), collection, key,
-                original_value, new_value)
-        self._journal.append(journal_item)
-        job_response = self._client.put(_jobs_collection, self._job_id,
-                json.loads(json.dumps({'timestamp': self._timestamp,
-                'items': self._journal}, cls=_Encoder)), None, False)
-        job_response.raise_for_status()
-        return journal_item
 
     def get(self, collection, key, ref = None):
         """
-        Execute a get operation via this job by locking the collection key
-        prior to executing the operation.
+        Execute a get operation via this job by read locking the collection
+        key prior to executing the operation. Read locks are shared with
+        other readers and are upgraded to write locks if this job later
+        writes to the collection key.
         :param collection: the collection
         :param key: the key
         :param ref: the ref
         :return: the operation's response
         """
+        return self._run_steps(self._get(collection, key, ref))
+
+    def _get(self, collection, key, ref):
+        """
+        The operation implementing get().
+        """
         self._verify_job_is_active()
         try:
-            lock = self._get_lock(collection, key)
+            self._raise_if_budget_is_insufficient(1 if
+                    self._use_optimistic_concurrency else 2)
+            if self._use_optimistic_concurrency is False:
+                lock = yield self._get_read_lock(collection, key)
             self._raise_if_job_is_timed_out()
-            response = self._client.get(collection, key, ref, False)
+            response = yield _Call(self._client.get, collection, key, ref,
+                    False)
             response.raise_for_status()
+            if (self._use_optimistic_concurrency and (collection, key) not in
+                    self._read_objects):
+                self._read_objects[(collection, key)] = (response.ref,
+                        response.json)
             self._raise_if_job_is_timed_out()
-            return response
+            raise _Return(response)
         except Exception as e:
-            self.roll_back((e, traceback.format_exc()))
+            yield self._roll_back((e, traceback.format_exc()))
 
     def post(self, collection, value):
         """
         Execute a post operation via this job by locking the collection key
         prior to executing the operation.
         :param collection: the collection
-        :param key: the key
-        :param ref: the ref
-        :return: the operation's response
+        :param value: the value
+        :return: the operation's response, which is a response with a
+        status_code of 202 and the generated key for optimistic jobs, whose
+        ref is set once the job is completed
+        """
+        return self._run_steps(self._post(collection, value))
+
+    def _post(self, collection, value):
+        """
+        The operation implementing post().
         """
         key = Job._generate_key()
-        return self.put(collection, key, value)
+        if self._use_optimistic_concurrency:
+            self._verify_job_is_active()
+            # The generated key is new so the object must not exist.
+            raise _Return(self._buffer_write(collection, key, value, False))
+        response = yield self._put(collection, key, value, None)
+        raise _Return(response)
 
     def put(self, collection, key, value, ref = None):
         """
@@ -270,33 +1727,39 @@ class Job:
         prior to executing the operation.
         :param collection: the collection
         :param key: the key
-        :return: the operation's response
+        :param value: the value
+        :param ref: the ref
+        :return: the operation's response, which is a response with a
+        status_code of 202 for optimistic jobs, whose ref is set once the job
+        is completed
+        """
+        return self._run_steps(self._put(collection, key, value, ref))
+
+    def _put(self, collection, key, value, ref):
+        """
+        The operation implementing put().
         """
         self._verify_job_is_active()
+        if self._use_optimistic_concurrency:
+            raise _Return(self._buffer_write(collection, key, value, ref))
         try:
-            lock = self._get_lock(collection, key)
+            self._raise_if_budget_is_insufficient(4)
+            lock = yield self._get_lock(collection, key)
             self._raise_if_job_is_timed_out()
             # If ref was passed, ensure that the value has not changed.
             # If ref was not passed, retrieve the current ref and store it.
-            response = self._client.get(collection, key, ref, False)
-            # Indicates a new record will be created.
-            if response.status_code == 404:
-                original_value = None
-            # Indicates an existing record will be updated so store the
-            # original ref and value.
-            elif response.status_code == 200:
-                original_value = response.json
-            else:
-                response.raise_for_status()
-            journal_item = self._add_journal_item(collection, key,
+            original_value = Job._get_original_value((yield _Call(
+                    self._client.get, collection, key, ref, False)), False)
+            journal_item = yield self._add_journal_item(collection, key,
                     value, original_value)
             self._raise_if_job_is_timed_out()
-            response = self._client.put(collection, key, value, ref, False)
+            response = yield _Call(self._client.put, collection, key, value,
+                    ref, False)
             response.raise_for_status()
             self._raise_if_job_is_timed_out()
-            return response
+            raise _Return(response)
         except Exception as e:
-            self.roll_back((e, traceback.format_exc()))
+            yield self._roll_back((e, traceback.format_exc()))
 
     def delete(self, collection, key, ref = None):
         """
@@ -304,25 +1767,223 @@ class Job:
         prior to executing the operation.
         :param collection: the collection
         :param key: the key
-        :return: the operation's response
+        :param ref: the ref
+        :return: the operation's response, which is a response with a
+        status_code of 202 for optimistic jobs
+        """
+        return self._run_steps(self._delete(collection, key, ref))
+
+    def _delete(self, collection, key, ref):
+        """
+        The operation implementing delete().
         """
         self._verify_job_is_active()
+        if self._use_optimistic_concurrency:
+            raise _Return(self._buffer_write(collection, key,
+                    _deleted_object_value, ref))
         try:
-            lock = self._get_lock(collection, key)
+            self._raise_if_budget_is_insufficient(4)
+            lock = yield self._get_lock(collection, key)
             self._raise_if_job_is_timed_out()
             # The record must be present in order to delete it.
-            response = self._client.get(collection, key, ref, False)
-            response.raise_for_status()
-            original_value = response.json
-            journal_item = self._add_journal_item(collection, key,
+            original_value = Job._get_original_value((yield _Call(
+                    self._client.get, collection, key, ref, False)), True)
+            journal_item = yield self._add_journal_item(collection, key,
                     _deleted_object_value, original_value)
             self._raise_if_job_is_timed_out()
-            response = self._client.delete(collection, key, ref, False)
+            response = yield _Call(self._client.delete, collection, key, ref,
+                    False)
             response.raise_for_status()
             self._raise_if_job_is_timed_out()
-            return response
+            raise _Return(response)
+        except Exception as e:
+            yield self._roll_back((e, traceback.format_exc()))
+
+    def put_many(self, entries):
+        """
+        Execute put operations for multiple collection keys via this job.
+        All of the collection keys are locked and their original values are
+        retrieved concurrently, a single journal update covering all of the
+        operations is added, and then the values are put concurrently.
+        :param entries: the (collection, key, value) or (collection, key,
+        value, ref) tuples to put, which raise ValueError if a collection key
+        is repeated
+        :return: the operations' responses in order, which are responses
+        with a status_code of 202 for optimistic jobs as returned by put()
+        """
+        return self._run_steps(self._put_many(entries))
+
+    def _put_many(self, entries):
+        """
+        The operation implementing put_many().
+        """
+        self._verify_job_is_active()
+        entries = Job._get_batch_entries(entries, 4)
+        if self._use_optimistic_concurrency:
+            responses = []
+            for entry in entries:
+                responses.append((yield self._put(*entry)))
+            raise _Return(responses)
+        try:
+            self._raise_if_budget_is_insufficient(4)
+            yield self._get_locks([(collection, key) for collection, key,
+                    value, ref in entries])
+            def get_original_value(collection, key, value, ref):
+                self._raise_if_job_is_timed_out()
+                # If ref was passed, ensure that the value has not changed.
+                raise _Return(Job._get_original_value((yield _Call(
+                        self._client.get, collection, key, ref, False)),
+                        False))
+            original_values = yield _Concurrently([get_original_value(
+                    *entry) for entry in entries])
+            yield self._add_journal_items([(collection, key, value,
+                    original_value) for (collection, key, value, ref),
+                    original_value in zip(entries, original_values)])
+            def put_value(collection, key, value, ref):
+                self._raise_if_job_is_timed_out()
+                response = yield _Call(self._client.put, collection, key,
+                        value, ref, False)
+                response.raise_for_status()
+                raise _Return(response)
+            responses = yield _Concurrently([put_value(*entry) for entry in
+                    entries])
+            self._raise_if_job_is_timed_out()
+            raise _Return(responses)
+        except Exception as e:
+            yield self._roll_back((e, traceback.format_exc()))
+
+    def delete_many(self, entries):
+        """
+        Execute delete operations for multiple collection keys via this job.
+        All of the collection keys are locked and their original values are
+        retrieved concurrently, a single journal update covering all of the
+        operations is added, and then the objects are deleted concurrently.
+        :param entries: the (collection, key) or (collection, key, ref)
+        tuples to delete, which raise ValueError if a collection key is
+        repeated
+        :return: the operations' responses in order, which are responses
+        with a status_code of 202 for optimistic jobs as returned by delete()
+        """
+        return self._run_steps(self._delete_many(entries))
+
+    def _delete_many(self, entries):
+        """
+        The operation implementing delete_many().
+        """
+        self._verify_job_is_active()
+        entries = Job._get_batch_entries(entries, 3)
+        if self._use_optimistic_concurrency:
+            responses = []
+            for entry in entries:
+                responses.append((yield self._delete(*entry)))
+            raise _Return(responses)
+        try:
+            self._raise_if_budget_is_insufficient(4)
+            yield self._get_locks([(collection, key) for collection, key, ref
+                    in entries])
+            def get_original_value(collection, key, ref):
+                self._raise_if_job_is_timed_out()
+                # The record must be present in order to delete it.
+                raise _Return(Job._get_original_value((yield _Call(
+                        self._client.get, collection, key, ref, False)),
+                        True))
+            original_values = yield _Concurrently([get_original_value(
+                    *entry) for entry in entries])
+            yield self._add_journal_items([(collection, key,
+                    _deleted_object_value, original_value) for
+                    (collection, key, ref), original_value in
+                    zip(entries, original_values)])
+            def delete_value(collection, key, ref):
+                self._raise_if_job_is_timed_out()
+                response = yield _Call(self._client.delete, collection, key,
+                        ref, False)
+                response.raise_for_status()
+                raise _Return(response)
+            responses = yield _Concurrently([delete_value(*entry) for entry
+                    in entries])
+            self._raise_if_job_is_timed_out()
+            raise _Return(responses)
+        except Exception as e:
+            yield self._roll_back((e, traceback.format_exc()))
+
+    def lock_all(self, collection_keys):
+        """
+        Lock the specified collection keys for writing ahead of the
+        operations of this job. The keys are locked in the order of their
+        keys in the locks collection regardless of the order in which they
+        are specified, concurrently unless some of them are locked, so jobs
+        declaring the keys they access up front do not deadlock. Optimistic
+        jobs do not lock.
+        :param collection_keys: the (collection, key) tuples to lock
+        """
+        return self._run_steps(self._lock_all(collection_keys))
+
+    def _lock_all(self, collection_keys):
+        """
+        The operation implementing lock_all().
+        """
+        self._verify_job_is_active()
+        if self._use_optimistic_concurrency:
+            return
+        try:
+            self._raise_if_budget_is_insufficient(1)
+            yield self._get_locks(collection_keys)
         except Exception as e:
-            self.roll_back((e, traceback.format_exc()))
+            yield self._roll_back((e, traceback.format_exc()))
+
+    def renew(self):
+        """
+        Renew the lease of this job, which then expires lease_time_in_ms
+        from now. A job using leases must be renewed before its lease
+        expires or it times out and its locks are reclaimed by curators.
+        The renewed expiration is also stored in the job's locks and in its
+        entries in the local lock table of its client, if any.
+        :return: whether the lease was renewed, which it is not once the job
+        is being completed or rolled back
+        """
+        return self._run_steps(self._renew())
+
+    def _renew(self):
+        """
+        The operation implementing renew().
+        """
+        if self._use_leases is False:
+            raise ValueError('Only jobs using leases can be renewed')
+        self._verify_job_is_active()
+        def renew_job_record():
+            if self._is_job_record_removed:
+                raise _Return(False)
+            lease_expiration_in_ms = (_get_timestamp_in_ms(
+                    datetime.utcnow()) + self._lease_time_in_ms)
+            # Curators find the renewed lease in the job record, which is
+            # added if the job has not journaled anything yet.
+            yield self._put_job_record(lease_expiration_in_ms)
+            self._lease_expiration_in_ms = lease_expiration_in_ms
+            # Locks are renewed while holding the job record lock so that
+            # they are not added back once the job is removed.
+            yield self._renew_locks(lease_expiration_in_ms)
+            raise _Return(True)
+        is_renewed = yield _Locked(self._get_job_record_lock(),
+                renew_job_record())
+        raise _Return(is_renewed)
+
+    def get_fencing_token(self, collection, key):
+        """
+        Get the fencing token of this job's write lock of the specified
+        collection key. The fencing tokens of a collection key increase
+        every time a job using leases locks it for writing, so a resource
+        written on behalf of this job can reject writes carrying a lower
+        token than one it has already seen, such as the late writes of a job
+        whose lease expired.
+        :param collection: the collection
+        :param key: the key
+        :return: the fencing token, or None if this job does not hold a
+        write lock with a fencing token for the collection key
+        """
+        for lock in self._locks:
+            if lock.collection == collection and lock.key == key:
+                return lock.fencing_token
+        return None
 
     def roll_back(self, exception_causing_rollback = None):
         """
@@ -331,13 +1992,19 @@ class Job:
         :param exception_causing_rollback: the exception that caused
         the roll back
         """
+        return self._run_steps(self._roll_back(exception_causing_rollback))
+
+    def _roll_back(self, exception_causing_rollback):
+        """
+        The operation implementing roll_back().
+        """
         self._verify_job_is_active()
+        self._record_rollback(exception_causing_rollback)
         try:
-            for journal_item in self._journal:
-                Job._roll_back_journal_item(self._client, journal_item,
-                        self._raise_if_job_is_timed_out)
-            self._remove_job()
-            self._remove_locks()
+            yield Job._roll_back_journal_items(self._client, self._journal,
+                    self._raise_if_job_is_timed_out)
+            yield self._remove_job()
+            yield self._remove_locks()
             self.is_rolled_back = True
             if exception_causing_rollback:
                 raise RollbackCausedByException(exception_causing_rollback[0],
@@ -356,24 +2023,40 @@ class Job:
     def complete(self):
         """
         Completes this job by removing the locks associated with the job
-        and the job itself.
+        and the job itself. An optimistic job first applies its buffered
+        writes and is rolled back if any of the objects it accessed was
+        modified in the meantime.
+        """
+        return self._run_steps(self._complete())
+
+    def _complete(self):
+        """
+        The operation implementing complete().
         """
         self._verify_job_is_active()
+        if self._use_optimistic_concurrency:
+            try:
+                yield self._apply_buffered_writes()
+            except Exception as e:
+                yield self._roll_back((e, traceback.format_exc()))
         try:
-            self._remove_job()
-            self._remove_locks()
+            yield self._remove_job()
+            yield self._remove_locks()
             self.is_completed = True
         except Exception as e:
             self.is_failed = True
-            raise FailedToComplete(e, traceback.format_exc())
+            raise FailedToComplete(e, traceback.format_exc(),
+                    getattr(e, 'locks_failing_removal', None))
 
 
 class _Lock(object):
     """
-    Represents a read-write lock and its information.
+    Represents a write lock or a shared read lock and its information.
     """
     def __init__(self, job_id = None, job_timestamp = None, timestamp = None,
-                collection = None, key = None, lock_ref = None):
+                collection = None, key = None, lock_ref = None,
+                mode = 'write', reader_id = None, readers = None,
+                lease_expiration_in_ms = None, fencing_token = None):
         """
         Create a Lock instance.
         :param job_id: the job ID
@@ -382,13 +2065,59 @@ class _Lock(object):
         :param collection: the collection
         :param key: the key
         :param lock_ref: the o.io ref value for the lock object
+        :param mode: 'write' for an exclusive lock or 'read' for a shared
+        read lock
+        :param reader_id: the ID identifying the reader in a read lock
+        :param readers: the readers of a read lock as of its last update
+        :param lease_expiration_in_ms: the lease expiration of the job as of
+        locking, or None if the job does not use leases
+        :param fencing_token: the fencing token of a write lock of a job
+        using leases
         """
         self.job_id = job_id
         self.job_timestamp = job_timestamp
+        # The job timestamp in milliseconds since the epoch.
+        self.job_timestamp_in_ms = (None if job_timestamp is None else
+                _get_timestamp_in_ms(job_timestamp))
         self.timestamp = timestamp
         self.collection = collection
         self.key = key
         self.lock_ref = lock_ref
+        self.mode = mode
+        self.reader_id = reader_id
+        self.readers = readers
+        self.lease_expiration_in_ms = lease_expiration_in_ms
+        self.fencing_token = fencing_token
+
+    def _set_upgraded(self, lock_ref):
+        """
+        Make this shared read lock a write lock once its object in the locks
+        collection was replaced by a write lock object.
+        :param lock_ref: the o.io ref value for the write lock object
+        """
+        self.mode = 'write'
+        self.lock_ref = lock_ref
+        self.reader_id = None
+        self.readers = None
+
+    def _get_wire_dict(self):
+        """
+        Get the object stored in the locks collection for this lock.
+        :return: the lock object
+        """
+        value = {'job_id': self.job_id,
+                'job_timestamp': _get_wire_value(self.job_timestamp),
+                'job_timestamp_in_ms': self.job_timestamp_in_ms,
+                'timestamp': _get_wire_value(self.timestamp),
+                'collection': self.collection, 'key': self.key,
+                'lock_ref': self.lock_ref, 'mode': self.mode,
+                'reader_id': self.reader_id,
+                'readers': _get_wire_value(self.readers)}
+        if self.lease_expiration_in_ms is not None:
+            value['lease_expiration_in_ms'] = self.lease_expiration_in_ms
+        if self.fencing_token is not None:
+            value['fencing_token'] = self.fencing_token
+        return value
 
 
 class _JournalItem(object):
@@ -411,16 +2140,47 @@ class _JournalItem(object):
         self.original_value = original_value
         self.new_value = new_value
 
+    def _get_wire_dict(self):
+        """
+        Get the object stored in the journal for this journal item.
+        :return: the journal item object
+        """
+        return {'timestamp': _get_wire_value(self.timestamp),
+                'collection': self.collection, 'key': self.key,
+                'original_value': _get_wire_value(self.original_value),
+                'new_value': _get_wire_value(self.new_value)}
+
+
+class _BufferedWriteResponse(object):
+    """
+    Stands in for the response of a write buffered by an optimistic job, so
+    that the operations of optimistic and pessimistic jobs return the same
+    kind of value.
+    """
+    # The write was accepted but is only applied when the job is completed.
+    status_code = 202
+
+    def __init__(self, collection, key):
+        """
+        Create a _BufferedWriteResponse instance.
+        :param collection: the collection
+        :param key: the key
+        """
+        self.collection = collection
+        self.key = key
+        # The ref of the object once the job applied the write as a put.
+        self.ref = None
+        self.json = {}
+
+    def raise_for_status(self):
+        """
+        Do nothing, since buffering a write does not fail.
+        """
+
 
 class _Encoder(json.JSONEncoder):
     """
     Determines how to properly encode objects into JSON.
     """
     def default(self, obj):
-        if isinstance(obj, datetime):
-            return obj.isoformat()
-        elif isinstance(obj, _JournalItem):
-            return vars(obj)
-        elif isinstance(obj, uuid.UUID):
-            return str(obj)
-        return json.JSONEncoder.default(self, obj)
+        return _get_wire_value(obj)
@@ -0,0 +1,251 @@
+"""
+    oiot.locktable
+    ~~~~~~~~~
+    This module implements the LocalLockTable class, a table of the
+    collection keys locked by the threads and processes of a single host
+    that they check before locking a collection key in o.io.
+    :copyright: (c) 2014 by Konstantin Bokarius.
+    :license: MIT, see LICENSE for more details.
+"""
+from datetime import datetime
+from .settings import _local_lock_table_size
+from .job import _get_timestamp_in_ms, _get_lock_wait_delay_in_ms
+import hashlib, mmap, os, random, struct, threading, time
+
+try:
+    import fcntl
+except ImportError:
+    # Tables shared between processes are not supported on Windows.
+    fcntl = None
+
+# Each slot holds the hash of the locked collection key, the token of the
+# holder, and the time at which the entry expires in milliseconds since the
+# epoch. Slots whose key hash is 0 are free.
+_slot_struct = struct.Struct('<QQQ')
+
+# number of consecutive slots searched for a collection key
+_probe_count = 8
+
+# Held while a table shared between processes is being updated, since the
+# file locks guarding it do not exclude other threads of the same process.
+_file_table_lock = threading.Lock()
+
+class LocalLockTable(object):
+    """
+    A table of the collection keys locked for writing by the jobs and
+    clients of this host. Jobs and clients using the same table queue up
+    locally for a collection key locked by one of them instead of each
+    sending a lock request to o.io that would fail, so only the local
+    holder of a collection key contends for it in o.io. A table created
+    without a path is shared by the threads of a process, and a table
+    created with a path is shared by all of the processes opening the same
+    path. o.io remains the authority on locks, so the table only saves
+    requests and never grants a lock by itself.
+    """
+    def __init__(self, path = None, slot_count = None):
+        """
+        Create a LocalLockTable instance.
+        :param path: the path of the file backing a table shared between
+        processes, or None for a table shared by the threads of this process
+        :param slot_count: the number of collection keys the table can
+        hold, which must be the same for every process sharing the file,
+        defaults to _local_lock_table_size
+        """
+        if slot_count is None:
+            slot_count = _local_lock_table_size
+        self._slot_count = slot_count
+        self._condition = threading.Condition()
+        self._file = None
+        size = slot_count * _slot_struct.size
+        if path is None:
+            self._table = bytearray(size)
+            return
+        if fcntl is None:
+            raise ValueError('Sharing a LocalLockTable between processes '
+                    'requires fcntl')
+        self._file = open(path, 'a+b')
+        with self._locked_file():
+            if os.fstat(self._file.fileno()).st_size < size:
+                self._file.truncate(size)
+        self._table = mmap.mmap(self._file.fileno(), size)
+
+    def _locked_file(self):
+        """
+        Get a context manager holding the exclusive lock of the file backing
+        this table, if any, for the duration of an update.
+        :return: the context manager
+        """
+        return _LockedFile(self._file)
+
+    @staticmethod
+    def _get_key_hash(lock_collection_key):
+        """
+        Get the hash identifying the specified collection key in the table,
+        which is the same in every process.
+        :param lock_collection_key: the key of the lock in the locks
+        collection
+        :return: the non-zero hash
+        """
+        digest = hashlib.sha1(lock_collection_key.encode('utf-8')).digest()
+        return struct.unpack('<Q', digest[:8])[0] or 1
+
+    def _try_acquire(self, key_hash, expiration_in_ms):
+        """
+        Add an entry for the specified collection key unless an unexpired
+        entry for it exists. Must be called while holding the condition.
+        :param key_hash: the hash of the collection key
+        :param expiration_in_ms: the time at which the entry expires
+        :return: the token of the added entry, 0 if the table has no room
+        for the collection key, or None if the collection key is held
+        """
+        now_in_ms = _get_timestamp_in_ms(datetime.utcnow())
+        with self._locked_file():
+            free_offset = None
+            for probe in range(_probe_count):
+                offset = ((key_hash + probe) % self._slot_count *
+                        _slot_struct.size)
+                slot_key_hash, token, slot_expiration_in_ms = \
+                        _slot_struct.unpack_from(self._table, offset)
+                if slot_expiration_in_ms <= now_in_ms:
+                    if free_offset is None:
+                        free_offset = offset
+                elif slot_key_hash == key_hash:
+                    return None
+            if free_offset is None:
+                return 0
+            token = random.getrandbits(63) + 1
+            _slot_struct.pack_into(self._table, free_offset, key_hash, token,
+                    expiration_in_ms)
+            return token
+
+    def acquire(self, lock_collection_key, expiration_in_ms,
+            timeout_in_ms = 0):
+        """
+        Acquire the entry of the specified collection key, waiting for up to
+        the specified timeout for its holder to release it. Threads of this
+        process waiting for a collection key are woken up when it is
+        released, while entries held by other processes are polled with a
+        backoff. Entries whose holders neither release them nor renew them
+        are acquirable once they expire.
+        :param lock_collection_key: the key of the lock in the locks
+        collection
+        :param expiration_in_ms: the time at which the entry expires in
+        milliseconds since the epoch, which should be no earlier than the
+        time at which the holder's lock in o.io can be curated
+        :param timeout_in_ms: the maximum time to wait
+        :return: the token to release the entry with, 0 if the table has no
+        room for the collection key and the caller should go to o.io without
+        an entry, or None if the collection key is still held
+        """
+        key_hash = LocalLockTable._get_key_hash(lock_collection_key)
+        deadline = time.time() + timeout_in_ms / 1000.0
+        retry = 0
+        with self._condition:
+            while True:
+                token = self._try_acquire(key_hash, expiration_in_ms)
+                remaining = deadline - time.time()
+                if token is not None or remaining <= 0:
+                    return token
+                self._condition.wait(min(remaining,
+                        _get_lock_wait_delay_in_ms(retry) / 1000.0))
+                retry += 1
+
+    def release(self, lock_collection_key, token):
+        """
+        Release the entry of the specified collection key acquired with the
+        specified token and wake up the threads of this process waiting for
+        it. Entries that have since expired and been acquired by another
+        holder are left alone.
+        :param lock_collection_key: the key of the lock in the locks
+        collection
+        :param token: the token returned by acquire()
+        """
+        if not token:
+            return
+        key_hash = LocalLockTable._get_key_hash(lock_collection_key)
+        with self._condition:
+            with self._locked_file():
+                for probe in range(_probe_count):
+                    offset = ((key_hash + probe) % self._slot_count *
+                            _slot_struct.size)
+                    slot_key_hash, slot_token, slot_expiration_in_ms = \
+                            _slot_struct.unpack_from(self._table, offset)
+                    if slot_key_hash == key_hash and slot_token == token:
+                        _slot_struct.pack_into(self._table, offset, 0, 0, 0)
+                        break
+            self._condition.notify_all()
+
+    def renew(self, lock_collection_key, token, expiration_in_ms):
+        """
+        Change the expiration of the entry of the specified collection key
+        acquired with the specified token, such as when the lease of the job
+        holding it is renewed. Entries that have since expired and been
+        acquired by another holder are left alone.
+        :param lock_collection_key: the key of the lock in the locks
+        collection
+        :param token: the token returned by acquire()
+        :param expiration_in_ms: the time at which the entry expires in
+        milliseconds since the epoch
+        :return: whether the entry was renewed
+        """
+        if not token:
+            return False
+        key_hash = LocalLockTable._get_key_hash(lock_collection_key)
+        with self._condition:
+            with self._locked_file():
+                for probe in range(_probe_count):
+                    offset = ((key_hash + probe) % self._slot_count *
+                            _slot_struct.size)
+                    slot_key_hash, slot_token, slot_expiration_in_ms = \
+                            _slot_struct.unpack_from(self._table, offset)
+                    if slot_key_hash == key_hash and slot_token == token:
+                        _slot_struct.pack_into(self._table, offset, key_hash,
+                                token, expiration_in_ms)
+                        return True
+        return False
+
+    def get_holder_count(self):
+        """
+        Get the number of collection keys currently held in this table.
+        :return: the number of unexpired entries
+        """
+        now_in_ms = _get_timestamp_in_ms(datetime.utcnow())
+        with self._condition:
+            with self._locked_file():
+                return len([offset for offset in range(0, len(self._table),
+                        _slot_struct.size) if _slot_struct.unpack_from(
+                        self._table, offset)[2] > now_in_ms])
+
+    def close(self):
+        """
+        Close the file backing this table, if any. Entries still held by
+        this process remain until they expire.
+        """
+        if self._file is not None:
+            self._table.close()
+            self._file.close()
+            self._file = None
+
+
+class _LockedFile(object):
+    """
+    A context manager holding the exclusive lock of the file backing a
+    LocalLockTable shared between processes, and doing nothing for tables
+    that are not backed by a file.
+    """
+    def __init__(self, file):
+        """
+        Create a _LockedFile instance.
+        :param file: the file or None
+        """
+        self._file = file
+
+    def __enter__(self):
+        if self._file is not None:
+            _file_table_lock.acquire()
+            fcntl.lockf(self._file, fcntl.LOCK_EX)
+
+    def __exit__(self, exception_type, exception, traceback):
+        if self._file is not None:
+            fcntl.lockf(self._file, fcntl.LOCK_UN)
+            _file_table_lock.release()
@@ -0,0 +1,488 @@
+"""
+    oiot.metrics
+    ~~~~~~~~~
+    This module implements the MetricsRegistry class, a thread-safe registry
+    of counters, gauges, and latency histograms that can be rendered in the
+    Prometheus text format and served over HTTP, the LatencyEstimator class
+    tracking the round trip time of a client's requests, and the
+    Instrumentation classes receiving the backend calls and events of clients
+    and jobs.
+    :copyright: (c) 2014 by Konstantin Bokarius.
+    :license: MIT, see LICENSE for more details.
+"""
+from collections import OrderedDict
+from .settings import _locks_collection, _jobs_collection, \
+        _journal_collection, _curators_collection, _max_job_time_in_ms, \
+        _latency_average_weight, _latency_window_size, _latency_percentile, \
+        _min_latency_sample_count, _job_time_in_round_trips, \
+        _min_adaptive_job_time_in_ms, _max_adaptive_job_time_in_ms, \
+        _timeout_wait_in_round_trips
+from collections import deque
+import math, threading, time
+
+try:
+    # python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    # python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# upper bounds in seconds of the buckets of latency histograms
+_default_latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+        2.5, 5.0, 10.0)
+
+# content type of the Prometheus text format
+_prometheus_content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+def _get_label_key(labels):
+    """
+    Get the hashable key identifying the specified labels.
+    :param labels: the labels dictionary or None
+    :return: the key
+    """
+    if not labels:
+        return ()
+    return tuple(sorted((str(name), str(value))
+            for name, value in labels.items()))
+
+def _format_labels(label_key, extra_label = None):
+    """
+    Format the specified labels for the Prometheus text format.
+    :param label_key: the key identifying the labels
+    :param extra_label: an additional (name, value) label or None
+    :return: the formatted labels
+    """
+    labels = list(label_key)
+    if extra_label is not None:
+        labels.append(extra_label)
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, value.replace('\\', '\\\\').
+            replace('"', '\\"').replace('\n', '\\n'))
+            for name, value in labels) + '}'
+
+def _format_value(value):
+    """
+    Format the specified sample value for the Prometheus text format.
+    :param value: the value
+    :return: the formatted value
+    """
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Histogram(object):
+    """
+    The bucket counts, sum, and count of the observations of a histogram.
+    """
+    def __init__(self, buckets):
+        """
+        Create a Histogram instance.
+        :param buckets: the upper bounds of the buckets
+        """
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """
+        Record the specified observation.
+        :param value: the observed value
+        """
+        for index, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                self.bucket_counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _Timer(object):
+    """
+    A context manager observing the time spent within it in a histogram.
+    """
+    def __init__(self, registry, name, labels):
+        """
+        Create a Timer instance.
+        :param registry: the metrics registry
+        :param name: the name of the histogram
+        :param labels: the labels of the histogram or None
+        """
+        self._registry = registry
+        self._name = name
+        self._labels = labels
+        self._start_time = None
+
+    def __enter__(self):
+        self._start_time = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._registry.observe(self._name, time.time() - self._start_time,
+                self._labels)
+        return False
+
+
+class MetricsRegistry(object):
+    """
+    A thread-safe registry of counters, gauges, and histograms, where each
+    metric is identified by its name and labels.
+    """
+    def __init__(self, latency_buckets = None):
+        """
+        Create a MetricsRegistry instance.
+        :param latency_buckets: the upper bounds in seconds of the buckets of
+        the histograms, defaults to _default_latency_buckets
+        """
+        if latency_buckets is None:
+            latency_buckets = _default_latency_buckets
+        self._latency_buckets = tuple(sorted(latency_buckets))
+        self._types = OrderedDict()
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _get_metric(self, name, metric_type):
+        """
+        Get the values of the specified metric, registering it if necessary.
+        Must be called while holding the lock.
+        :param name: the metric name
+        :param metric_type: the metric type
+        :return: the values of the metric keyed by their labels
+        """
+        registered_type = self._types.setdefault(name, metric_type)
+        if registered_type != metric_type:
+            raise ValueError('Metric ' + name + ' is a ' + registered_type +
+                    ', not a ' + metric_type)
+        return self._values.setdefault(name, OrderedDict())
+
+    def increment(self, name, labels = None, value = 1):
+        """
+        Increment the specified counter.
+        :param name: the counter name
+        :param labels: the labels dictionary or None
+        :param value: the amount to increment the counter by
+        """
+        with self._lock:
+            values = self._get_metric(name, 'counter')
+            label_key = _get_label_key(labels)
+            values[label_key] = values.get(label_key, 0) + value
+
+    def set_gauge(self, name, value, labels = None):
+        """
+        Set the specified gauge.
+        :param name: the gauge name
+        :param value: the value
+        :param labels: the labels dictionary or None
+        """
+        with self._lock:
+            self._get_metric(name, 'gauge')[_get_label_key(labels)] = value
+
+    def observe(self, name, value, labels = None):
+        """
+        Record an observation in the specified histogram.
+        :param name: the histogram name
+        :param value: the observed value
+        :param labels: the labels dictionary or None
+        """
+        with self._lock:
+            values = self._get_metric(name, 'histogram')
+            label_key = _get_label_key(labels)
+            if label_key not in values:
+                values[label_key] = _Histogram(self._latency_buckets)
+            values[label_key].observe(value)
+
+    def timer(self, name, labels = None):
+        """
+        Get a context manager observing the seconds spent within it in the
+        specified histogram.
+        :param name: the histogram name
+        :param labels: the labels dictionary or None
+        :return: the context manager
+        """
+        return _Timer(self, name, labels)
+
+    def get_value(self, name, labels = None):
+        """
+        Get the value of the specified counter or gauge, or the number of
+        observations of the specified histogram.
+        :param name: the metric name
+        :param labels: the labels dictionary or None
+        :return: the value or None if the metric has no value
+        """
+        with self._lock:
+            value = self._values.get(name, {}).get(_get_label_key(labels))
+            if isinstance(value, _Histogram):
+                return value.count
+            return value
+
+    def render_prometheus(self):
+        """
+        Render all metrics in the Prometheus text format.
+        :return: the rendered metrics
+        """
+        lines = []
+        with self._lock:
+            for name, metric_type in self._types.items():
+                lines.append('# TYPE %s %s' % (name, metric_type))
+                for label_key, value in self._values[name].items():
+                    if metric_type != 'histogram':
+                        lines.append(name + _format_labels(label_key) + ' ' +
+                                _format_value(value))
+                        continue
+                    for upper_bound, count in zip(value.buckets +
+                            (float('inf'),), value.bucket_counts +
+                            [value.count]):
+                        lines.append(name + '_bucket' +
+                                _format_labels(label_key,
+                                ('le', _format_value(upper_bound))) + ' ' +
+                                str(count))
+                    lines.append(name + '_sum' + _format_labels(label_key) +
+                            ' ' + _format_value(value.sum))
+                    lines.append(name + '_count' +
+                            _format_labels(label_key) + ' ' +
+                            str(value.count))
+        return '\n'.join(lines) + '\n'
+
+
+class LatencyEstimator(object):
+    """
+    A thread-safe estimate of the round trip time of o.io requests, kept as
+    an exponentially weighted moving average of every measurement and as a
+    percentile of a window of recent measurements. Clients measure every
+    request that receives a response, jobs compare the average to the time
+    they have left, and jobs and curators base their budgets and timeouts on
+    the percentile.
+    """
+    def __init__(self, weight = None, window_size = None, percentile = None):
+        """
+        Create a LatencyEstimator instance.
+        :param weight: the weight of each new measurement in the moving
+        average, defaults to _latency_average_weight
+        :param window_size: the number of recent measurements kept for the
+        percentile, defaults to _latency_window_size
+        :param percentile: the percentile of the recent measurements that
+        budgets and timeouts are based on, defaults to _latency_percentile
+        """
+        if weight is None:
+            weight = _latency_average_weight
+        self._weight = weight
+        if window_size is None:
+            window_size = _latency_window_size
+        if percentile is None:
+            percentile = _latency_percentile
+        self._percentile = percentile
+        self._average_in_ms = None
+        self._window = deque(maxlen = window_size)
+        self._sample_count = 0
+        # The window sorted for percentiles, or None if a measurement was
+        # recorded since it was sorted.
+        self._sorted_window = None
+        self._lock = threading.Lock()
+
+    def observe(self, latency_in_ms):
+        """
+        Record the specified round trip time.
+        :param latency_in_ms: the round trip time in milliseconds
+        """
+        with self._lock:
+            if self._average_in_ms is None:
+                self._average_in_ms = float(latency_in_ms)
+            else:
+                self._average_in_ms += self._weight * (latency_in_ms -
+                        self._average_in_ms)
+            self._window.append(latency_in_ms)
+            self._sample_count += 1
+            self._sorted_window = None
+
+    def get_sample_count(self):
+        """
+        Get the number of round trip times recorded.
+        :return: the number of measurements
+        """
+        return self._sample_count
+
+    def get_average_in_ms(self):
+        """
+        Get the moving average of the round trip time.
+        :return: the average in milliseconds, or None if nothing was
+        measured yet
+        """
+        return self._average_in_ms
+
+    def get_percentile_in_ms(self, percentile = None):
+        """
+        Get the specified percentile of the recent round trip times.
+        :param percentile: the percentile, defaults to the percentile of this
+        estimator
+        :return: the percentile in milliseconds, or None if nothing was
+        measured yet
+        """
+        if percentile is None:
+            percentile = self._percentile
+        with self._lock:
+            if not self._window:
+                return None
+            if self._sorted_window is None:
+                self._sorted_window = sorted(self._window)
+            sorted_window = self._sorted_window
+        index = int(math.ceil(percentile / 100.0 * len(sorted_window))) - 1
+        return sorted_window[min(max(index, 0), len(sorted_window) - 1)]
+
+    def _get_round_trip_time_in_ms(self):
+        """
+        Get the round trip time that budgets and timeouts are based on.
+        :return: the percentile in milliseconds, or None if fewer than
+        _min_latency_sample_count round trips were measured
+        """
+        if self._sample_count < _min_latency_sample_count:
+            return None
+        return self.get_percentile_in_ms()
+
+    def get_expected_time_in_ms(self, round_trip_count):
+        """
+        Get the expected time of the specified number of sequential round
+        trips at the moving average of the round trip time.
+        :param round_trip_count: the number of round trips
+        :return: the time in milliseconds, or None if fewer than
+        _min_latency_sample_count round trips were measured
+        """
+        if self._sample_count < _min_latency_sample_count:
+            return None
+        return round_trip_count * self._average_in_ms
+
+    def get_job_time_in_ms(self):
+        """
+        Get the budget of a job starting now, which covers
+        _job_time_in_round_trips round trips at the percentile of the recent
+        round trip times within the bounds of _min_adaptive_job_time_in_ms
+        and _max_adaptive_job_time_in_ms.
+        :return: the budget in milliseconds, which is _max_job_time_in_ms
+        until enough round trips were measured
+        """
+        round_trip_time_in_ms = self._get_round_trip_time_in_ms()
+        if round_trip_time_in_ms is None:
+            return _max_job_time_in_ms
+        return int(min(max(round_trip_time_in_ms * _job_time_in_round_trips,
+                _min_adaptive_job_time_in_ms), _max_adaptive_job_time_in_ms))
+
+    def get_timeout_wait_in_ms(self, minimum_in_ms = 0):
+        """
+        Get the time to wait after a timeout for requests still in flight,
+        which covers _timeout_wait_in_round_trips round trips at the
+        percentile of the recent round trip times.
+        :param minimum_in_ms: the minimum time to wait
+        :return: the time in milliseconds
+        """
+        round_trip_time_in_ms = self._get_round_trip_time_in_ms()
+        if round_trip_time_in_ms is None:
+            return minimum_in_ms
+        return max(minimum_in_ms, int(math.ceil(round_trip_time_in_ms *
+                _timeout_wait_in_round_trips)))
+
+
+def serve_metrics(registry, port, host = '127.0.0.1'):
+    """
+    Serve the specified registry in the Prometheus text format at /metrics
+    from a background thread.
+    :param registry: the metrics registry
+    :param port: the port to listen on, or 0 to use any free port
+    :param host: the host to listen on, defaults to the local host only
+    :return: the HTTP server, whose shutdown() method stops serving
+    """
+    class MetricsRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', _prometheus_content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer((host, port), MetricsRequestHandler)
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def _get_request_phase(method, collection):
+    """
+    Get the transaction phase of a backend call from the collection it
+    accesses and its HTTP method.
+    :param method: the HTTP method
+    :param collection: the collection or None
+    :return: the phase
+    """
+    if collection is None:
+        return 'other'
+    if collection == _locks_collection:
+        return 'lock_release' if method == 'DELETE' else 'lock_acquisition'
+    if collection in (_jobs_collection, _journal_collection):
+        return 'journal'
+    if collection == _curators_collection:
+        return 'curation'
+    return 'read' if method in ('GET', 'HEAD') else 'write'
+
+
+class Instrumentation(object):
+    """
+    The instrumentation of an OiotClient and of the jobs using it. The
+    methods do nothing and subclasses override the ones they need.
+    """
+    def on_request(self, phase, method, collection, status_code,
+            latency_in_seconds):
+        """
+        Called after every backend call.
+        :param phase: the transaction phase of the call, which is one of
+        lock_acquisition, read, journal, write, lock_release, curation, or
+        other
+        :param method: the HTTP method
+        :param collection: the collection or None
+        :param status_code: the status code of the response, or None if no
+        response was received
+        :param latency_in_seconds: the latency of the call
+        """
+        pass
+
+    def on_event(self, event):
+        """
+        Called when a lock conflict, job timeout, or job rollback occurs.
+        :param event: the event, which is one of lock_conflict,
+        write_conflict, timeout, or rollback
+        """
+        pass
+
+
+class MetricsInstrumentation(Instrumentation):
+    """
+    The instrumentation recording backend calls and events in a
+    MetricsRegistry.
+    """
+    def __init__(self, metrics = None):
+        """
+        Create a MetricsInstrumentation instance.
+        :param metrics: the MetricsRegistry to record in, defaults to a new
+        registry
+        """
+        if metrics is None:
+            metrics = MetricsRegistry()
+        self.metrics = metrics
+
+    def on_request(self, phase, method, collection, status_code,
+            latency_in_seconds):
+        labels = {'phase': phase, 'method': method,
+                'collection': collection or ''}
+        self.metrics.observe('oiot_request_seconds', latency_in_seconds,
+                labels)
+        labels['status'] = status_code or 'error'
+        self.metrics.increment('oiot_requests_total', labels)
+
+    def on_event(self, event):
+        self.metrics.increment('oiot_events_total', {'event': event})
@@ -0,0 +1,103 @@
+"""
+    oiot.pool
+    ~~~~~~~~~
+    This module implements the ConnectionPool class, a sized pool of
+    keep-alive HTTP connections that can be shared by any number of clients
+    and threads.
+    :copyright: (c) 2014 by Konstantin Bokarius.
+    :license: MIT, see LICENSE for more details.
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from .settings import _connection_pool_size
+import socket
+
+class _KeepAliveAdapter(HTTPAdapter):
+    """
+    The requests adapter of a ConnectionPool, which enables TCP keep-alive
+    on its sockets so idle pooled connections are not silently dropped.
+    """
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['socket_options'] = HTTPConnection.default_socket_options + [
+                (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        super(_KeepAliveAdapter, self).init_poolmanager(*args, **kwargs)
+
+
+class ConnectionPool(object):
+    """
+    A thread-safe pool of keep-alive HTTP connections. Mounting the pool on
+    several clients makes them reuse the same sockets, so the connection
+    setup and TLS handshake of a host are paid once per pooled connection
+    instead of once per client.
+    """
+    def __init__(self, max_size = None):
+        """
+        Create a ConnectionPool instance.
+        :param max_size: the maximum number of idle connections kept per
+        host, defaults to _connection_pool_size
+        """
+        if max_size is None:
+            max_size = _connection_pool_size
+        self.max_size = max_size
+        self._adapter = _KeepAliveAdapter(pool_maxsize = max_size)
+
+    def mount(self, client):
+        """
+        Route all requests made by the specified client through this pool.
+        :param client: the porc.Client, OiotClient, or AsyncOiotClient
+        instance
+        :return: the specified client
+        """
+        adapters = OrderedDict([('https://', self._adapter),
+                ('http://', self._adapter)])
+        # Pages instances create their own sessions from the client options.
+        client.opts['adapters'] = adapters
+        for session in [client.session, client.async_session]:
+            session.adapters = adapters
+        return client
+
+    def warm_up(self, client, connection_count = None):
+        """
+        Open connections to the o.io host of the specified client ahead of
+        the first operations by sending concurrent HEAD requests to it.
+        The requests are not reported to the client's instrumentation.
+        :param client: a client this pool is mounted on
+        :param connection_count: the number of connections to open, which
+        is at most and defaults to max_size
+        """
+        if connection_count is None:
+            connection_count = self.max_size
+        connection_count = min(connection_count, self.max_size)
+        url = client.uri + '/v0'
+        # Every connection must be in use at the same time to be opened, so
+        # the requests do not go through the executor shared by jobs.
+        with ThreadPoolExecutor(max_workers =
+                max(connection_count, 1)) as executor:
+            for future in [executor.submit(client.session.head, url)
+                    for index in range(connection_count)]:
+                future.result()
+
+    def get_statistics(self):
+        """
+        Get the statistics of this pool, summed over the hosts it connected
+        to.
+        :return: a dictionary of the number of hosts, the number of
+        connections opened so far, the number of requests sent, the number
+        of idle connections currently available for reuse, and max_size
+        """
+        statistics = {'hosts': 0, 'connections_opened': 0, 'requests': 0,
+                'idle_connections': 0, 'max_size': self.max_size}
+        pools = self._adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            statistics['hosts'] += 1
+            statistics['connections_opened'] += pool.num_connections
+            statistics['requests'] += pool.num_requests
+            # Slots without an open connection hold None.
+            statistics['idle_connections'] += len([connection for connection
+                    in list(pool.pool.queue) if connection is not None])
+        return statistics
@@ -0,0 +1,109 @@
+"""
+    oiot.serializer
+    ~~~~~~~~~
+    This module converts oiot's records into the JSON-compatible values sent
+    to o.io in a single pass, and serializes request bodies with orjson or
+    ujson when either is installed.
+    :copyright: (c) 2014 by Konstantin Bokarius.
+    :license: MIT, see LICENSE for more details.
+"""
+from datetime import datetime
+import json, uuid
+
+try:
+    # python 2
+    from urlparse import urljoin
+    _scalar_types = (basestring, int, long, float, bool, type(None))
+except ImportError:
+    # python 3
+    from urllib.parse import urljoin
+    _scalar_types = (str, int, float, bool, type(None))
+
+try:
+    import orjson
+    _json_backend = 'orjson'
+except ImportError:
+    orjson = None
+    try:
+        import ujson
+        _json_backend = 'ujson'
+    except ImportError:
+        ujson = None
+        _json_backend = 'json'
+
+# HTTP methods whose body porc sends as JSON rather than as parameters
+_methods_with_json_body = frozenset(['PUT', 'POST', 'PATCH'])
+
+def _get_wire_value(value):
+    """
+    Get the JSON-compatible equivalent of the specified value, converting
+    datetimes to ISO 8601 timestamps, UUIDs to strings, and oiot records
+    such as locks and journal items to dictionaries.
+    :param value: the value
+    :return: the JSON-compatible value
+    """
+    if isinstance(value, _scalar_types):
+        return value
+    if isinstance(value, dict):
+        return dict((key, _get_wire_value(item))
+                for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_get_wire_value(item) for item in value]
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    get_wire_dict = getattr(value, '_get_wire_dict', None)
+    if get_wire_dict is None:
+        raise TypeError(repr(value) + ' is not JSON serializable')
+    return get_wire_dict()
+
+def _dumps(value):
+    """
+    Serialize the specified JSON-compatible value using the fastest
+    available JSON library.
+    :param value: the value
+    :return: the JSON document as a string or UTF-8 encoded bytes
+    """
+    try:
+        if orjson is not None:
+            return orjson.dumps(value, option = orjson.OPT_NON_STR_KEYS)
+        if ujson is not None:
+            return ujson.dumps(value)
+    except (TypeError, ValueError, OverflowError):
+        # Values the fast libraries reject, such as integers beyond 64 bits,
+        # are left to the json module.
+        pass
+    return json.dumps(value)
+
+def _has_fast_json_body(method, body):
+    """
+    Determine whether the body of the specified request is serialized with
+    orjson or ujson by _send_request instead of by porc.
+    :param method: the HTTP method
+    :param body: the request body
+    :return: whether the body is serialized by _send_request
+    """
+    return (_json_backend != 'json' and body is not None and
+            method.upper() in _methods_with_json_body)
+
+def _send_request(resource, method, path, body, headers):
+    """
+    Send the specified o.io request the way porc.Resource._request does,
+    except that the JSON body is serialized with _dumps.
+    :param resource: the porc.Resource sending the request
+    :param method: the HTTP method
+    :param path: the path as a list of components or a string
+    :param body: the request body
+    :param headers: the request headers
+    :return: the response, or its future if the resource is asynchronous
+    """
+    if isinstance(path, list):
+        path = resource._make_path(path)
+    headers = dict(headers)
+    if not any(name.lower() == 'accept-encoding' for name in headers):
+        headers['Accept-Encoding'] = 'gzip'
+    session = (resource.async_session if resource.use_async else
+            resource.session)
+    return session.request(method, urljoin(resource.uri, path),
+            headers = headers, data = _dumps(body))
@@ -11,9 +11,15 @@ _locks_collection = 'oiot-locks'
 # collection name to use for the jobs collection
 _jobs_collection = 'oiot-jobs'
 
+# collection name to use for the journal items of append-only journals
+_journal_collection = 'oiot-journal'
+
 # collection name to use for the curators collection
 _curators_collection = 'oiot-curators'
 
+# collection name to use for the fencing tokens of locked keys
+_fencing_tokens_collection = 'oiot-fencing-tokens'
+
 # collection key name to use for the active curator
 _active_curator_key = 'active'
 
@@ -32,5 +38,107 @@ _max_job_time_in_ms = 5000
 # additional elapsed time used by active curators before rolling back jobs
 _additional_timeout_wait_in_ms = 1000
 
+# whether jobs store each journal item as its own record by default instead
+# of rewriting the entire journal in the job record for every operation
+_use_append_only_journal = False
+
+# whether jobs buffer their writes without locking by default and apply them
+# at completion conditionally on the refs of the objects they accessed
+_use_optimistic_concurrency = False
+
+# whether jobs hold their locks under a lease that expires unless the job
+# renews it by default instead of timing out after _max_job_time_in_ms
+_use_leases = False
+
+# time after a job starts or renews its lease at which the lease expires
+_lease_time_in_ms = 2000
+
+# whether curators search for timed out jobs, locks, and journal items by
+# their timestamps by default instead of listing the entire collections
+_use_curator_search = False
+
+# number of jobs, locks, or journal items an active curator curates
+# concurrently
+_curator_worker_count = 8
+
+# number of shards of jobs, locks, and journal items, each of which is
+# curated by its own active curator
+_curator_shard_count = 1
+
+# maximum number of IDs of recently removed jobs a curator remembers
+_max_removed_job_ids = 1000
+
+# time a curator remembers the ID of a job it removed
+_removed_job_id_lifetime_in_ms = 60000
+
+# maximum number of o.io requests executed concurrently by the threads shared
+# by all jobs, clients and curators in the process
+_max_concurrent_requests = 16
+
+# maximum number of keep-alive connections a ConnectionPool keeps per host
+_connection_pool_size = 32
+
+# maximum number of attempts to update a shared read lock that is being
+# updated concurrently by other readers
+_max_lock_update_attempts = 5
+
+# maximum time jobs and OiotClient wait by default for a locked collection
+# key to be unlocked before raising CollectionKeyIsLocked, or 0 to raise it
+# immediately
+_lock_wait_timeout_in_ms = 0
+
+# backoff before the first retry of a lock acquisition, which doubles after
+# every retry
+_initial_lock_wait_backoff_in_ms = 10
+
+# maximum backoff between retries of a lock acquisition
+_max_lock_wait_backoff_in_ms = 500
+
+# whether jobs waiting for locked collection keys use the wait-die policy by
+# default, rolling back instead of waiting for keys locked by older jobs
+_use_wait_die = False
+
+# number of collection keys a LocalLockTable can hold
+_local_lock_table_size = 4096
+
+# whether jobs time out after a budget derived from the latency measured by
+# their client by default instead of after _max_job_time_in_ms, and whether
+# curators derive their timeouts from the latency measured by their client
+_use_adaptive_timeouts = False
+
+# weight of each new latency measurement in the moving average of a client's
+# latency
+_latency_average_weight = 0.125
+
+# number of recent latency measurements kept for latency percentiles
+_latency_window_size = 256
+
+# percentile of the recent latencies that budgets and timeouts are based on
+_latency_percentile = 99
+
+# number of latency measurements required before budgets and timeouts are
+# derived from them
+_min_latency_sample_count = 20
+
+# number of round trips at the latency percentile an adaptive job budget
+# covers
+_job_time_in_round_trips = 50
+
+# minimum adaptive job budget
+_min_adaptive_job_time_in_ms = 1000
+
+# maximum adaptive job budget
+_max_adaptive_job_time_in_ms = 30000
+
+# number of round trips at the latency percentile that curators wait at
+# least in addition to a job's budget and a curator's heartbeat interval
+_timeout_wait_in_round_trips = 4
+
+# whether OiotClient checks for locks concurrently with gets and before
+# conditional puts and deletes by default instead of taking a lock for every
+# single-key operation, which lets a job that locks a key between the check
+# and a write silently replace the write
+_use_lock_check_fast_path = False
+
 # value used by journal items to indicate a delete operation was performed
 _deleted_object_value = {"deleted": "{A0981677-7933-4A5C-A141-9B40E60BD411}"}
@@ -0,0 +1,193 @@
+"""
+    oiot.steps
+    ~~~~~~~~~
+    This module implements the steps that the operations of OiotClient, Job,
+    and Curator are written in, and the driver running them synchronously.
+    An operation is a generator yielding each step that waits, such as an
+    o.io request, and receiving its result, so the same operation is run
+    by _run_steps() for OiotClient, Job, and Curator and by
+    oiot.aio._run_steps_async() for AsyncOiotClient, AsyncJob, and
+    AsyncCurator.
+    :copyright: (c) 2014 by Konstantin Bokarius.
+    :license: MIT, see LICENSE for more details.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from .settings import _max_concurrent_requests
+import threading, time, types
+
+# executor shared by all concurrent calls in the process, created on first
+# use
+_executor = None
+_executor_lock = threading.Lock()
+
+# whether the current thread is one of the shared executor's threads
+_executor_thread_state = threading.local()
+
+def _get_executor():
+    """
+    Get the executor shared by all concurrent calls, which runs at most
+    _max_concurrent_requests calls at a time.
+    :return: the executor
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers =
+                    _max_concurrent_requests)
+        return _executor
+
+def _call_in_executor_thread(function, args):
+    """
+    Call the specified function in a thread of the shared executor.
+    :param function: the specified function
+    :param args: the function's arguments tuple
+    :return: the function's result
+    """
+    _executor_thread_state.is_executor_thread = True
+    return function(*args)
+
+def _call_concurrently(calls):
+    """
+    Execute the specified calls concurrently using the shared executor and
+    wait for all of them to finish. Calls made from within the executor's
+    threads are executed sequentially instead, since waiting for calls
+    queued behind the waiting thread could otherwise exhaust the executor.
+    :param calls: the (function, arguments tuple) pair of each call
+    :return: the results of the calls in order, or raise the exception of
+    the first failed call
+    """
+    if (len(calls) <= 1 or
+            getattr(_executor_thread_state, 'is_executor_thread', False)):
+        return [function(*args) for function, args in calls]
+    executor = _get_executor()
+    futures = [executor.submit(_call_in_executor_thread, function, args)
+            for function, args in calls]
+    return [future.result() for future in futures]
+
+class _Return(BaseException):
+    """
+    Raised by an operation to return the specified value, since generators
+    cannot return values on Python 2. It is not an Exception so that the
+    operations' exception handlers do not catch it.
+    """
+    def __init__(self, value = None):
+        """
+        Create a _Return instance.
+        :param value: the return value of the operation
+        """
+        super(_Return, self).__init__(value)
+        self.value = value
+
+
+class _Call(object):
+    """
+    The step calling a function, which is an o.io request, an operation, or
+    a method that the synchronous and asyncio classes implement differently.
+    Its result is the function's result, after running it if it is an
+    operation or awaiting it if it is awaitable.
+    """
+    def __init__(self, function, *args, **kwargs):
+        """
+        Create a _Call instance.
+        :param function: the function
+        :param args: the function's arguments
+        :param kwargs: the function's keyword arguments
+        """
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+
+
+class _Concurrently(object):
+    """
+    The step running the specified steps concurrently. Its result is the
+    list of their results in order, or the exception of the first failed
+    step.
+    """
+    def __init__(self, steps):
+        """
+        Create a _Concurrently instance.
+        :param steps: the steps
+        """
+        self.steps = steps
+
+
+class _Sleep(object):
+    """
+    The step sleeping for the specified time.
+    """
+    def __init__(self, seconds):
+        """
+        Create a _Sleep instance.
+        :param seconds: the time to sleep in seconds
+        """
+        self.seconds = seconds
+
+
+class _Locked(object):
+    """
+    The step running the specified operation while holding the specified
+    lock, which is a threading lock for the synchronous classes and an
+    asyncio lock for the asyncio classes. Its result is the operation's
+    result.
+    """
+    def __init__(self, lock, operation):
+        """
+        Create a _Locked instance.
+        :param lock: the lock
+        :param operation: the operation
+        """
+        self.lock = lock
+        self.operation = operation
+
+
+def _run_steps(operation):
+    """
+    Run the specified operation synchronously, sending the result of each
+    step it yields back into it, or throwing the step's exception into it.
+    :param operation: the operation
+    :return: the operation's return value
+    """
+    result = None
+    error = None
+    while True:
+        try:
+            if error is None:
+                step = operation.send(result)
+            else:
+                step = operation.throw(error)
+        except _Return as e:
+            return e.value
+        except StopIteration:
+            return None
+        try:
+            result, error = _run_step(step), None
+        except BaseException as e:
+            # The operation is given the chance to clean up, or to handle
+            # the exception.
+            result, error = None, e
+
+def _run_step(step):
+    """
+    Run the specified step synchronously. An operation can also be yielded
+    as a step of its own.
+    :param step: the step
+    :return: the step's result
+    """
+    if isinstance(step, types.GeneratorType):
+        return _run_steps(step)
+    if isinstance(step, _Call):
+        result = step.function(*step.args, **step.kwargs)
+        if isinstance(result, types.GeneratorType):
+            return _run_steps(result)
+        return result
+    if isinstance(step, _Concurrently):
+        return _call_concurrently([(_run_step, (concurrent_step,)) for
+                concurrent_step in step.steps])
+    if isinstance(step, _Sleep):
+        time.sleep(step.seconds)
+        return None
+    if isinstance(step, _Locked):
+        with step.lock:
+            return _run_steps(step.operation)
+    raise TypeError('Unknown step ' + repr(step))
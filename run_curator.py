@@ -1,17 +1,33 @@
-from oiot import Curator, OiotClient
-import sys, time, traceback
+from oiot import Curator, OiotClient, ConnectionPool
+from oiot.metrics import MetricsRegistry, serve_metrics
+import argparse, time, traceback
 
 if __name__ == '__main__':
-    api_key = sys.argv[1]
-    if api_key is None:
-        print('Error: specify the API key to use.')
+    parser = argparse.ArgumentParser(description = 'Run an oiot curator.')
+    parser.add_argument('api_key', help = 'the o.io API key to use')
+    parser.add_argument('shard_count', nargs = '?', type = int,
+            help = 'the number of curator shards')
+    parser.add_argument('--metrics-port', type = int,
+            help = 'serve metrics in the Prometheus text format at '
+            '/metrics on this local port')
+    args = parser.parse_args()
+    # The metrics outlive the curator instances created below.
+    metrics = MetricsRegistry()
+    if args.metrics_port is not None:
+        serve_metrics(metrics, args.metrics_port)
+    # The pooled connections are reused by the clients created below.
+    connection_pool = ConnectionPool()
     while (True):
         try:
-            client = OiotClient(api_key)
+            client = OiotClient(args.api_key,
+                    connection_pool = connection_pool)
             client.ping().raise_for_status()
-            curator = Curator(client)
+            connection_pool.warm_up(client)
+            curator = Curator(client, shard_count = args.shard_count,
+                    metrics = metrics)
             curator.run()
         except Exception as e:
             # TODO: Log exception.
+            metrics.increment('oiot_curator_restarts_total')
             print('Caught: ' + traceback.format_exc())
             time.sleep(3)
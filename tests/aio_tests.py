@@ -0,0 +1,572 @@
+import os, sys, unittest, asyncio
+from oiot.settings import _jobs_collection, _locks_collection, \
+        _journal_collection, _fencing_tokens_collection, \
+        _min_latency_sample_count, _min_adaptive_job_time_in_ms
+from oiot.client import OiotClient
+from oiot.aio import AsyncOiotClient, AsyncJob, AsyncCurator, _gather, \
+        _run_steps_async
+from oiot.emulator import Emulator
+from oiot.locktable import LocalLockTable
+from oiot.metrics import Instrumentation, LatencyEstimator
+from oiot.exceptions import CollectionKeyIsLocked, JobIsCompleted, \
+        JobIsTimedOut, RollbackCausedByException
+from .emulator_tests import _expire_job, _expire_lease, _abandon_shards
+
+class AsyncTests(unittest.TestCase):
+    def setUp(self):
+        self._emulator = Emulator(seed = 0)
+        self._client = self._emulator.mount(
+                AsyncOiotClient('emulated-api-key'))
+        self._sync_client = self._emulator.mount(
+                OiotClient('emulated-api-key'))
+        self._loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self._loop.close()
+
+    def _run(self, coroutine):
+        return self._loop.run_until_complete(coroutine)
+
+    def test_client_operations(self):
+        async def run_test():
+            response = await self._client.put('test1', 'key1', {'value': 1})
+            response.raise_for_status()
+            response = await self._client.get('test1', 'key1')
+            self.assertEqual(response.json, {'value': 1})
+            response = await self._client.delete('test1', 'key1')
+            response.raise_for_status()
+            response = await self._client.get('test1', 'key1')
+            self.assertEqual(response.status_code, 404)
+        self._run(run_test())
+        self.assertEqual(self._emulator.get_call_count('PUT',
+                _locks_collection), 4)
+
+    def test_lock_check_fast_path(self):
+        client = self._emulator.mount(AsyncOiotClient('emulated-api-key',
+                use_lock_check_fast_path = True))
+        async def run_test():
+            (await client.put('test1', 'key1', {'value': 1})).\
+                    raise_for_status()
+            self.assertEqual((await client.get('test1', 'key1')).json,
+                    {'value': 1})
+            job = AsyncJob(self._client)
+            await job.put('test1', 'key1', {'value': 2})
+            with self.assertRaises(CollectionKeyIsLocked):
+                await client.get('test1', 'key1')
+            with self.assertRaises(CollectionKeyIsLocked):
+                await client.delete('test1', 'key1')
+            await job.complete()
+            (await client.delete('test1', 'key1')).raise_for_status()
+        self._run(run_test())
+        self.assertEqual(self._emulator.get_call_count('PUT',
+                _locks_collection), 1)
+
+    def test_instrumentation(self):
+        class RecordingInstrumentation(Instrumentation):
+            def __init__(self):
+                self.requests = []
+                self.events = []
+            def on_request(self, phase, method, collection, status_code,
+                    latency_in_seconds):
+                self.requests.append((phase, method, collection, status_code))
+            def on_event(self, event):
+                self.events.append(event)
+        instrumentation = RecordingInstrumentation()
+        client = self._emulator.mount(AsyncOiotClient('emulated-api-key',
+                instrumentation = instrumentation))
+        async def run_test():
+            job = AsyncJob(client)
+            await job.put('test1', 'key1', {'value': 1})
+            with self.assertRaises(CollectionKeyIsLocked):
+                await client.get('test1', 'key1')
+            await job.complete()
+        self._run(run_test())
+        self.assertEqual(sorted(set(request[0] for request in
+                instrumentation.requests)), ['journal', 'lock_acquisition',
+                'lock_release', 'read', 'write'])
+        self.assertIn(('lock_acquisition', 'PUT', _locks_collection, 412),
+                instrumentation.requests)
+        self.assertEqual(instrumentation.events, ['lock_conflict'])
+
+    def test_job_completion(self):
+        async def run_test():
+            job = AsyncJob(self._client)
+            response = await job.post('test1', {'value': 1})
+            await job.put('test1', 'key1', {'value': 2})
+            await job.get('test1', response.key)
+            await job.delete('test1', response.key)
+            with self.assertRaises(CollectionKeyIsLocked):
+                await self._client.get('test1', 'key1')
+            await job.complete()
+            with self.assertRaises(JobIsCompleted):
+                await job.complete()
+            response = await self._client.get('test1', 'key1')
+            self.assertEqual(response.json, {'value': 2})
+        self._run(run_test())
+        self.assertEqual(self._client.list(_locks_collection).all(), [])
+        self.assertEqual(self._client.list(_jobs_collection).all(), [])
+
+    def test_job_rollback(self):
+        async def run_test():
+            await self._client.put('test1', 'key1', {'value': 1})
+            await self._client.put('test1', 'key2', {'value': 2})
+            job = AsyncJob(self._client)
+            response = await job.post('test1', {'value': 3})
+            await job.put('test1', 'key1', {'value': 4})
+            await job.delete('test1', 'key2')
+            with self.assertRaises(RollbackCausedByException):
+                await job.put('test1', 'key1', None)
+            self.assertEqual((await self._client.get('test1',
+                    'key1')).json, {'value': 1})
+            self.assertEqual((await self._client.get('test1',
+                    'key2')).json, {'value': 2})
+            self.assertEqual((await self._client.get('test1',
+                    response.key)).status_code, 404)
+        self._run(run_test())
+        self.assertEqual(self._client.list(_locks_collection).all(), [])
+
+    def test_concurrent_jobs(self):
+        async def run_job(index):
+            job = AsyncJob(self._client)
+            await job.put('test1', 'key%03d' % index, {'value': index})
+            await job.complete()
+        async def run_test():
+            await asyncio.gather(*[run_job(index) for index in range(100)])
+        self._run(run_test())
+        self.assertEqual(len(self._client.list('test1').all()), 100)
+        self.assertEqual(self._client.list(_locks_collection).all(), [])
+
+    def test_shared_read_locks(self):
+        async def run_test():
+            await self._client.put('test1', 'key1', {'value': 1})
+            jobs = [AsyncJob(self._client) for index in range(3)]
+            responses = await asyncio.gather(*[job.get('test1', 'key1')
+                    for job in jobs])
+            self.assertEqual([response.json for response in responses],
+                    [{'value': 1}] * 3)
+            with self.assertRaises(CollectionKeyIsLocked):
+                await self._client.put('test1', 'key1', {})
+            with self.assertRaises(RollbackCausedByException):
+                await jobs[0].put('test1', 'key1', {'value': 2})
+            await jobs[1].complete()
+            await jobs[2].put('test1', 'key1', {'value': 3})
+            with self.assertRaises(CollectionKeyIsLocked):
+                await self._client.get('test1', 'key1')
+            await jobs[2].complete()
+            self.assertEqual((await self._client.get('test1',
+                    'key1')).json, {'value': 3})
+        self._run(run_test())
+        self.assertEqual(self._client.list(_locks_collection).all(), [])
+
+    def test_optimistic_job(self):
+        async def run_test():
+            await self._client.put('test1', 'key1', {'value': 1})
+            job = AsyncJob(self._client, use_optimistic_concurrency = True)
+            await job.get('test1', 'key1')
+            responses = await job.put_many([('test1', 'key1', {'value': 2}),
+                    ('test1', 'key2', {'value': 3})])
+            self.assertEqual([response.status_code for response in
+                    responses], [202, 202])
+            await job.complete()
+            self.assertEqual(responses[1].ref, (await self._client.get(
+                    'test1', 'key2')).ref)
+            self.assertEqual((await self._client.get('test1',
+                    'key1')).json, {'value': 2})
+            job = AsyncJob(self._client, use_optimistic_concurrency = True)
+            await job.get('test1', 'key1')
+            await job.delete('test1', 'key2')
+            await self._client.put('test1', 'key1', {'value': 4})
+            with self.assertRaises(RollbackCausedByException):
+                await job.complete()
+            self.assertEqual((await self._client.get('test1',
+                    'key2')).json, {'value': 3})
+            pessimistic_job = AsyncJob(self._client)
+            await pessimistic_job.put('test1', 'key2', {'value': 5})
+            job = AsyncJob(self._client, use_optimistic_concurrency = True)
+            await job.put('test1', 'key2', {'value': 6})
+            try:
+                await job.complete()
+                self.fail('RollbackCausedByException was not raised')
+            except RollbackCausedByException as e:
+                self.assertTrue(isinstance(e.exception_causing_rollback,
+                        CollectionKeyIsLocked))
+            await pessimistic_job.roll_back()
+            self.assertEqual((await self._client.get('test1',
+                    'key2')).json, {'value': 3})
+        self._run(run_test())
+        self.assertEqual(self._client.list(_locks_collection).all(), [])
+        self.assertEqual(self._client.list(_jobs_collection).all(), [])
+
+    def test_lease_renewal_and_fencing_tokens(self):
+        async def run_test():
+            job = AsyncJob(self._client, use_leases = True,
+                    lease_time_in_ms = 300, renew_automatically = True)
+            await job.put('test1', 'key1', {'value': 1})
+            self.assertEqual(job.get_fencing_token('test1', 'key1'), 1)
+            # The job outlives its original lease.
+            await asyncio.sleep(0.5)
+            await job.put('test1', 'key2', {'value': 2})
+            self.assertTrue(await job.renew())
+            for key in ['key1', 'key2']:
+                self.assertEqual((await self._client.get(_locks_collection,
+                        'test1-' + key, None, False)).json[
+                        'lease_expiration_in_ms'], job._lease_expiration_in_ms)
+            await job.complete()
+            with self.assertRaises(JobIsCompleted):
+                await job.renew()
+            job = AsyncJob(self._client, use_leases = True)
+            await job.get('test1', 'key1')
+            await job.put('test1', 'key1', {'value': 3})
+            self.assertEqual(job.get_fencing_token('test1', 'key1'), 2)
+            await job.complete()
+            with self.assertRaises(ValueError):
+                await AsyncJob(self._client).renew()
+        self._run(run_test())
+        self.assertEqual(self._sync_client.get(_fencing_tokens_collection,
+                'test1-key1', None, False).json, {'fencing_token': 2})
+        self.assertEqual(self._sync_client.list(_jobs_collection).all(), [])
+
+    def test_waiting_for_locks(self):
+        client = self._emulator.mount(AsyncOiotClient('emulated-api-key',
+                lock_wait_timeout_in_ms = 5000))
+        async def complete_later(job):
+            await asyncio.sleep(0.2)
+            await job.complete()
+        async def run_test():
+            job = AsyncJob(self._client)
+            await job.put('test1', 'key1', {'value': 1})
+            task = asyncio.ensure_future(complete_later(job))
+            self.assertEqual((await client.get('test1', 'key1')).json,
+                    {'value': 1})
+            await task
+            job = AsyncJob(self._client)
+            await job.get('test1', 'key1')
+            task = asyncio.ensure_future(complete_later(job))
+            waiting_job = AsyncJob(self._client,
+                    lock_wait_timeout_in_ms = 5000)
+            await waiting_job.put('test1', 'key1', {'value': 2})
+            await task
+            with self.assertRaises(RollbackCausedByException):
+                await AsyncJob(self._client, lock_wait_timeout_in_ms =
+                        100).get('test1', 'key1')
+            await waiting_job.complete()
+        self._run(run_test())
+        self.assertEqual(self._sync_client.get('test1', 'key1').json,
+                {'value': 2})
+
+    def test_local_lock_table(self):
+        table = LocalLockTable(slot_count = 64)
+        client = self._emulator.mount(AsyncOiotClient('emulated-api-key',
+                lock_table = table, lock_wait_timeout_in_ms = 5000))
+        async def complete_later(job):
+            await asyncio.sleep(0.2)
+            await job.complete()
+        async def run_test():
+            job = AsyncJob(client)
+            await job.put('test1', 'key1', {'value': 1})
+            self.assertEqual(table.get_holder_count(), 1)
+            lock_puts = self._emulator.get_call_count('PUT',
+                    _locks_collection)
+            with self.assertRaises(RollbackCausedByException):
+                await AsyncJob(client, lock_wait_timeout_in_ms = 0).put(
+                        'test1', 'key1', {'value': 2})
+            self.assertEqual(self._emulator.get_call_count('PUT',
+                    _locks_collection), lock_puts)
+            task = asyncio.ensure_future(complete_later(job))
+            (await client.put('test1', 'key1', {'value': 3})).\
+                    raise_for_status()
+            await task
+        self._run(run_test())
+        self.assertEqual(table.get_holder_count(), 0)
+        self.assertEqual(self._sync_client.get('test1', 'key1').json,
+                {'value': 3})
+
+    def test_adaptive_timeouts(self):
+        latency_estimator = LatencyEstimator()
+        client = self._emulator.mount(AsyncOiotClient('emulated-api-key',
+                latency_estimator = latency_estimator))
+        async def run_test():
+            (await client.put('test1', 'key1', {'value': 1})).\
+                    raise_for_status()
+            self.assertEqual(latency_estimator.get_sample_count(), 3)
+            for index in range(_min_latency_sample_count):
+                latency_estimator.observe(10)
+            job = AsyncJob(client, use_adaptive_timeouts = True)
+            self.assertEqual(job._job_time_in_ms,
+                    _min_adaptive_job_time_in_ms)
+            await job.get('test1', 'key1')
+            for index in range(_min_latency_sample_count):
+                latency_estimator.observe(500)
+            lock_puts = self._emulator.get_call_count('PUT',
+                    _locks_collection)
+            try:
+                await job.put('test1', 'key1', {'value': 2})
+                self.fail('RollbackCausedByException not raised')
+            except RollbackCausedByException as e:
+                self.assertTrue(isinstance(e.exception_causing_rollback,
+                        JobIsTimedOut))
+            self.assertEqual(self._emulator.get_call_count('PUT',
+                    _locks_collection), lock_puts)
+            self.assertTrue(job.is_rolled_back)
+            self.assertEqual(AsyncCurator(client, use_adaptive_timeouts =
+                    True)._get_additional_timeout_wait_in_ms(), 2000)
+        self._run(run_test())
+        self.assertEqual(self._sync_client.get('test1', 'key1').json,
+                {'value': 1})
+
+    def test_lock_all(self):
+        async def lock_all_and_complete(collection_keys):
+            job = AsyncJob(self._client, lock_wait_timeout_in_ms = 3000)
+            await job.lock_all(collection_keys)
+            await job.put('test1', 'key2', {'value': 2})
+            await job.complete()
+        async def run_test():
+            holder = AsyncJob(self._client)
+            await holder.put('test1', 'key1', {'value': 1})
+            collection_keys = [('test1', 'key1'), ('test1', 'key2')]
+            tasks = [asyncio.ensure_future(lock_all_and_complete(keys))
+                    for keys in [collection_keys, collection_keys[::-1]]]
+            await asyncio.sleep(0.2)
+            await holder.complete()
+            await _gather(tasks)
+        self._run(run_test())
+        self.assertEqual(self._sync_client.list(_locks_collection).all(), [])
+
+    def test_put_many_and_delete_many(self):
+        async def run_test():
+            await self._client.put('test1', 'key1', {'value': 1})
+            await self._client.put('test1', 'key2', {'value': 2})
+            job = AsyncJob(self._client)
+            responses = await job.put_many([('test1', 'key1', {'value': 3}),
+                    ('test1', 'key3', {'value': 4})])
+            self.assertEqual(len(responses), 2)
+            await job.delete_many([('test1', 'key2')])
+            self.assertEqual(len(self._client.list('test1').all()), 2)
+            await job.roll_back()
+            self.assertEqual((await self._client.get('test1',
+                    'key1')).json, {'value': 1})
+            self.assertEqual((await self._client.get('test1',
+                    'key2')).json, {'value': 2})
+            with self.assertRaises(ValueError):
+                await AsyncJob(self._client).delete_many([('test1', 'key1'),
+                        ('test1', 'key1')])
+        self._run(run_test())
+        self.assertEqual(len(self._client.list('test1').all()), 2)
+        self.assertEqual(self._client.list(_locks_collection).all(), [])
+
+    def test_curation_of_timed_out_job(self):
+        async def run_test():
+            await self._client.put('test1', 'key1', {'value': 1})
+            job = AsyncJob(self._client)
+            await job.put('test1', 'key1', {'value': 2})
+            _expire_job(self._sync_client, job)
+            curator = AsyncCurator(self._client)
+            self.assertTrue(await _run_steps_async(
+                    curator._determine_active_status()))
+            curator._is_active = True
+            self.assertTrue(await _run_steps_async(curator._curate()))
+            self.assertEqual((await self._client.get('test1',
+                    'key1')).json, {'value': 1})
+        self._run(run_test())
+        self.assertEqual(self._client.list(_locks_collection).all(), [])
+        self.assertEqual(self._client.list(_jobs_collection).all(), [])
+
+    def test_curation_of_job_with_expired_lease(self):
+        async def run_test():
+            await self._client.put('test1', 'key1', {'value': 1})
+            job = AsyncJob(self._client, use_leases = True)
+            await job.put('test1', 'key1', {'value': 2})
+            _expire_lease(self._sync_client, job)
+            curator = AsyncCurator(self._client)
+            self.assertTrue(await _run_steps_async(
+                    curator._determine_active_status()))
+            curator._is_active = True
+            self.assertTrue(await _run_steps_async(curator._curate()))
+            self.assertEqual((await self._client.get('test1',
+                    'key1')).json, {'value': 1})
+        self._run(run_test())
+        self.assertEqual(self._client.list(_locks_collection).all(), [])
+        self.assertEqual(self._client.list(_jobs_collection).all(), [])
+
+    def test_lease_curation_using_search(self):
+        async def run_test():
+            await self._client.put('test1', 'key1', {'value': 1})
+            job = AsyncJob(self._client, use_leases = True)
+            await job.put('test1', 'key1', {'value': 2})
+            _expire_lease(self._sync_client, job)
+            curator = AsyncCurator(self._client, use_search = True)
+            self.assertTrue(await _run_steps_async(
+                    curator._determine_active_status()))
+            curator._is_active = True
+            self.assertTrue(await _run_steps_async(curator._curate()))
+            self.assertEqual((await self._client.get('test1',
+                    'key1')).json, {'value': 1})
+        self._run(run_test())
+        self.assertEqual(self._client.list(_locks_collection).all(), [])
+        self.assertEqual(self._client.list(_jobs_collection).all(), [])
+
+    def test_curation_of_orphaned_locks_without_job_lookups(self):
+        async def run_test():
+            await self._client.put('test1', 'key1', {'value': 1})
+            job = AsyncJob(self._client)
+            await job.put('test1', 'key1', {'value': 2})
+            _expire_job(self._sync_client, job)
+            # Remove the job record only, leaving its lock orphaned.
+            await self._client.delete(_jobs_collection, job._job_id, None,
+                    False)
+            curator = AsyncCurator(self._client)
+            self.assertTrue(await _run_steps_async(
+                    curator._determine_active_status()))
+            curator._is_active = True
+            self._emulator.reset_call_counts()
+            self.assertTrue(await _run_steps_async(curator._curate()))
+            # The jobs are listed once and no job is looked up individually.
+            self.assertEqual(self._emulator.get_call_count('GET',
+                    _jobs_collection), 1)
+        self._run(run_test())
+        self.assertEqual(self._client.list(_locks_collection).all(), [])
+
+    def test_curation_across_pages(self):
+        async def run_test():
+            for index in range(25):
+                key = 'key%02d' % index
+                await self._client.put('test1', key, {'value': 1})
+                job = AsyncJob(self._client)
+                await job.put('test1', key, {'value': 2})
+                _expire_job(self._sync_client, job)
+            curator = AsyncCurator(self._client)
+            self.assertTrue(await _run_steps_async(
+                    curator._determine_active_status()))
+            curator._is_active = True
+            self.assertTrue(await _run_steps_async(curator._curate()))
+        self._run(run_test())
+        self.assertEqual([result['value'] for result in
+                self._client.list('test1').all()], [{'value': 1}] * 25)
+        self.assertEqual(self._client.list(_jobs_collection).all(), [])
+        self.assertEqual(self._client.list(_locks_collection).all(), [])
+
+    def test_sharded_curation(self):
+        async def run_test():
+            for index in range(10):
+                key = 'key%02d' % index
+                await self._client.put('test1', key, {'value': 1})
+                job = AsyncJob(self._client)
+                await job.put('test1', key, {'value': 2})
+                _expire_job(self._sync_client, job)
+            curators = [AsyncCurator(self._client, shard_count = 2)
+                    for index in range(3)]
+            self.assertTrue(await _run_steps_async(
+                    curators[0]._determine_active_status()))
+            self.assertTrue(await _run_steps_async(
+                    curators[1]._determine_active_status()))
+            self.assertFalse(await _run_steps_async(
+                    curators[2]._determine_active_status()))
+            for curator in curators[:2] + curators[:1]:
+                curator._is_active = True
+                await _run_steps_async(curator._curate())
+        self._run(run_test())
+        self.assertEqual([result['value'] for result in
+                self._client.list('test1').all()], [{'value': 1}] * 10)
+        self.assertEqual(self._client.list(_jobs_collection).all(), [])
+        self.assertEqual(self._client.list(_locks_collection).all(), [])
+
+    def test_abandoned_shards_are_taken_over(self):
+        async def run_test():
+            for index in range(10):
+                key = 'key%02d' % index
+                await self._client.put('test1', key, {'value': 1})
+                job = AsyncJob(self._client)
+                await job.put('test1', key, {'value': 2})
+                _expire_job(self._sync_client, job)
+            curators = [AsyncCurator(self._client, shard_count = 2)
+                    for index in range(2)]
+            self.assertTrue(await _run_steps_async(
+                    curators[0]._determine_active_status()))
+            self.assertTrue(await _run_steps_async(
+                    curators[1]._determine_active_status()))
+            _abandon_shards(self._sync_client, curators[1])
+            curators[0]._is_active = True
+            self.assertTrue(await _run_steps_async(
+                    curators[0]._determine_active_status()))
+            self.assertEqual(sorted(curators[0]._shard_indexes), [0, 1])
+            self.assertTrue(await _run_steps_async(curators[0]._curate()))
+        self._run(run_test())
+        self.assertEqual([result['value'] for result in
+                self._client.list('test1').all()], [{'value': 1}] * 10)
+        self.assertEqual(self._client.list(_jobs_collection).all(), [])
+        self.assertEqual(self._client.list(_locks_collection).all(), [])
+
+    def test_curators_started_one_after_another(self):
+        async def run_test():
+            curators = []
+            for index in range(4):
+                for curator in curators:
+                    curator._last_shard_check_time = None
+                    self.assertTrue(await _run_steps_async(
+                            curator._determine_active_status()))
+                curator = AsyncCurator(self._client, shard_count = 4)
+                self.assertTrue(await _run_steps_async(
+                        curator._determine_active_status()))
+                curator._is_active = True
+                curators.append(curator)
+            self.assertEqual(sorted(curator._shard_indexes[0]
+                    for curator in curators), [0, 1, 2, 3])
+            self.assertTrue(all(len(curator._shard_indexes) == 1
+                    for curator in curators))
+        self._run(run_test())
+
+    def test_concurrent_curation_of_timed_out_jobs(self):
+        async def run_test():
+            for index in range(10):
+                key = 'key%02d' % index
+                await self._client.put('test1', key, {'value': 1})
+                job = AsyncJob(self._client)
+                await job.put('test1', key, {'value': 2})
+                _expire_job(self._sync_client, job)
+            curator = AsyncCurator(self._client, worker_count = 4)
+            self.assertTrue(await _run_steps_async(
+                    curator._determine_active_status()))
+            curator._is_active = True
+            self.assertTrue(await _run_steps_async(curator._curate()))
+        self._run(run_test())
+        self.assertEqual([result['value'] for result in
+                self._client.list('test1').all()], [{'value': 1}] * 10)
+        self.assertEqual(self._client.list(_locks_collection).all(), [])
+
+    def test_curation_using_search(self):
+        async def run_test():
+            await self._client.put('test1', 'key1', {'value': 1})
+            job = AsyncJob(self._client, use_append_only_journal = True)
+            await job.put('test1', 'key1', {'value': 2})
+            _expire_job(self._sync_client, job)
+            curator = AsyncCurator(self._client, use_search = True)
+            self.assertTrue(await _run_steps_async(
+                    curator._determine_active_status()))
+            curator._is_active = True
+            self.assertTrue(await _run_steps_async(curator._curate()))
+            self.assertEqual((await self._client.get('test1',
+                    'key1')).json, {'value': 1})
+        self._run(run_test())
+        self.assertEqual(self._client.list(_locks_collection).all(), [])
+        self.assertEqual(self._client.list(_journal_collection).all(), [])
+
+    def test_curation_of_timed_out_append_only_job(self):
+        async def run_test():
+            await self._client.put('test1', 'key1', {'value': 1})
+            job = AsyncJob(self._client, use_append_only_journal = True)
+            await job.put('test1', 'key1', {'value': 2})
+            await job.post('test1', {'value': 3})
+            _expire_job(self._sync_client, job)
+            curator = AsyncCurator(self._client)
+            self.assertTrue(await _run_steps_async(
+                    curator._determine_active_status()))
+            curator._is_active = True
+            self.assertTrue(await _run_steps_async(curator._curate()))
+            self.assertEqual((await self._client.get('test1',
+                    'key1')).json, {'value': 1})
+        self._run(run_test())
+        self.assertEqual(len(self._client.list('test1').all()), 1)
+        self.assertEqual(self._client.list(_journal_collection).all(), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import os, sys, unittest, json
+from oiot import bench
+
+class BenchTests(unittest.TestCase):
+    def test_backend_calls_per_operation(self):
+        results = bench.run(rtt_in_ms = 0, iterations = 3,
+                seed = 0)['results']
+        expected_calls = {'porc.get': 1, 'porc.put': 1, 'porc.delete': 1,
+                'oiot_client.get': 3, 'oiot_client.put': 3,
+                'oiot_client.delete': 3, 'oiot_client_fast_path.get': 2,
+                'oiot_client_fast_path.put': 3,
+                'oiot_client_fast_path.delete': 3, 'job.get': 2, 'job.put': 4,
+                'job.post': 4, 'job.delete': 4, 'job.complete': 2,
+                'job.roll_back': 4, 'job.transaction': 11,
+                'optimistic_job.transaction': 8}
+        for name, calls in expected_calls.items():
+            self.assertEqual(results[name]['backend_calls_per_operation'],
+                    calls, name)
+        self.assertEqual(results['job.put']['baseline'], 'porc.put')
+        self.assertEqual(
+                results['job.put']['backend_calls_relative_to_baseline'], 4)
+
+    def test_selected_benchmarks(self):
+        results = bench.run(rtt_in_ms = 0, iterations = 2,
+                names = ['porc.get'])['results']
+        self.assertEqual(list(results), ['porc.get'])
+        self.assertTrue(results['porc.get']['p99_latency_in_ms'] >=
+                results['porc.get']['p50_latency_in_ms'])
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(bench._get_percentile(values, 50), 50)
+        self.assertEqual(bench._get_percentile(values, 99), 99)
+        self.assertEqual(bench._get_percentile([], 50), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,6 +2,7 @@ import os, sys, unittest, time
 from oiot.settings import _locks_collection, _jobs_collection
 from oiot.client import OiotClient
 from oiot.job import Job
+from oiot.steps import _run_steps
 from oiot.exceptions import CollectionKeyIsLocked, JobIsCompleted, \
         JobIsRolledBack, JobIsFailed, FailedToComplete, \
         FailedToRollBack, RollbackCausedByException, JobIsTimedOut     
@@ -16,9 +17,9 @@ class ClientTests(unittest.TestCase):
         self._client.ping().raise_for_status()
 
     def test_lock_key_and_execute_operation(self):
-        response = self._client._lock_key_and_execute_operation(True,
-                super(self._client.__class__, self._client).put, 'test1',
-                Job._generate_key(), {}, None)
+        response = _run_steps(self._client._lock_key_and_execute_operation(
+                True, super(self._client.__class__, self._client).put,
+                'test1', Job._generate_key(), {}, None))
         response.raise_for_status()
         self._client.get('test1', response.key, None,
                 False).raise_for_status()
@@ -29,12 +30,12 @@ class ClientTests(unittest.TestCase):
 
     def test_add_and_remove_lock(self):
         key = Job._generate_key()
-        lock = Job._create_and_add_lock(self._client, 'test1', key, None,
-                datetime.utcnow())
+        lock = _run_steps(Job._create_and_add_lock(self._client, 'test1',
+                key, None, datetime.utcnow()))
         self._client.get(_locks_collection, Job._get_lock_collection_key(
                 'test1', key), None,
                 False).raise_for_status()
-        self._client._remove_lock(lock)
+        _run_steps(self._client._remove_lock(lock))
         self.assertEqual(self._client.get(_locks_collection,
                 Job._get_lock_collection_key('test1', key), None, False).
                 status_code, 404)
@@ -9,6 +9,7 @@ from oiot.settings import _curator_heartbeat_timeout_in_ms, \
         _additional_timeout_wait_in_ms, _max_job_time_in_ms, \
         _jobs_collection, _locks_collection
 from oiot.job import Job
+from oiot.steps import _run_steps
 from .test_tools import _were_collections_cleared, _oio_api_key, \
         _verify_job_creation, _clear_test_collections, \
         _verify_lock_creation
@@ -67,8 +68,8 @@ def run_test_curation_of_timed_out_locks(client, test_instance):
     test2_key = Job._generate_key()
     test3_key = Job._generate_key()
     job = Job(client)
-    job._get_lock('test2', test2_key)
-    job._get_lock('test3', test3_key)
+    _run_steps(job._get_lock('test2', test2_key))
+    _run_steps(job._get_lock('test3', test3_key))
     for lock in job._locks:
         if lock.job_id == job._job_id:
             response = client.get(_locks_collection,
@@ -0,0 +1,1321 @@
+import os, sys, unittest, time, threading
+from datetime import datetime, timedelta
+from requests.exceptions import ConnectionError
+from oiot.settings import _jobs_collection, _locks_collection, \
+        _journal_collection, _curators_collection, _max_job_time_in_ms, \
+        _additional_timeout_wait_in_ms, _max_lock_update_attempts, \
+        _curator_heartbeat_interval_in_ms, _fencing_tokens_collection, \
+        _initial_lock_wait_backoff_in_ms, _max_lock_wait_backoff_in_ms, \
+        _min_latency_sample_count, _min_adaptive_job_time_in_ms, \
+        _curator_heartbeat_timeout_in_ms, _max_concurrent_requests
+from oiot.client import OiotClient
+from oiot.curator import Curator, _ExpiringSet, _iterate_records
+from oiot.emulator import Emulator
+from oiot.metrics import MetricsRegistry, MetricsInstrumentation, \
+        LatencyEstimator
+from oiot.job import Job, _Encoder, _get_timestamp_in_ms, \
+        _get_lock_wait_delay_in_ms, _get_record_expiration_in_ms
+from oiot.steps import _Return, _call_concurrently, _get_executor, \
+        _run_steps
+from oiot.exceptions import CollectionKeyIsLocked, \
+        RollbackCausedByException, FailedToComplete, \
+        CollectionKeyWasModified, JobIsCompleted, JobIsTimedOut, \
+        _CuratorNoLongerActive
+from .job_tests import run_test_basic_job_completion, \
+        run_test_basic_job_rollback, \
+        run_test_rollback_caused_by_exception, \
+        run_test_failed_completion, run_test_failed_rollback, \
+        run_test_job_and_lock_creation_and_removal, \
+        run_test_job_and_lock_creation_and_removal2, \
+        run_test_verify_operations_and_roll_back, \
+        run_test_exception_raised_when_key_locked, \
+        verify_locked_exception_is_raised
+import json
+
+def _get_emulated_client(emulator):
+    client = emulator.mount(OiotClient('emulated-api-key'))
+    client.ping().raise_for_status()
+    return client
+
+def _set_timestamp(value, timestamp_field, timestamp, use_legacy_timestamps):
+    value[timestamp_field] = json.loads(json.dumps(timestamp, cls=_Encoder))
+    if use_legacy_timestamps:
+        value.pop(timestamp_field + '_in_ms', None)
+    else:
+        value[timestamp_field + '_in_ms'] = _get_timestamp_in_ms(timestamp)
+
+def _expire_job(client, job, use_legacy_timestamps = False):
+    # Move the timestamps of the job and of its locks and journal items back
+    # so the curator considers them timed out. Legacy timestamps leave out
+    # the millisecond timestamps like records written by older versions.
+    timestamp = datetime.utcnow() - timedelta(milliseconds =
+            _max_job_time_in_ms + _additional_timeout_wait_in_ms + 1000)
+    response = client.get(_jobs_collection, job._job_id, None, False)
+    response.raise_for_status()
+    value = response.json
+    _set_timestamp(value, 'timestamp', timestamp, use_legacy_timestamps)
+    client.put(_jobs_collection, job._job_id, value, None,
+            False).raise_for_status()
+    for collection in [_locks_collection, _journal_collection]:
+        for record in client.list(collection).all():
+            if record['value'].get('job_id') == job._job_id:
+                _set_timestamp(record['value'], 'job_timestamp', timestamp,
+                        use_legacy_timestamps)
+                client.put(collection, record['path']['key'],
+                        record['value'], None, False).raise_for_status()
+
+def _expire_lease(client, job):
+    # Move the lease expiration of the job and of its locks back so the
+    # curator considers the job timed out long before _max_job_time_in_ms.
+    lease_expiration_in_ms = (_get_timestamp_in_ms(datetime.utcnow()) -
+            _additional_timeout_wait_in_ms - 1000)
+    response = client.get(_jobs_collection, job._job_id, None, False)
+    response.raise_for_status()
+    value = response.json
+    value['lease_expiration_in_ms'] = lease_expiration_in_ms
+    client.put(_jobs_collection, job._job_id, value, None,
+            False).raise_for_status()
+    for record in client.list(_locks_collection).all():
+        value = record['value']
+        if value.get('job_id') == job._job_id:
+            value['lease_expiration_in_ms'] = lease_expiration_in_ms
+        elif value.get('mode') == 'read':
+            readers = value['readers']
+            for reader in readers.values():
+                if reader['job_id'] == job._job_id:
+                    reader['lease_expiration_in_ms'] = lease_expiration_in_ms
+            value = Job._create_read_lock_value(value['collection'],
+                    value['key'], readers)
+        else:
+            continue
+        client.put(_locks_collection, record['path']['key'], value, None,
+                False).raise_for_status()
+
+def _abandon_shards(client, curator):
+    # Move the heartbeats of the curator's shards back so other curators
+    # consider it stopped.
+    timestamp = datetime.utcnow() - timedelta(milliseconds =
+            _curator_heartbeat_timeout_in_ms +
+            _additional_timeout_wait_in_ms + 1000)
+    for shard_index in curator._shard_indexes:
+        key = curator._get_active_curator_key(shard_index)
+        response = client.get(_curators_collection, key, None, False)
+        response.raise_for_status()
+        value = response.json
+        value['timestamp'] = json.loads(json.dumps(timestamp, cls=_Encoder))
+        client.put(_curators_collection, key, value, None,
+                False).raise_for_status()
+
+class EmulatorTests(unittest.TestCase):
+    def setUp(self):
+        self._emulator = Emulator(seed = 0)
+        self._client = _get_emulated_client(self._emulator)
+
+    def test_put_and_get(self):
+        response = self._client.put('test1', 'key1', {'value': 1})
+        response.raise_for_status()
+        response2 = self._client.get('test1', 'key1')
+        response2.raise_for_status()
+        self.assertEqual(response2.json, {'value': 1})
+        self.assertEqual(response2.ref, response.ref)
+        self.assertEqual(response2.key, 'key1')
+        self.assertEqual(self._client.get('test1', 'key2').status_code, 404)
+
+    def test_get_by_ref(self):
+        response = self._client.put('test1', 'key1', {'value': 1})
+        self._client.put('test1', 'key1', {'value': 2}).raise_for_status()
+        response = self._client.get('test1', 'key1', response.ref)
+        response.raise_for_status()
+        self.assertEqual(response.json, {'value': 1})
+
+    def test_conditional_put_and_delete(self):
+        response = self._client.put('test1', 'key1', {}, False)
+        response.raise_for_status()
+        self.assertEqual(self._client.put('test1', 'key1', {},
+                False).status_code, 412)
+        self.assertEqual(self._client.put('test1', 'key1', {},
+                'badref').status_code, 412)
+        self.assertEqual(self._client.delete('test1', 'key1',
+                'badref').status_code, 412)
+        response = self._client.put('test1', 'key1', {'value': 1},
+                response.ref)
+        response.raise_for_status()
+        self._client.delete('test1', 'key1',
+                response.ref).raise_for_status()
+        self.assertEqual(self._client.get('test1', 'key1').status_code, 404)
+
+    def test_list_pages(self):
+        for index in range(25):
+            self._client.put('test1', 'key%02d' % index,
+                    {'index': index}).raise_for_status()
+        pages = self._client.list('test1')
+        self.assertEqual(len(pages.next()['results']), 10)
+        results = self._client.list('test1').all()
+        self.assertEqual([result['value']['index'] for result in results],
+                list(range(25)))
+        self._client.delete('test1').raise_for_status()
+        self.assertEqual(self._client.list('test1').all(), [])
+
+    def test_injected_failures(self):
+        self._emulator.inject_failure('GET', 'test1', 503)
+        self.assertEqual(self._client.get('test1', 'key1').status_code, 503)
+        self.assertEqual(self._client.get('test1', 'key1').status_code, 404)
+        self._emulator.inject_failure(status_code = None)
+        self.assertRaises(ConnectionError, self._client.get, 'test1', 'key1')
+
+    def test_injected_failure_rolls_back_job(self):
+        self._client.put('test1', 'key1', {'value': 1}).raise_for_status()
+        job = Job(self._client)
+        self._emulator.inject_failure('PUT', 'test1')
+        self.assertRaises(RollbackCausedByException, job.put, 'test1',
+                'key1', {'value': 2})
+        self.assertEqual(self._client.get('test1', 'key1').json,
+                {'value': 1})
+        self.assertEqual(self._client.list(_locks_collection).all(), [])
+
+    def test_latency(self):
+        emulator = Emulator(latency = 20)
+        client = _get_emulated_client(emulator)
+        start_time = time.time()
+        client.get('test1', 'key1', None, False)
+        self.assertTrue(time.time() - start_time >= 0.02)
+
+    def test_call_counts(self):
+        self._emulator.reset_call_counts()
+        self._client.get('test1', 'key1')
+        self.assertEqual(self._emulator.get_call_count('PUT',
+                _locks_collection), 1)
+        self.assertEqual(self._emulator.get_call_count('GET', 'test1'), 1)
+        self.assertEqual(self._emulator.get_call_count('DELETE',
+                _locks_collection), 1)
+        self.assertEqual(self._emulator.get_call_count(), 3)
+
+    def test_lock_check_fast_path(self):
+        client = self._emulator.mount(OiotClient('emulated-api-key',
+                use_lock_check_fast_path = True))
+        client.put('test1', 'key1', {'value': 1}).raise_for_status()
+        self._emulator.reset_call_counts()
+        self.assertEqual(client.get('test1', 'key1').json, {'value': 1})
+        self.assertEqual(self._emulator.get_call_count('GET',
+                _locks_collection), 1)
+        self.assertEqual(self._emulator.get_call_count(), 2)
+        self._emulator.reset_call_counts()
+        client.put('test1', 'key1', {'value': 2}).raise_for_status()
+        client.delete('test1', 'key2').raise_for_status()
+        self.assertEqual(self._emulator.get_call_count('PUT',
+                _locks_collection), 0)
+        self.assertEqual(self._emulator.get_call_count(), 6)
+        job = Job(self._client)
+        job.get('test1', 'key1')
+        self.assertEqual(client.get('test1', 'key1').json, {'value': 2})
+        self.assertRaises(CollectionKeyIsLocked, client.put, 'test1',
+                'key1', {})
+        job.put('test1', 'key1', {'value': 3})
+        self.assertRaises(CollectionKeyIsLocked, client.get, 'test1',
+                'key1')
+        self.assertRaises(CollectionKeyIsLocked, client.delete, 'test1',
+                'key1')
+        job.roll_back()
+        client.delete('test1', 'key1').raise_for_status()
+        self.assertEqual(client.get('test1', 'key1').status_code, 404)
+
+    def test_lock_check_fast_path_falls_back_to_locking(self):
+        client = self._emulator.mount(OiotClient('emulated-api-key',
+                use_lock_check_fast_path = True))
+        client.put('test1', 'key1', {'value': 1}).raise_for_status()
+        # Conflicting conditional writes fall back to locking the key.
+        self._emulator.inject_failure('PUT', 'test1', 412,
+                _max_lock_update_attempts)
+        self._emulator.reset_call_counts()
+        client.put('test1', 'key1', {'value': 2}).raise_for_status()
+        self.assertEqual(self._emulator.get_call_count('PUT',
+                _locks_collection), 1)
+        self.assertEqual(client.get('test1', 'key1').json, {'value': 2})
+        self.assertEqual(self._client.list(_locks_collection).all(), [])
+
+    def test_lock_check_fast_path_write_hazard(self):
+        # This documents a known hazard of the lock check fast path rather
+        # than behavior to rely on: since the fast path checks for locks
+        # instead of holding one, a job that locks the key between the check
+        # and the conditional write does not stop the write, and the job may
+        # then silently overwrite it.
+        client = self._emulator.mount(OiotClient('emulated-api-key',
+                use_lock_check_fast_path = True))
+        client.put('test1', 'key1', {'value': 1}).raise_for_status()
+        get_lock_and_execute_operation = client._get_lock_and_execute_operation
+        def run_between_check_and_write(operation):
+            # Run the operation after the lock check and before the write.
+            def get_lock_and_execute_operation_and_run(*args):
+                client._get_lock_and_execute_operation = \
+                        get_lock_and_execute_operation
+                responses = yield get_lock_and_execute_operation(*args)
+                operation()
+                raise _Return(responses)
+            client._get_lock_and_execute_operation = \
+                    get_lock_and_execute_operation_and_run
+        # Hazard: a job that locks the key without writing it in the
+        # meantime does not change the ref, so the write succeeds even though
+        # the job has already read the previous value.
+        job = Job(self._client)
+        run_between_check_and_write(lambda: self.assertEqual(
+                job.get('test1', 'key1').json, {'value': 1}))
+        client.put('test1', 'key1', {'value': 2}).raise_for_status()
+        self.assertRaises(CollectionKeyIsLocked, client.put, 'test1', 'key1',
+                {'value': 3})
+        # The job's journal records the value written by the client, so
+        # rolling the job back keeps that value.
+        job.put('test1', 'key1', {'value': 3})
+        job.roll_back()
+        self.assertEqual(client.get('test1', 'key1').json, {'value': 2})
+        # Hazard: completing the job instead silently replaces the value
+        # written by the client, which is a lost update, with a value based
+        # on what the job read before it.
+        job = Job(self._client)
+        run_between_check_and_write(lambda: job.get('test1', 'key1'))
+        client.put('test1', 'key1', {'value': 4}).raise_for_status()
+        job.put('test1', 'key1', {'value': 5})
+        job.complete()
+        self.assertEqual(client.get('test1', 'key1').json, {'value': 5})
+        # A job that writes the key in the meantime changes the ref, so the
+        # race is detected: the write is not executed and the lock check
+        # that follows raises.
+        job = Job(self._client)
+        run_between_check_and_write(lambda: job.put('test1', 'key1',
+                {'value': 6}))
+        self.assertRaises(CollectionKeyIsLocked, client.put, 'test1',
+                'key1', {'value': 7})
+        self.assertRaises(CollectionKeyIsLocked, client.delete, 'test1',
+                'key1')
+        job.roll_back()
+        self.assertEqual(client.get('test1', 'key1').json, {'value': 5})
+
+    def test_instrumentation(self):
+        instrumentation = MetricsInstrumentation()
+        client = self._emulator.mount(OiotClient('emulated-api-key',
+                instrumentation = instrumentation))
+        client.put('test1', 'key1', {'value': 1}).raise_for_status()
+        job = Job(client)
+        job.put('test1', 'key1', {'value': 2})
+        job.complete()
+        metrics = instrumentation.metrics
+        def get_call_count(phase, method, collection, status):
+            return metrics.get_value('oiot_requests_total', {'phase': phase,
+                    'method': method, 'collection': collection,
+                    'status': status})
+        self.assertEqual(get_call_count('lock_acquisition', 'PUT',
+                _locks_collection, 201), 2)
+        self.assertEqual(get_call_count('read', 'GET', 'test1', 200), 1)
+        self.assertEqual(get_call_count('journal', 'PUT', _jobs_collection,
+                201), 1)
+        self.assertEqual(get_call_count('write', 'PUT', 'test1', 201), 2)
+        self.assertEqual(get_call_count('lock_release', 'DELETE',
+                _locks_collection, 204), 2)
+        self.assertEqual(metrics.get_value('oiot_request_seconds',
+                {'phase': 'read', 'method': 'GET', 'collection': 'test1'}), 1)
+        job = Job(client)
+        job.put('test1', 'key1', {'value': 3})
+        self.assertRaises(CollectionKeyIsLocked, client.get, 'test1', 'key1')
+        self.assertEqual(get_call_count('lock_acquisition', 'PUT',
+                _locks_collection, 412), 1)
+        job2 = Job(client)
+        self.assertRaises(RollbackCausedByException, job2.put, 'test1',
+                'key1', {'value': 4})
+        job.complete()
+        for event, count in [('lock_conflict', 2), ('rollback', 1),
+                ('timeout', None)]:
+            self.assertEqual(metrics.get_value('oiot_events_total',
+                    {'event': event}), count)
+
+    def test_collection_key_locked(self):
+        job = Job(self._client)
+        response = job.post('test1', {})
+        self.assertRaises(CollectionKeyIsLocked, self._client.put, 'test1',
+                response.key, {})
+        self.assertRaises(CollectionKeyIsLocked, self._client.get,
+                'test1', response.key)
+        self.assertRaises(CollectionKeyIsLocked, self._client.delete,
+                'test1', response.key)
+
+    def test_basic_job_completion(self):
+        run_test_basic_job_completion(self._client, self)
+
+    def test_basic_job_rollback(self):
+        run_test_basic_job_rollback(self._client, self)
+
+    def test_rollback_caused_by_exception(self):
+        run_test_rollback_caused_by_exception(self._client, self)
+
+    def test_failed_completion(self):
+        run_test_failed_completion(self._client, self)
+
+    def test_failed_rollback(self):
+        run_test_failed_rollback(self._client, self)
+
+    def test_job_and_lock_creation_and_removal(self):
+        run_test_job_and_lock_creation_and_removal(self._client, self)
+
+    def test_job_and_lock_creation_and_removal2(self):
+        run_test_job_and_lock_creation_and_removal2(self._client, self)
+
+    def test_verify_operations_and_roll_back(self):
+        run_test_verify_operations_and_roll_back(self._client, self)
+
+    def test_exception_raised_when_key_locked(self):
+        run_test_exception_raised_when_key_locked(self._client, self)
+
+    def test_curation_of_timed_out_job(self):
+        self._client.put('test1', 'key1', {'value': 1}).raise_for_status()
+        job = Job(self._client)
+        job.put('test1', 'key1', {'value': 2})
+        response = job.post('test2', {'value': 3})
+        _expire_job(self._client, job)
+        curator = Curator(self._client)
+        self.assertTrue(_run_steps(curator._determine_active_status()))
+        curator._is_active = True
+        self.assertTrue(_run_steps(curator._curate()))
+        self.assertEqual(self._client.get('test1', 'key1').json,
+                {'value': 1})
+        self.assertEqual(self._client.get('test2', response.key).status_code,
+                404)
+        self.assertEqual(self._client.list(_jobs_collection).all(), [])
+        self.assertEqual(self._client.list(_locks_collection).all(), [])
+        metrics = curator.metrics
+        self.assertEqual(metrics.get_value('oiot_curator_curated_total',
+                {'kind': 'job'}), 1)
+        self.assertEqual(metrics.get_value('oiot_curator_curated_total',
+                {'kind': 'lock'}), 2)
+        self.assertEqual(metrics.get_value('oiot_curator_last_pass_records',
+                {'kind': 'job'}), 1)
+        self.assertEqual(metrics.get_value('oiot_curator_operation_seconds',
+                {'operation': 'rollback'}), 1)
+        self.assertEqual(metrics.get_value('oiot_curator_operation_seconds',
+                {'operation': 'delete'}), 3)
+        self.assertEqual(metrics.get_value('oiot_curator_pass_seconds'), 1)
+        self.assertTrue(metrics.get_value('oiot_curator_operation_seconds',
+                {'operation': 'heartbeat'}) >= 1)
+
+    def test_records_store_millisecond_timestamps(self):
+        self._client.put('test1', 'key1', {'value': 1}).raise_for_status()
+        job = Job(self._client, use_append_only_journal = True)
+        job.get('test1', 'key1')
+        job.put('test2', 'key1', {'value': 2})
+        timestamp_in_ms = _get_timestamp_in_ms(job._timestamp)
+        self.assertEqual(self._client.get(_jobs_collection, job._job_id, None,
+                False).json['timestamp_in_ms'], timestamp_in_ms)
+        for collection in [_locks_collection, _journal_collection]:
+            for record in self._client.list(collection).all():
+                self.assertEqual(record['value']['job_timestamp_in_ms'],
+                        timestamp_in_ms)
+        read_lock = self._client.get(_locks_collection, 'test1-key1', None,
+                False).json
+        self.assertEqual(read_lock['readers'][job._job_id][
+                'job_timestamp_in_ms'], timestamp_in_ms)
+        job.complete()
+        self.assertEqual(_get_timestamp_in_ms(datetime(1970, 1, 2, 0, 0, 1,
+                2999)), 86401002)
+
+    def test_curation_of_timed_out_job_with_legacy_timestamps(self):
+        self._client.put('test1', 'key1', {'value': 1}).raise_for_status()
+        job = Job(self._client, use_append_only_journal = True)
+        job.put('test1', 'key1', {'value': 2})
+        _expire_job(self._client, job, True)
+        self.assertFalse('timestamp_in_ms' in self._client.get(
+                _jobs_collection, job._job_id, None, False).json)
+        curator = Curator(self._client)
+        self.assertTrue(_run_steps(curator._determine_active_status()))
+        curator._is_active = True
+        self.assertTrue(_run_steps(curator._curate()))
+        self.assertEqual(self._client.get('test1', 'key1').json,
+                {'value': 1})
+        for collection in [_jobs_collection, _locks_collection,
+                _journal_collection]:
+            self.assertEqual(self._client.list(collection).all(), [])
+
+    def test_lease_renewal_and_fencing_tokens(self):
+        self.assertRaises(ValueError, Job(self._client).renew)
+        self.assertRaises(ValueError, Job, self._client,
+                renew_automatically = True)
+        self._client.put('test1', 'key3', {'value': 3}).raise_for_status()
+        job = Job(self._client, use_leases = True, lease_time_in_ms = 300)
+        job.put('test1', 'key1', {'value': 1})
+        job.get('test1', 'key3')
+        self.assertEqual(job.get_fencing_token('test1', 'key1'), 1)
+        self.assertEqual(job.get_fencing_token('test1', 'key2'), None)
+        lease_expiration_in_ms = job._lease_expiration_in_ms
+        time.sleep(0.2)
+        self.assertTrue(job.renew())
+        self.assertTrue(job._lease_expiration_in_ms > lease_expiration_in_ms)
+        self.assertEqual(self._client.get(_jobs_collection, job._job_id,
+                None, False).json['lease_expiration_in_ms'],
+                job._lease_expiration_in_ms)
+        # The renewed expiration is also stored in the job's locks.
+        write_lock = self._client.get(_locks_collection, 'test1-key1', None,
+                False).json
+        self.assertEqual(write_lock['lease_expiration_in_ms'],
+                job._lease_expiration_in_ms)
+        self.assertEqual(write_lock['fencing_token'], 1)
+        read_lock = self._client.get(_locks_collection, 'test1-key3', None,
+                False).json
+        self.assertEqual(read_lock['reader_expiration_in_ms'],
+                job._lease_expiration_in_ms)
+        self.assertEqual([reader['lease_expiration_in_ms'] for reader in
+                read_lock['readers'].values()], [job._lease_expiration_in_ms])
+        # The job outlives its original lease.
+        time.sleep(0.2)
+        job.put('test1', 'key2', {'value': 2})
+        # Upgrading the renewed read lock takes the next fencing token.
+        job.put('test1', 'key3', {'value': 4})
+        self.assertEqual(job.get_fencing_token('test1', 'key3'), 1)
+        job.complete()
+        self.assertEqual(self._client.list(_locks_collection).all(), [])
+        self.assertRaises(JobIsCompleted, job.renew)
+        job = Job(self._client, use_leases = True)
+        job.get('test1', 'key1')
+        self.assertEqual(job.get_fencing_token('test1', 'key1'), None)
+        # Upgrading the read lock takes the next fencing token.
+        job.put('test1', 'key1', {'value': 3})
+        self.assertEqual(job.get_fencing_token('test1', 'key1'), 2)
+        job.complete()
+        self.assertEqual(self._client.get(_fencing_tokens_collection,
+                'test1-key1', None, False).json, {'fencing_token': 2})
+
+    def test_automatic_lease_renewal(self):
+        job = Job(self._client, use_leases = True, lease_time_in_ms = 300,
+                renew_automatically = True)
+        job.put('test1', 'key1', {'value': 1})
+        time.sleep(0.5)
+        job.put('test1', 'key2', {'value': 2})
+        job.complete()
+        self.assertEqual(self._client.list(_jobs_collection).all(), [])
+
+    def test_curation_of_job_with_expired_lease(self):
+        self._client.put('test1', 'key1', {'value': 1}).raise_for_status()
+        job = Job(self._client, use_leases = True)
+        job.put('test1', 'key1', {'value': 2})
+        _expire_lease(self._client, job)
+        curator = Curator(self._client)
+        self.assertTrue(_run_steps(curator._determine_active_status()))
+        curator._is_active = True
+        self.assertTrue(_run_steps(curator._curate()))
+        self.assertEqual(self._client.get('test1', 'key1').json,
+                {'value': 1})
+        self.assertEqual(self._client.list(_jobs_collection).all(), [])
+        self.assertEqual(self._client.list(_locks_collection).all(), [])
+        # The fencing tokens of the expired job's locks are not reused.
+        job = Job(self._client, use_leases = True)
+        job.put('test1', 'key1', {'value': 3})
+        self.assertEqual(job.get_fencing_token('test1', 'key1'), 2)
+        job.complete()
+
+    def test_waiting_for_locks(self):
+        job = Job(self._client)
+        job.put('test1', 'key1', {'value': 1})
+        timer = threading.Timer(0.2, job.complete)
+        timer.start()
+        waiting_job = Job(self._client, lock_wait_timeout_in_ms = 5000)
+        self.assertEqual(waiting_job.get('test1', 'key1').json, {'value': 1})
+        waiting_job.put('test1', 'key1', {'value': 2})
+        timer.join()
+        self._client.put('test1', 'key2', {'value': 1}).raise_for_status()
+        job = Job(self._client)
+        job.get('test1', 'key2')
+        waiting_job.get('test1', 'key2')
+        # Upgrading a read lock waits for the other readers to leave.
+        timer = threading.Timer(0.2, job.complete)
+        timer.start()
+        waiting_job.put('test1', 'key2', {'value': 2})
+        timer.join()
+        waiting_job.complete()
+        client = OiotClient('emulated-api-key', lock_wait_timeout_in_ms = 100)
+        self._emulator.mount(client)
+        self.assertEqual(client.get('test1', 'key1').json, {'value': 2})
+        job = Job(self._client)
+        job.put('test1', 'key1', {'value': 3})
+        start_time = time.time()
+        self.assertRaises(CollectionKeyIsLocked, client.put, 'test1', 'key1',
+                {'value': 4})
+        self.assertTrue(time.time() - start_time >= 0.1)
+        verify_locked_exception_is_raised(self, Job(self._client,
+                lock_wait_timeout_in_ms = 100).delete, 'test1', 'key1')
+        job.complete()
+
+    def test_waiting_for_orphaned_lock(self):
+        job = Job(self._client)
+        job.put('test1', 'key1', {'value': 1})
+        _expire_job(self._client, job)
+        client = OiotClient('emulated-api-key',
+                lock_wait_timeout_in_ms = 100)
+        self._emulator.mount(client)
+        # The job still needs to be rolled back by a curator.
+        self.assertRaises(CollectionKeyIsLocked, client.get, 'test1', 'key1')
+        self._client.delete(_jobs_collection, job._job_id, None,
+                False).raise_for_status()
+        # The orphaned lock is removed without waiting for a curator.
+        start_time = time.time()
+        client.put('test1', 'key1', {'value': 2}).raise_for_status()
+        self.assertTrue(time.time() - start_time < 0.1)
+        self.assertEqual(self._client.list(_locks_collection).all(), [])
+
+    def test_latency_measurement(self):
+        latency_estimator = LatencyEstimator()
+        client = self._emulator.mount(OiotClient('emulated-api-key',
+                latency_estimator = latency_estimator))
+        client.put('test1', 'key1', {'value': 1}).raise_for_status()
+        # Locking, writing, and unlocking the key took three round trips.
+        self.assertEqual(latency_estimator.get_sample_count(), 3)
+        self.assertTrue(latency_estimator.get_average_in_ms() >= 0)
+        self.assertTrue(latency_estimator.get_percentile_in_ms() >= 0)
+
+    def test_adaptive_timeouts(self):
+        latency_estimator = LatencyEstimator()
+        for index in range(_min_latency_sample_count):
+            latency_estimator.observe(10)
+        client = self._emulator.mount(OiotClient('emulated-api-key',
+                latency_estimator = latency_estimator))
+        self.assertEqual(Job(client)._job_time_in_ms, _max_job_time_in_ms)
+        job = Job(client, use_adaptive_timeouts = True)
+        self.assertEqual(job._job_time_in_ms, _min_adaptive_job_time_in_ms)
+        job.put('test1', 'key1', {'value': 1})
+        # Curators time the job out when its budget runs out.
+        value = client.get(_jobs_collection, job._job_id, None, False).json
+        self.assertEqual(_get_record_expiration_in_ms(value, 'timestamp'),
+                job._timestamp_in_ms + _min_adaptive_job_time_in_ms)
+        for lock in client.list(_locks_collection).all():
+            self.assertEqual(_get_record_expiration_in_ms(lock['value'],
+                    'job_timestamp'), job._get_expiration_in_ms())
+        job.complete()
+        # Jobs using leases time out when their lease expires instead.
+        self.assertEqual(Job(client, use_leases = True,
+                use_adaptive_timeouts = True)._job_time_in_ms,
+                _max_job_time_in_ms)
+        job = Job(client, use_adaptive_timeouts = True)
+        unbounded_job = Job(client)
+        job.get('test1', 'key1')
+        for index in range(_min_latency_sample_count):
+            latency_estimator.observe(500)
+        lock_puts = self._emulator.get_call_count('PUT', _locks_collection)
+        try:
+            job.put('test1', 'key1', {'value': 2})
+            self.fail('RollbackCausedByException not raised')
+        except RollbackCausedByException as e:
+            self.assertTrue(isinstance(e.exception_causing_rollback,
+                    JobIsTimedOut))
+        # The operation was rejected before its first round trip.
+        self.assertEqual(self._emulator.get_call_count('PUT',
+                _locks_collection), lock_puts)
+        self.assertTrue(job.is_rolled_back)
+        unbounded_job.put('test1', 'key1', {'value': 3})
+        unbounded_job.complete()
+        self.assertEqual(client.get('test1', 'key1').json, {'value': 3})
+        curator = Curator(client)
+        self.assertEqual(curator._get_additional_timeout_wait_in_ms(),
+                _additional_timeout_wait_in_ms)
+        self.assertEqual(curator._get_heartbeat_timeout_in_ms(),
+                _curator_heartbeat_timeout_in_ms)
+        curator = Curator(client, use_adaptive_timeouts = True)
+        self.assertEqual(curator._get_additional_timeout_wait_in_ms(), 2000)
+        self.assertEqual(curator._get_heartbeat_timeout_in_ms(),
+                _curator_heartbeat_timeout_in_ms)
+        for index in range(_min_latency_sample_count):
+            latency_estimator.observe(5000)
+        self.assertEqual(curator._get_heartbeat_timeout_in_ms(),
+                _curator_heartbeat_interval_in_ms + 20000)
+
+    def test_lock_all(self):
+        job = Job(self._client)
+        job.lock_all([('test2', 'key1'), ('test1', 'key2'),
+                ('test1', 'key1'), ('test1', 'key2')])
+        self.assertEqual([(lock.collection, lock.key) for lock in job._locks],
+                [('test1', 'key1'), ('test1', 'key2'), ('test2', 'key1')])
+        self.assertEqual(len(self._client.list(_locks_collection).all()), 3)
+        job.put('test1', 'key1', {'value': 1})
+        job.complete()
+        self.assertEqual(self._client.list(_locks_collection).all(), [])
+        # Jobs declaring the same keys in opposite orders lock them in the
+        # same order, so neither waits for the other in a cycle.
+        holder = Job(self._client)
+        holder.put('test1', 'key1', {'value': 2})
+        collection_keys = [('test1', 'key1'), ('test1', 'key2')]
+        exceptions = []
+        def lock_all_and_complete(collection_keys):
+            try:
+                job = Job(self._client, lock_wait_timeout_in_ms = 3000)
+                job.lock_all(collection_keys)
+                job.put('test1', 'key2', {'value': 3})
+                job.complete()
+            except Exception as e:
+                exceptions.append(e)
+        threads = [threading.Thread(target = lock_all_and_complete,
+                args = (keys,)) for keys in [collection_keys,
+                collection_keys[::-1]]]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.2)
+        holder.complete()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(exceptions, [])
+        self.assertEqual(self._client.list(_locks_collection).all(), [])
+        job = Job(self._client)
+        job.put('test1', 'key1', {'value': 4})
+        verify_locked_exception_is_raised(self, Job(self._client).lock_all,
+                collection_keys)
+        job.complete()
+        self.assertEqual(self._client.list(_locks_collection).all(), [])
+
+    def test_wait_die(self):
+        older_job = Job(self._client, lock_wait_timeout_in_ms = 5000,
+                use_wait_die = True)
+        time.sleep(0.01)
+        younger_job = Job(self._client, lock_wait_timeout_in_ms = 5000,
+                use_wait_die = True)
+        younger_job.put('test1', 'key1', {'value': 1})
+        # The older job waits for the younger job.
+        timer = threading.Timer(0.2, younger_job.complete)
+        timer.start()
+        older_job.put('test1', 'key1', {'value': 2})
+        timer.join()
+        # The younger job dies instead of waiting for the older job.
+        younger_job = Job(self._client, lock_wait_timeout_in_ms = 5000,
+                use_wait_die = True)
+        start_time = time.time()
+        verify_locked_exception_is_raised(self, younger_job.get, 'test1',
+                'key1')
+        self.assertTrue(time.time() - start_time < 1)
+        older_job.complete()
+        self.assertEqual(self._client.get('test1', 'key1').json,
+                {'value': 2})
+
+    def test_concurrent_calls(self):
+        self.assertEqual(_call_concurrently([(max, (1, 2)), (min, (1, 2)),
+                (len, ('abc',))]), [2, 1, 3])
+        executor = _get_executor()
+        # Nested concurrent calls run in the calling executor thread, so
+        # they cannot wait on calls queued behind them.
+        get_thread_name = lambda: threading.current_thread().name
+        thread_names = _call_concurrently([(_call_concurrently,
+                ([(get_thread_name, ())] * _max_concurrent_requests,))] *
+                (_max_concurrent_requests * 2))
+        for names in thread_names:
+            self.assertEqual(len(set(names)), 1)
+        self.assertTrue(_get_executor() is executor)
+        self.assertRaises(ZeroDivisionError, _call_concurrently,
+                [(lambda value: 1 // value, (1,)), (lambda value: 1 // value,
+                (0,))])
+
+    def test_lock_wait_delays(self):
+        for retry in range(40):
+            delay_in_ms = _get_lock_wait_delay_in_ms(retry)
+            self.assertTrue(0 <= delay_in_ms <= min(
+                    _max_lock_wait_backoff_in_ms,
+                    _initial_lock_wait_backoff_in_ms * 2 ** retry))
+
+    def test_concurrent_curation_of_timed_out_jobs(self):
+        jobs = []
+        for index in range(20):
+            key = 'key%02d' % index
+            self._client.put('test1', key, {'value': 1}).raise_for_status()
+            job = Job(self._client)
+            job.put('test1', key, {'value': 2})
+            _expire_job(self._client, job)
+            jobs.append(job)
+        curator = Curator(self._client, worker_count = 8)
+        self.assertTrue(_run_steps(curator._determine_active_status()))
+        curator._is_active = True
+        self.assertTrue(_run_steps(curator._curate()))
+        self.assertEqual([result['value'] for result in
+                self._client.list('test1').all()], [{'value': 1}] * 20)
+        self.assertEqual(self._client.list(_jobs_collection).all(), [])
+        self.assertEqual(self._client.list(_locks_collection).all(), [])
+
+    def test_curation_candidates_are_retrieved_lazily(self):
+        for index in range(35):
+            self._client.put('test1', 'key%02d' % index,
+                    {'index': index}).raise_for_status()
+        self._emulator.reset_call_counts()
+        records = _iterate_records(self._client.list('test1'),
+                MetricsRegistry())
+        self.assertEqual(next(records)['value'], {'index': 0})
+        # Only the first page and the prefetched second page are retrieved.
+        records.close()
+        self.assertEqual(self._emulator.get_call_count('GET', 'test1'), 2)
+        metrics = MetricsRegistry()
+        self.assertEqual([record['value']['index'] for record in
+                _iterate_records(self._client.list('test1'), metrics)],
+                list(range(35)))
+        self.assertEqual(metrics.get_value('oiot_curator_operation_seconds',
+                {'operation': 'list'}), 4)
+
+    def test_curation_stops_when_no_longer_active(self):
+        for index in range(10):
+            key = 'key%02d' % index
+            self._client.put('test1', key, {'value': 1}).raise_for_status()
+            job = Job(self._client)
+            job.put('test1', key, {'value': 2})
+            _expire_job(self._client, job)
+        curator = Curator(self._client, worker_count = 4)
+        self.assertTrue(_run_steps(curator._determine_active_status()))
+        curator._is_active = True
+        # Another curator takes over before the next heartbeat.
+        curator._last_heartbeat_time = datetime.utcnow() - timedelta(
+                milliseconds = _curator_heartbeat_interval_in_ms)
+        self._emulator.inject_failure('PUT', _curators_collection, 412)
+        self.assertRaises(_CuratorNoLongerActive, lambda: _run_steps(
+                curator._curate()))
+        self.assertRaises(_CuratorNoLongerActive, lambda: _run_steps(
+                curator._try_send_heartbeat()))
+        self.assertEqual([result['value'] for result in
+                self._client.list('test1').all()], [{'value': 2}] * 10)
+        self.assertEqual(len(self._client.list(_jobs_collection).all()), 10)
+
+    def test_sharded_curation(self):
+        for index in range(10):
+            key = 'key%02d' % index
+            self._client.put('test1', key, {'value': 1}).raise_for_status()
+            job = Job(self._client)
+            job.put('test1', key, {'value': 2})
+            _expire_job(self._client, job)
+        curators = [Curator(self._client, shard_count = 2)
+                for index in range(3)]
+        self.assertTrue(_run_steps(curators[0]._determine_active_status()))
+        self.assertTrue(_run_steps(curators[1]._determine_active_status()))
+        # Every shard already has an active curator.
+        self.assertFalse(_run_steps(curators[2]._determine_active_status()))
+        self.assertNotEqual(curators[0]._shard_indexes,
+                curators[1]._shard_indexes)
+        self.assertEqual(sorted(curator['path']['key'] for curator in
+                self._client.list(_curators_collection).all()),
+                ['active-0', 'active-1'])
+        curators[0]._is_active = True
+        _run_steps(curators[0]._curate())
+        remaining_job_ids = [job['path']['key'] for job in
+                self._client.list(_jobs_collection).all()]
+        self.assertTrue(0 < len(remaining_job_ids) < 10)
+        self.assertFalse(any(curators[0]._is_in_shard(job_id)
+                for job_id in remaining_job_ids))
+        curators[1]._is_active = True
+        self.assertTrue(_run_steps(curators[1]._curate()))
+        self.assertEqual([result['value'] for result in
+                self._client.list('test1').all()], [{'value': 1}] * 10)
+        self.assertEqual(self._client.list(_jobs_collection).all(), [])
+        # The first shard's locks of jobs removed by the second shard are
+        # removed on the first shard's next pass.
+        self.assertTrue(all(curators[0]._is_in_shard(lock['path']['key'])
+                for lock in self._client.list(_locks_collection).all()))
+        _run_steps(curators[0]._curate())
+        self.assertEqual(self._client.list(_locks_collection).all(), [])
+
+    def test_abandoned_shards_are_taken_over(self):
+        for index in range(10):
+            key = 'key%02d' % index
+            self._client.put('test1', key, {'value': 1}).raise_for_status()
+            job = Job(self._client)
+            job.put('test1', key, {'value': 2})
+            _expire_job(self._client, job)
+        curators = [Curator(self._client, shard_count = 2)
+                for index in range(2)]
+        self.assertTrue(_run_steps(curators[0]._determine_active_status()))
+        self.assertTrue(_run_steps(curators[1]._determine_active_status()))
+        curators[0]._is_active = True
+        self.assertTrue(_run_steps(curators[0]._determine_active_status()))
+        self.assertEqual(len(curators[0]._shard_indexes), 1)
+        # The second curator stops, so the first one takes over its shard
+        # the next time it checks the other shards.
+        _abandon_shards(self._client, curators[1])
+        curators[0]._last_shard_check_time = None
+        self.assertTrue(_run_steps(curators[0]._determine_active_status()))
+        self.assertEqual(sorted(curators[0]._shard_indexes), [0, 1])
+        self.assertTrue(_run_steps(curators[0]._curate()))
+        self.assertEqual([result['value'] for result in
+                self._client.list('test1').all()], [{'value': 1}] * 10)
+        self.assertEqual(self._client.list(_jobs_collection).all(), [])
+        self.assertEqual(self._client.list(_locks_collection).all(), [])
+        # Heartbeats are sent to both shards, and the second curator is no
+        # longer active if it resumes.
+        curators[0]._last_heartbeat_time = datetime.utcnow() - timedelta(
+                milliseconds = _curator_heartbeat_interval_in_ms)
+        self.assertTrue(_run_steps(curators[0]._try_send_heartbeat()))
+        self.assertEqual([curator['value']['curator_id'] for curator in
+                self._client.list(_curators_collection).all()],
+                [str(curators[0]._id)] * 2)
+        curators[1]._is_active = True
+        curators[1]._last_heartbeat_time = datetime.utcnow() - timedelta(
+                milliseconds = _curator_heartbeat_interval_in_ms)
+        self.assertRaises(_CuratorNoLongerActive, lambda: _run_steps(
+                curators[1]._determine_active_status()))
+
+    def test_curators_started_one_after_another(self):
+        curators = []
+        for index in range(4):
+            # Every active curator checks the other shards before the next
+            # curator starts.
+            for curator in curators:
+                curator._last_shard_check_time = None
+                self.assertTrue(_run_steps(curator._determine_active_status()))
+            curator = Curator(self._client, shard_count = 4)
+            self.assertTrue(_run_steps(curator._determine_active_status()))
+            curator._is_active = True
+            curators.append(curator)
+        self.assertEqual(sorted(curator._shard_indexes[0]
+                for curator in curators), [0, 1, 2, 3])
+        self.assertTrue(all(len(curator._shard_indexes) == 1
+                for curator in curators))
+        # Every shard has an active curator now.
+        self.assertFalse(_run_steps(Curator(self._client,
+                shard_count = 4)._determine_active_status()))
+
+    def test_curation_using_search(self):
+        self._client.put('test1', 'key1', {'value': 1}).raise_for_status()
+        job = Job(self._client)
+        job.put('test1', 'key1', {'value': 2})
+        _expire_job(self._client, job)
+        job2 = Job(self._client)
+        job2.put('test1', 'key2', {'value': 3})
+        curator = Curator(self._client, use_search = True)
+        self.assertTrue(_run_steps(curator._determine_active_status()))
+        curator._is_active = True
+        self.assertEqual([job['path']['key'] for job in
+                curator._get_curation_candidates(_jobs_collection,
+                'timestamp')], [job._job_id])
+        self.assertTrue(_run_steps(curator._curate()))
+        self.assertEqual(self._client.get('test1', 'key1').json,
+                {'value': 1})
+        self.assertEqual([lock['value']['job_id'] for lock in
+                self._client.list(_locks_collection).all()], [job2._job_id])
+        job2.complete()
+        self.assertFalse(_run_steps(curator._curate()))
+
+    def test_lease_curation_using_search(self):
+        self._client.put('test1', 'key1', {'value': 1}).raise_for_status()
+        self._client.put('test1', 'key2', {'value': 2}).raise_for_status()
+        job = Job(self._client, use_leases = True)
+        job.put('test1', 'key1', {'value': 3})
+        job.get('test1', 'key2')
+        job2 = Job(self._client, use_leases = True)
+        job2.get('test1', 'key2')
+        _expire_lease(self._client, job)
+        curator = Curator(self._client, use_search = True)
+        self.assertTrue(_run_steps(curator._determine_active_status()))
+        curator._is_active = True
+        # The expired lease is found long before _max_job_time_in_ms has
+        # passed, and so is the read lock whose earliest reader expired.
+        self.assertEqual([job['path']['key'] for job in
+                curator._get_curation_candidates(_jobs_collection,
+                'timestamp')], [job._job_id])
+        self.assertEqual(sorted(lock['value']['key'] for lock in
+                curator._get_curation_candidates(_locks_collection,
+                'job_timestamp')), ['key1', 'key2'])
+        self.assertTrue(_run_steps(curator._curate()))
+        self.assertEqual(self._client.get('test1', 'key1').json,
+                {'value': 1})
+        locks = self._client.list(_locks_collection).all()
+        self.assertEqual([list(lock['value']['readers']) for lock in locks],
+                [[job2._job_id]])
+        self.assertEqual(list(curator._get_curation_candidates(
+                _locks_collection, 'job_timestamp')), [])
+        job2.complete()
+        self.assertEqual(self._client.list(_locks_collection).all(), [])
+
+    def test_search(self):
+        for index in range(15):
+            self._client.put('test1', 'key%02d' % index,
+                    {'nested': {'index': '%02d' % index}}).raise_for_status()
+        results = self._client.search('test1',
+                'value.nested.index:["03" TO "12"]').all()
+        self.assertEqual([result['path']['key'] for result in results],
+                ['key%02d' % index for index in range(3, 13)])
+        self.assertEqual(self._client.search('test1',
+                'value.nested.index:[* TO 01]').next()['count'], 2)
+        self.assertEqual(self._client.search('test1',
+                'value.index:foo').next().status_code, 400)
+        for index in range(15):
+            self._client.put('test2', 'key%02d' % index,
+                    {'number': index} if index % 2 else
+                    {'text': '%02d' % index}).raise_for_status()
+        results = self._client.search('test2',
+                'value.number:[* TO 4] OR value.text:["10" TO *]').all()
+        self.assertEqual([result['path']['key'] for result in results],
+                ['key01', 'key03', 'key10', 'key12', 'key14'])
+
+    def test_append_only_journal(self):
+        for index in range(3):
+            self._client.put('test1', 'key%d' % index,
+                    {'value': index}).raise_for_status()
+        job = Job(self._client, use_append_only_journal = True)
+        self._emulator.reset_call_counts()
+        job.put('test1', 'key0', {'value': 'new0'})
+        self.assertEqual(self._emulator.get_call_count('PUT',
+                _jobs_collection), 1)
+        job.put('test1', 'key1', {'value': 'new1'})
+        job.delete('test1', 'key2')
+        self.assertEqual(self._emulator.get_call_count('PUT',
+                _jobs_collection), 1)
+        self.assertEqual(self._emulator.get_call_count('PUT',
+                _journal_collection), 3)
+        journal_items = _run_steps(Job._get_journal_items(self._client,
+                job._job_id, self._client.get(_jobs_collection,
+                job._job_id).json))
+        self.assertEqual([item.key for item in journal_items],
+                ['key0', 'key1', 'key2'])
+        job.roll_back()
+        for index in range(3):
+            self.assertEqual(self._client.get('test1', 'key%d' % index).json,
+                    {'value': index})
+        self.assertEqual(self._client.list(_journal_collection).all(), [])
+
+    def test_put_many_and_delete_many(self):
+        for index in range(20):
+            self._client.put('test1', 'key%02d' % index,
+                    {'value': index}).raise_for_status()
+        emulator = self._emulator
+        emulator.latency = lambda rng, method, collection: 20
+        job = Job(self._client)
+        emulator.reset_call_counts()
+        start_time = time.time()
+        responses = job.put_many([('test1', 'key%02d' % index,
+                {'value': 'new'}) for index in range(10)] +
+                [('test2', 'new-key', {'value': 'new'})])
+        # Sequential operations would take at least 11 * 4 * 20ms.
+        self.assertTrue(time.time() - start_time < 0.5)
+        self.assertEqual(len(responses), 11)
+        self.assertEqual(emulator.get_call_count('PUT', _locks_collection),
+                11)
+        self.assertEqual(emulator.get_call_count('PUT', _jobs_collection), 1)
+        job.delete_many([('test1', 'key%02d' % index)
+                for index in range(10, 20)])
+        emulator.latency = None
+        self.assertEqual(len(job._locks), 21)
+        self.assertEqual(len(self._client.list('test1').all()), 10)
+        job.roll_back()
+        self.assertEqual([item['value']['value'] for item in
+                self._client.list('test1').all()], list(range(20)))
+        self.assertEqual(self._client.get('test2', 'new-key').status_code,
+                404)
+        self.assertEqual(self._client.list(_locks_collection).all(), [])
+
+    def test_batches_reject_repeated_keys(self):
+        self._client.put('test1', 'key1', {'value': 1}).raise_for_status()
+        job = Job(self._client)
+        self.assertRaises(ValueError, job.put_many, [('test1', 'key1',
+                {'value': 2}), ('test1', 'key2', {'value': 3}), ('test1',
+                'key1', {'value': 4}, None)])
+        self.assertRaises(ValueError, job.delete_many, [('test1', 'key1'),
+                ('test1', 'key1')])
+        # Nothing was locked or written and the job remains usable.
+        self.assertEqual(self._client.list(_locks_collection).all(), [])
+        self.assertEqual(self._client.get('test1', 'key2').status_code, 404)
+        job.put_many([('test1', 'key1', {'value': 5}), ('test2', 'key1',
+                {'value': 6})])
+        job.complete()
+        self.assertEqual(self._client.get('test1', 'key1').json,
+                {'value': 5})
+        job = Job(self._client, use_optimistic_concurrency = True)
+        self.assertRaises(ValueError, job.put_many, [('test1', 'key1', {}),
+                ('test1', 'key1', {})])
+
+    def test_put_many_rolls_back_on_failure(self):
+        for index in range(5):
+            self._client.put('test1', 'key%d' % index,
+                    {'value': index}).raise_for_status()
+        job = Job(self._client, use_append_only_journal = True)
+        self._emulator.inject_failure('PUT', 'test1')
+        self.assertRaises(RollbackCausedByException, job.put_many,
+                [('test1', 'key%d' % index, {'value': 'new'})
+                for index in range(5)])
+        self.assertEqual([item['value']['value'] for item in
+                self._client.list('test1').all()], list(range(5)))
+        self.assertEqual(self._client.list(_locks_collection).all(), [])
+        self.assertEqual(self._client.list(_journal_collection).all(), [])
+
+    def test_put_many_rolls_back_when_key_locked(self):
+        job = Job(self._client)
+        job.put('test1', 'key3', {})
+        job2 = Job(self._client)
+        try:
+            job2.put_many([('test1', 'key%d' % index, {})
+                    for index in range(5)])
+            self.fail('RollbackCausedByException not raised')
+        except RollbackCausedByException as e:
+            self.assertTrue(isinstance(e.exception_causing_rollback,
+                    CollectionKeyIsLocked))
+        self.assertEqual([lock['value']['job_id'] for lock in
+                self._client.list(_locks_collection).all()], [job._job_id])
+
+    def test_complete_removes_locks_concurrently(self):
+        job = Job(self._client)
+        job.put_many([('test1', 'key%02d' % index, {})
+                for index in range(16)])
+        self._emulator.latency = lambda rng, method, collection: 20
+        start_time = time.time()
+        job.complete()
+        # Sequential lock removal would take at least 16 * 20ms.
+        self.assertTrue(time.time() - start_time < 0.2)
+        self._emulator.latency = None
+        self.assertEqual(self._client.list(_locks_collection).all(), [])
+
+    def test_complete_removes_journal_records_concurrently(self):
+        job = Job(self._client, use_append_only_journal = True)
+        job.put_many([('test1', 'key%02d' % index, {})
+                for index in range(16)])
+        self.assertEqual(len(self._client.list(_journal_collection).all()),
+                16)
+        self._emulator.inject_failure('DELETE', _journal_collection, 503)
+        self._emulator.latency = lambda rng, method, collection: 20
+        start_time = time.time()
+        job.complete()
+        # Sequential journal record removal would take at least 16 * 20ms.
+        self.assertTrue(time.time() - start_time < 0.25)
+        self._emulator.latency = None
+        # The journal record failing removal is left to the curator.
+        self.assertEqual(len(self._client.list(_journal_collection).all()),
+                1)
+        self.assertTrue(job.is_completed)
+
+    def test_partially_failed_lock_removal(self):
+        job = Job(self._client)
+        job.put_many([('test1', 'key%d' % index, {}) for index in range(3)])
+        self._emulator.inject_failure('DELETE', _locks_collection, 503)
+        try:
+            job.complete()
+            self.fail('FailedToComplete not raised')
+        except FailedToComplete as e:
+            self.assertEqual(len(e.locks_failing_removal), 1)
+            collection, key, exception = e.locks_failing_removal[0]
+            self.assertEqual(collection, 'test1')
+            self.assertEqual(exception.response.status_code, 503)
+        self.assertEqual(len(self._client.list(_locks_collection).all()), 1)
+        self.assertEqual(self._client.list(_jobs_collection).all(), [])
+
+    def test_roll_back_of_keys_changed_more_than_once(self):
+        self._client.put('test1', 'key1', {'value': 1}).raise_for_status()
+        job = Job(self._client)
+        job.put('test1', 'key1', {'value': 2})
+        job.put('test1', 'key1', {'value': 3})
+        job.delete('test1', 'key1')
+        job.put('test1', 'key1', {'value': 4})
+        job.roll_back()
+        self.assertEqual(self._client.get('test1', 'key1').json,
+                {'value': 1})
+
+    def test_roll_back_keys_concurrently(self):
+        job = Job(self._client)
+        job.put_many([('test1', 'key%02d' % index, {})
+                for index in range(16)])
+        self._emulator.latency = lambda rng, method, collection: 20
+        start_time = time.time()
+        job.roll_back()
+        # Sequential roll back would take at least 16 * 2 * 20ms.
+        self.assertTrue(time.time() - start_time < 0.3)
+        self._emulator.latency = None
+        self.assertEqual(self._client.list('test1').all(), [])
+
+    def test_optimistic_job_completion(self):
+        self._client.put('test1', 'key1', {'value': 1}).raise_for_status()
+        self._client.put('test1', 'key2', {'value': 2}).raise_for_status()
+        self._emulator.reset_call_counts()
+        job = Job(self._client, use_optimistic_concurrency = True)
+        self.assertEqual(job.get('test1', 'key1').json, {'value': 1})
+        put_response = job.put('test1', 'key1', {'value': 3})
+        post_response = job.post('test1', {'value': 4})
+        key = post_response.key
+        delete_responses = job.delete_many([('test1', 'key2')])
+        # Writes are buffered until the job is completed, and the same kind
+        # of responses as those of a pessimistic job are returned.
+        for response in [put_response, post_response] + delete_responses:
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(response.ref, None)
+            response.raise_for_status()
+        self.assertEqual(len(delete_responses), 1)
+        self.assertEqual(self._client.get('test1', 'key2', None,
+                False).json, {'value': 2})
+        job.complete()
+        # The locks of the written keys are checked but never taken.
+        self.assertEqual(self._emulator.get_call_count('PUT',
+                _locks_collection), 0)
+        self.assertEqual(self._emulator.get_call_count('GET',
+                _locks_collection), 3)
+        self.assertEqual(self._client.get('test1', 'key1').json,
+                {'value': 3})
+        self.assertEqual(self._client.get('test1', key).json, {'value': 4})
+        self.assertEqual(self._client.get('test1', 'key2').status_code, 404)
+        self.assertEqual(self._client.list(_jobs_collection).all(), [])
+        self.assertEqual(put_response.ref,
+                self._client.get('test1', 'key1').ref)
+        self.assertEqual(post_response.ref,
+                self._client.get('test1', key).ref)
+
+    def test_optimistic_job_rolls_back_on_conflicting_write(self):
+        self._client.put('test1', 'key1', {'value': 1}).raise_for_status()
+        job = Job(self._client, use_optimistic_concurrency = True)
+        job.get('test1', 'key1')
+        job.put('test1', 'key1', {'value': 2})
+        job.put('test1', 'key2', {'value': 3})
+        self._client.put('test1', 'key1', {'value': 4}).raise_for_status()
+        try:
+            job.complete()
+            self.fail('RollbackCausedByException was not raised')
+        except RollbackCausedByException as e:
+            self.assertTrue(isinstance(e.exception_causing_rollback,
+                    CollectionKeyWasModified))
+        self.assertTrue(job.is_rolled_back)
+        self.assertEqual(self._client.get('test1', 'key1').json,
+                {'value': 4})
+        self.assertEqual(self._client.get('test1', 'key2').status_code, 404)
+        self.assertEqual(self._client.list(_jobs_collection).all(), [])
+
+    def test_optimistic_job_respects_locks(self):
+        self._client.put('test1', 'key1', {'value': 1}).raise_for_status()
+        pessimistic_job = Job(self._client)
+        pessimistic_job.put('test1', 'key1', {'value': 2})
+        job = Job(self._client, use_optimistic_concurrency = True)
+        job.put('test1', 'key1', {'value': 3})
+        try:
+            job.complete()
+            self.fail('RollbackCausedByException was not raised')
+        except RollbackCausedByException as e:
+            self.assertTrue(isinstance(e.exception_causing_rollback,
+                    CollectionKeyIsLocked))
+        # Rolling back the pessimistic job restores the value it locked.
+        pessimistic_job.roll_back()
+        self.assertEqual(self._client.get('test1', 'key1').json,
+                {'value': 1})
+        # Keys read by pessimistic jobs are not written either.
+        pessimistic_job = Job(self._client)
+        pessimistic_job.get('test1', 'key1')
+        job = Job(self._client, use_optimistic_concurrency = True)
+        job.delete('test1', 'key1')
+        self.assertRaises(RollbackCausedByException, job.complete)
+        pessimistic_job.complete()
+        job = Job(self._client, use_optimistic_concurrency = True)
+        job.put('test1', 'key1', {'value': 4})
+        job.complete()
+        self.assertEqual(self._client.get('test1', 'key1').json,
+                {'value': 4})
+
+    def test_optimistic_job_validates_reads(self):
+        self._client.put('test1', 'key1', {'value': 1}).raise_for_status()
+        job = Job(self._client, use_optimistic_concurrency = True)
+        job.get('test1', 'key1')
+        job.put('test1', 'key2', {'value': 2})
+        self._client.put('test1', 'key1', {'value': 3}).raise_for_status()
+        self.assertRaises(RollbackCausedByException, job.complete)
+        self.assertEqual(self._client.get('test1', 'key2').status_code, 404)
+        job = Job(self._client, use_optimistic_concurrency = True)
+        key = job.post('test1', {'value': 4}).key
+        job.delete('test1', key)
+        job.delete('test1', 'key3')
+        # The record must be present in order to delete it.
+        self.assertRaises(RollbackCausedByException, job.complete)
+
+    def test_shared_read_locks(self):
+        self._client.put('test1', 'key1', {'value': 1}).raise_for_status()
+        jobs = [Job(self._client) for index in range(3)]
+        for job in jobs:
+            self.assertEqual(job.get('test1', 'key1').json, {'value': 1})
+        self.assertEqual(self._client.get('test1', 'key1').json,
+                {'value': 1})
+        lock = self._client.get(_locks_collection, 'test1-key1', None,
+                False).json
+        self.assertEqual(lock['mode'], 'read')
+        self.assertEqual(sorted(lock['readers']),
+                sorted(job._job_id for job in jobs))
+        self.assertRaises(CollectionKeyIsLocked, self._client.put, 'test1',
+                'key1', {})
+        self.assertRaises(CollectionKeyIsLocked, self._client.delete,
+                'test1', 'key1')
+        # Upgrading to a write lock fails while there are other readers.
+        self.assertRaises(RollbackCausedByException, jobs[0].put, 'test1',
+                'key1', {'value': 2})
+        jobs[1].complete()
+        jobs[2].put('test1', 'key1', {'value': 3})
+        self.assertEqual(self._client.get(_locks_collection, 'test1-key1',
+                None, False).json['mode'], 'write')
+        self.assertRaises(RollbackCausedByException, Job(self._client).get,
+                'test1', 'key1')
+        jobs[2].complete()
+        self.assertEqual(self._client.get('test1', 'key1').json,
+                {'value': 3})
+        self.assertEqual(self._client.list(_locks_collection).all(), [])
+
+    def test_curation_of_timed_out_readers(self):
+        self._client.put('test1', 'key1', {'value': 1}).raise_for_status()
+        job = Job(self._client)
+        job.get('test1', 'key1')
+        job2 = Job(self._client)
+        job2.get('test1', 'key1')
+        response = self._client.get(_locks_collection, 'test1-key1', None,
+                False)
+        # Age the first reader so the curator considers it timed out.
+        value = response.json
+        _set_timestamp(value['readers'][job._job_id], 'job_timestamp',
+                datetime.utcnow() - timedelta(milliseconds =
+                _max_job_time_in_ms + _additional_timeout_wait_in_ms + 1000),
+                False)
+        self._client.put(_locks_collection, 'test1-key1', value, None,
+                False).raise_for_status()
+        curator = Curator(self._client)
+        self.assertTrue(_run_steps(curator._determine_active_status()))
+        curator._is_active = True
+        self.assertTrue(_run_steps(curator._curate()))
+        lock = self._client.get(_locks_collection, 'test1-key1', None,
+                False).json
+        self.assertEqual(list(lock['readers']), [job2._job_id])
+        job2.complete()
+        self.assertEqual(self._client.list(_locks_collection).all(), [])
+
+    def test_curation_of_orphaned_locks_without_job_lookups(self):
+        for index in range(5):
+            key = 'key%02d' % index
+            self._client.put('test1', key, {'value': 1}).raise_for_status()
+            job = Job(self._client)
+            job.put('test1', key, {'value': 2})
+            _expire_job(self._client, job)
+            # Remove the job record only, leaving its lock orphaned.
+            self._client.delete(_jobs_collection, job._job_id, None,
+                    False).raise_for_status()
+        job2 = Job(self._client)
+        job2.put('test1', 'key05', {'value': 3})
+        curator = Curator(self._client)
+        self.assertTrue(_run_steps(curator._determine_active_status()))
+        curator._is_active = True
+        self._emulator.reset_call_counts()
+        self.assertTrue(_run_steps(curator._curate()))
+        # The jobs are listed once and no job is looked up individually.
+        self.assertEqual(self._emulator.get_call_count('GET',
+                _jobs_collection), 1)
+        self.assertEqual([lock['value']['job_id'] for lock in
+                self._client.list(_locks_collection).all()], [job2._job_id])
+        job2.complete()
+
+    def test_removed_job_ids_are_bounded_and_expire(self):
+        removed_job_ids = _ExpiringSet(3, 50)
+        for job_id in ['job1', 'job2', 'job3', 'job4']:
+            removed_job_ids.add(job_id)
+        self.assertNotIn('job1', removed_job_ids)
+        self.assertIn('job4', removed_job_ids)
+        self.assertEqual(len(removed_job_ids), 3)
+        time.sleep(0.1)
+        self.assertNotIn('job4', removed_job_ids)
+        self.assertEqual(len(removed_job_ids), 0)
+
+    def test_curation_of_timed_out_append_only_job(self):
+        for index in range(12):
+            self._client.put('test1', 'key%02d' % index,
+                    {'value': index}).raise_for_status()
+        job = Job(self._client, use_append_only_journal = True)
+        for index in range(12):
+            job.put('test1', 'key%02d' % index, {'value': 'new'})
+        _expire_job(self._client, job)
+        curator = Curator(self._client)
+        self.assertTrue(_run_steps(curator._determine_active_status()))
+        curator._is_active = True
+        self.assertTrue(_run_steps(curator._curate()))
+        for index in range(12):
+            self.assertEqual(self._client.get('test1',
+                    'key%02d' % index).json, {'value': index})
+        self.assertEqual(self._client.list(_jobs_collection).all(), [])
+        self.assertEqual(self._client.list(_locks_collection).all(), [])
+        self.assertEqual(self._client.list(_journal_collection).all(), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+import os, sys, unittest, shutil, tempfile, threading, time
+from datetime import datetime
+from oiot.settings import _locks_collection, _additional_timeout_wait_in_ms
+from oiot.client import OiotClient
+from oiot.emulator import Emulator
+from oiot.job import Job, _get_timestamp_in_ms
+from oiot.locktable import LocalLockTable, _slot_struct
+from oiot.exceptions import CollectionKeyIsLocked, RollbackCausedByException
+
+def _get_expiration_in_ms(time_in_ms = 60000):
+    return _get_timestamp_in_ms(datetime.utcnow()) + time_in_ms
+
+class LocalLockTableTests(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+
+    def test_acquire_and_release(self):
+        table = LocalLockTable(slot_count = 64)
+        token = table.acquire('key1', _get_expiration_in_ms())
+        self.assertTrue(token)
+        self.assertIsNone(table.acquire('key1', _get_expiration_in_ms()))
+        other_token = table.acquire('key2', _get_expiration_in_ms())
+        self.assertTrue(other_token)
+        self.assertEqual(table.get_holder_count(), 2)
+        table.release('key1', other_token)
+        self.assertIsNone(table.acquire('key1', _get_expiration_in_ms()))
+        table.release('key1', token)
+        table.release('key2', other_token)
+        self.assertEqual(table.get_holder_count(), 0)
+        self.assertTrue(table.acquire('key1', _get_expiration_in_ms()))
+
+    def test_renew(self):
+        table = LocalLockTable(slot_count = 64)
+        token = table.acquire('key1', _get_expiration_in_ms(-1))
+        self.assertFalse(table.renew('key1', token + 1,
+                _get_expiration_in_ms()))
+        self.assertFalse(table.renew('key1', 0, _get_expiration_in_ms()))
+        self.assertFalse(table.renew('key2', token, _get_expiration_in_ms()))
+        self.assertTrue(table.renew('key1', token, _get_expiration_in_ms()))
+        # The renewed entry is no longer expired.
+        self.assertIsNone(table.acquire('key1', _get_expiration_in_ms()))
+        table.release('key1', token)
+        self.assertEqual(table.get_holder_count(), 0)
+
+    def test_expired_entries_are_acquirable(self):
+        table = LocalLockTable(slot_count = 64)
+        token = table.acquire('key1', _get_expiration_in_ms(-1))
+        self.assertTrue(token)
+        other_token = table.acquire('key1', _get_expiration_in_ms())
+        self.assertTrue(other_token)
+        # Releasing an entry that has since been acquired by another holder
+        # leaves it alone.
+        table.release('key1', token)
+        self.assertIsNone(table.acquire('key1', _get_expiration_in_ms()))
+
+    def test_full_table(self):
+        table = LocalLockTable(slot_count = 4)
+        tokens = [table.acquire('key' + str(index), _get_expiration_in_ms())
+                for index in range(4)]
+        self.assertTrue(all(tokens))
+        self.assertEqual(table.acquire('key4', _get_expiration_in_ms()), 0)
+        table.release('key4', 0)
+        self.assertEqual(table.get_holder_count(), 4)
+
+    def test_threads_queue_for_a_key(self):
+        table = LocalLockTable(slot_count = 64)
+        token = table.acquire('key1', _get_expiration_in_ms())
+        acquired_tokens = []
+        def acquire():
+            acquired_token = table.acquire('key1', _get_expiration_in_ms(),
+                    5000)
+            acquired_tokens.append(acquired_token)
+            table.release('key1', acquired_token)
+        threads = [threading.Thread(target = acquire) for index in range(3)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        self.assertEqual(acquired_tokens, [])
+        table.release('key1', token)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(acquired_tokens), 3)
+        self.assertTrue(all(acquired_tokens))
+        self.assertEqual(table.get_holder_count(), 0)
+
+    def test_tables_sharing_a_file(self):
+        path = os.path.join(self._directory, 'locks')
+        table = LocalLockTable(path, slot_count = 64)
+        other_table = LocalLockTable(path, slot_count = 64)
+        token = table.acquire('key1', _get_expiration_in_ms())
+        self.assertTrue(token)
+        self.assertIsNone(other_table.acquire('key1',
+                _get_expiration_in_ms(), 50))
+        self.assertEqual(other_table.get_holder_count(), 1)
+        thread = threading.Timer(0.1, table.release, ['key1', token])
+        thread.start()
+        other_token = other_table.acquire('key1', _get_expiration_in_ms(),
+                5000)
+        thread.join()
+        self.assertTrue(other_token)
+        self.assertIsNone(table.acquire('key1', _get_expiration_in_ms()))
+        other_table.release('key1', other_token)
+        table.close()
+        other_table.close()
+
+    def test_jobs_sharing_a_table(self):
+        emulator = Emulator(seed = 0)
+        table = LocalLockTable(slot_count = 64)
+        client = emulator.mount(OiotClient('emulated-api-key',
+                lock_table = table))
+        job = Job(client)
+        job.put('test1', 'key1', {'value': 1})
+        self.assertEqual(table.get_holder_count(), 1)
+        lock_puts = emulator.get_call_count('PUT', _locks_collection)
+        with self.assertRaises(CollectionKeyIsLocked):
+            client.put('test1', 'key1', {'value': 2})
+        self.assertRaises(RollbackCausedByException, Job(client).put,
+                'test1', 'key1', {'value': 2})
+        # Conflicts within the table never reach o.io.
+        self.assertEqual(emulator.get_call_count('PUT', _locks_collection),
+                lock_puts)
+        # Reads are not serialized by the table.
+        self.assertRaises(RollbackCausedByException, Job(client).get,
+                'test1', 'key1')
+        self.assertTrue(emulator.get_call_count('PUT', _locks_collection) >
+                lock_puts)
+        job.complete()
+        self.assertEqual(table.get_holder_count(), 0)
+        waiting_job = Job(client, lock_wait_timeout_in_ms = 5000)
+        waiting_job.put('test1', 'key1', {'value': 2})
+        waiting_client = emulator.mount(OiotClient('emulated-api-key',
+                lock_table = table, lock_wait_timeout_in_ms = 5000))
+        thread = threading.Thread(target = lambda: waiting_client.put(
+                'test1', 'key1', {'value': 3}))
+        thread.start()
+        time.sleep(0.1)
+        self.assertEqual(client.get('test1', 'key1', raise_if_locked =
+                False).json, {'value': 2})
+        waiting_job.complete()
+        thread.join()
+        self.assertEqual(client.get('test1', 'key1').json, {'value': 3})
+        self.assertEqual(table.get_holder_count(), 0)
+
+    def test_renewal_of_job_entries(self):
+        table = LocalLockTable(slot_count = 64)
+        client = Emulator(seed = 0).mount(OiotClient('emulated-api-key',
+                lock_table = table))
+        job = Job(client, use_leases = True, lease_time_in_ms = 300)
+        job.put('test1', 'key1', {'value': 1})
+        time.sleep(0.1)
+        self.assertTrue(job.renew())
+        expirations = [_slot_struct.unpack_from(table._table, offset)[2]
+                for offset in range(0, len(table._table), _slot_struct.size)
+                if _slot_struct.unpack_from(table._table, offset)[1]]
+        self.assertEqual(expirations, [job._lease_expiration_in_ms +
+                _additional_timeout_wait_in_ms])
+        job.complete()
+        self.assertEqual(table.get_holder_count(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+import os, sys, unittest
+from oiot.settings import _locks_collection, _jobs_collection, \
+        _journal_collection, _curators_collection, _max_job_time_in_ms, \
+        _min_latency_sample_count, _min_adaptive_job_time_in_ms, \
+        _max_adaptive_job_time_in_ms, _latency_window_size
+from oiot.metrics import MetricsRegistry, MetricsInstrumentation, \
+        LatencyEstimator, serve_metrics, _get_request_phase
+
+try:
+    # python 2
+    from urllib2 import urlopen, HTTPError
+except ImportError:
+    # python 3
+    from urllib.request import urlopen
+    from urllib.error import HTTPError
+
+class MetricsTests(unittest.TestCase):
+    def test_counters_and_gauges(self):
+        metrics = MetricsRegistry()
+        metrics.increment('requests_total', {'operation': 'get'})
+        metrics.increment('requests_total', {'operation': 'get'}, 2)
+        metrics.set_gauge('backlog', 5)
+        metrics.set_gauge('backlog', 3)
+        self.assertEqual(metrics.get_value('requests_total',
+                {'operation': 'get'}), 3)
+        self.assertEqual(metrics.get_value('requests_total',
+                {'operation': 'put'}), None)
+        self.assertEqual(metrics.get_value('backlog'), 3)
+        self.assertRaises(ValueError, metrics.set_gauge, 'requests_total', 1)
+
+    def test_histograms(self):
+        metrics = MetricsRegistry(latency_buckets = [0.1, 1.0])
+        for value in [0.05, 0.5, 5.0]:
+            metrics.observe('latency_seconds', value, {'operation': 'list'})
+        with metrics.timer('latency_seconds', {'operation': 'list'}):
+            pass
+        self.assertEqual(metrics.get_value('latency_seconds',
+                {'operation': 'list'}), 4)
+        rendered = metrics.render_prometheus().splitlines()
+        self.assertEqual(rendered[0], '# TYPE latency_seconds histogram')
+        self.assertEqual(rendered[1:4], [
+                'latency_seconds_bucket{operation="list",le="0.1"} 2',
+                'latency_seconds_bucket{operation="list",le="1.0"} 3',
+                'latency_seconds_bucket{operation="list",le="+Inf"} 4'])
+        self.assertEqual(rendered[5],
+                'latency_seconds_count{operation="list"} 4')
+
+    def test_render_prometheus(self):
+        metrics = MetricsRegistry()
+        metrics.increment('curated_total', {'kind': 'journal "item"'})
+        metrics.set_gauge('active', 1)
+        self.assertEqual(metrics.render_prometheus(),
+                '# TYPE curated_total counter\n'
+                'curated_total{kind="journal \\"item\\""} 1\n'
+                '# TYPE active gauge\n'
+                'active 1\n')
+
+    def test_request_phases(self):
+        for method, collection, phase in [
+                ('PUT', _locks_collection, 'lock_acquisition'),
+                ('GET', _locks_collection, 'lock_acquisition'),
+                ('DELETE', _locks_collection, 'lock_release'),
+                ('PUT', _jobs_collection, 'journal'),
+                ('PUT', _journal_collection, 'journal'),
+                ('GET', 'test1', 'read'), ('DELETE', 'test1', 'write'),
+                ('PUT', _curators_collection, 'curation'),
+                ('HEAD', None, 'other')]:
+            self.assertEqual(_get_request_phase(method, collection), phase)
+
+    def test_metrics_instrumentation(self):
+        instrumentation = MetricsInstrumentation()
+        instrumentation.on_request('read', 'GET', 'test1', None, 0.5)
+        instrumentation.on_event('rollback')
+        self.assertEqual(instrumentation.metrics.get_value(
+                'oiot_requests_total', {'phase': 'read', 'method': 'GET',
+                'collection': 'test1', 'status': 'error'}), 1)
+        self.assertEqual(instrumentation.metrics.get_value(
+                'oiot_events_total', {'event': 'rollback'}), 1)
+
+    def test_latency_estimator(self):
+        latency_estimator = LatencyEstimator(weight = 0.5, window_size = 4)
+        self.assertEqual(latency_estimator.get_average_in_ms(), None)
+        self.assertEqual(latency_estimator.get_percentile_in_ms(), None)
+        for latency_in_ms in [10, 20, 30, 40, 50]:
+            latency_estimator.observe(latency_in_ms)
+        self.assertEqual(latency_estimator.get_sample_count(), 5)
+        self.assertEqual(latency_estimator.get_average_in_ms(), 40.625)
+        # The window holds the four most recent round trip times.
+        self.assertEqual(latency_estimator.get_percentile_in_ms(50), 30)
+        self.assertEqual(latency_estimator.get_percentile_in_ms(), 50)
+        self.assertEqual(latency_estimator.get_percentile_in_ms(0), 20)
+        # Budgets and timeouts ignore the first few round trips.
+        self.assertEqual(latency_estimator.get_expected_time_in_ms(2), None)
+        self.assertEqual(latency_estimator.get_job_time_in_ms(),
+                _max_job_time_in_ms)
+        self.assertEqual(latency_estimator.get_timeout_wait_in_ms(1000), 1000)
+        latency_estimator = LatencyEstimator()
+        for index in range(_min_latency_sample_count):
+            latency_estimator.observe(30)
+        self.assertEqual(latency_estimator.get_expected_time_in_ms(2), 60)
+        self.assertEqual(latency_estimator.get_job_time_in_ms(), 1500)
+        self.assertEqual(latency_estimator.get_timeout_wait_in_ms(), 120)
+        self.assertEqual(latency_estimator.get_timeout_wait_in_ms(1000), 1000)
+        for index in range(_latency_window_size):
+            latency_estimator.observe(0.01)
+        self.assertEqual(latency_estimator.get_job_time_in_ms(),
+                _min_adaptive_job_time_in_ms)
+        for index in range(_min_latency_sample_count):
+            latency_estimator.observe(10000)
+        self.assertEqual(latency_estimator.get_job_time_in_ms(),
+                _max_adaptive_job_time_in_ms)
+
+    def test_serve_metrics(self):
+        metrics = MetricsRegistry()
+        metrics.set_gauge('active', 1)
+        server = serve_metrics(metrics, 0)
+        try:
+            url = 'http://127.0.0.1:%d' % server.server_address[1]
+            response = urlopen(url + '/metrics')
+            self.assertTrue(response.headers['Content-Type'].startswith(
+                    'text/plain'))
+            self.assertEqual(response.read().decode('utf-8'),
+                    metrics.render_prometheus())
+            self.assertRaises(HTTPError, urlopen, url + '/other')
+        finally:
+            server.shutdown()
+            server.server_close()
+
+if __name__ == '__main__':
+    unittest.main()
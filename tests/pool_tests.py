@@ -0,0 +1,87 @@
+import os, sys, unittest, threading
+from oiot.client import OiotClient
+from oiot.pool import ConnectionPool
+
+try:
+    # python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    # python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+class _KeepAliveRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _send_empty_response(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_HEAD(self):
+        self._send_empty_response()
+
+    def do_GET(self):
+        self._send_empty_response()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class PoolTests(unittest.TestCase):
+    def setUp(self):
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0),
+                _KeepAliveRequestHandler)
+        thread = threading.Thread(target = self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _get_client(self, connection_pool):
+        client = OiotClient('any-api-key', connection_pool = connection_pool)
+        client.uri = 'http://127.0.0.1:%d' % self._server.server_address[1]
+        return client
+
+    def test_clients_share_connections(self):
+        connection_pool = ConnectionPool(max_size = 4)
+        clients = [self._get_client(connection_pool) for index in range(3)]
+        for client in clients:
+            for index in range(5):
+                client.ping().raise_for_status()
+        statistics = connection_pool.get_statistics()
+        self.assertEqual(statistics, {'hosts': 1, 'connections_opened': 1,
+                'requests': 15, 'idle_connections': 1, 'max_size': 4})
+
+    def test_threads_reuse_warmed_up_connections(self):
+        connection_pool = ConnectionPool(max_size = 4)
+        client = self._get_client(connection_pool)
+        connection_pool.warm_up(client, 10)
+        statistics = connection_pool.get_statistics()
+        self.assertTrue(1 <= statistics['connections_opened'] <= 4)
+        self.assertEqual(statistics['idle_connections'],
+                statistics['connections_opened'])
+        connections_opened = statistics['connections_opened']
+        def get():
+            for index in range(5):
+                client.get('test1', 'key1', raise_if_locked = False)
+        threads = [threading.Thread(target = get) for index in
+                range(connections_opened)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        statistics = connection_pool.get_statistics()
+        # The warm-up sent max_size requests.
+        self.assertEqual(statistics['requests'], 4 + 5 * connections_opened)
+        self.assertTrue(statistics['connections_opened'] <= 4)
+
+if __name__ == '__main__':
+    unittest.main()
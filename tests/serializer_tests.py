@@ -0,0 +1,63 @@
+import os, sys, unittest, json, uuid
+from datetime import datetime
+from oiot import serializer
+from oiot.serializer import _get_wire_value, _dumps, _has_fast_json_body
+from oiot.client import OiotClient
+from oiot.curator import _ActiveCuratorDetails
+from oiot.emulator import Emulator
+from oiot.job import Job, _Lock, _JournalItem, _Encoder
+
+class SerializerTests(unittest.TestCase):
+    def _assert_same_as_encoder(self, value):
+        self.assertEqual(_get_wire_value(value),
+                json.loads(json.dumps(value, cls=_Encoder)))
+
+    def test_wire_values_match_encoder(self):
+        timestamp = datetime(2014, 6, 1, 12, 30, 15, 250000)
+        lock = _Lock('job1', timestamp, timestamp, 'test1', 'key1', None,
+                'read', 'reader1', {'reader1': {'job_id': 'job1'}})
+        self._assert_same_as_encoder(lock)
+        self._assert_same_as_encoder(_JournalItem(timestamp, 'test1', 'key1',
+                {'value': [1, (2, 3)]}, {'value': timestamp}))
+        self._assert_same_as_encoder(_ActiveCuratorDetails(uuid.UUID(int = 1),
+                timestamp))
+        self._assert_same_as_encoder({'timestamp': timestamp, 'items':
+                [_JournalItem(timestamp.isoformat(), 'test1', 'key1', None,
+                {'value': 1.5})], 'flag': True})
+        self.assertEqual(lock._get_wire_dict()['job_timestamp'],
+                '2014-06-01T12:30:15.250000')
+        self.assertRaises(TypeError, _get_wire_value, object())
+
+    def test_dumps(self):
+        value = {'key': 'value', 'items': [1, 2.5, None, True],
+                'big': 2 ** 70}
+        serialized = _dumps(value)
+        if isinstance(serialized, bytes):
+            serialized = serialized.decode('utf-8')
+        self.assertEqual(json.loads(serialized), value)
+
+    def test_fast_json_bodies(self):
+        fast = serializer._json_backend != 'json'
+        self.assertEqual(_has_fast_json_body('PUT', {}), fast)
+        self.assertEqual(_has_fast_json_body('post', {}), fast)
+        self.assertFalse(_has_fast_json_body('PUT', None))
+        self.assertFalse(_has_fast_json_body('GET', {'limit': 10}))
+
+    def test_requests_with_fast_json_bodies(self):
+        client = Emulator(seed = 0).mount(OiotClient('emulated-api-key'))
+        response = client.put('test1', 'key1', {'value': u'caf\u00e9'})
+        response.raise_for_status()
+        self.assertEqual(client.get('test1', 'key1').json,
+                {'value': u'caf\u00e9'})
+        self.assertEqual(client.put('test1', 'key1', {'value': 2},
+                False).status_code, 412)
+        response = client.post('test1', {'value': 3})
+        self.assertEqual(client.get('test1', response.key).json,
+                {'value': 3})
+        job = Job(client)
+        job.put('test1', 'key1', {'value': 4})
+        job.complete()
+        self.assertEqual(client.get('test1', 'key1').json, {'value': 4})
+
+if __name__ == '__main__':
+    unittest.main()
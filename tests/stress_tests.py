@@ -4,6 +4,7 @@ from oiot.settings import _locks_collection, _jobs_collection, \
 from oiot.client import OiotClient
 from oiot.job import Job
 from oiot.curator import Curator
+from oiot.pool import ConnectionPool
 from oiot.exceptions import CollectionKeyIsLocked, JobIsCompleted, \
         JobIsRolledBack, JobIsFailed, FailedToComplete, FailedToRollBack, \
         RollbackCausedByException, JobIsTimedOut, _format_exception
@@ -29,11 +30,14 @@ import threading
 class StressTests(unittest.TestCase):
     def _get_client(self):
         global _oio_api_key
-        client = OiotClient(_oio_api_key)
+        client = OiotClient(_oio_api_key,
+                connection_pool = self._connection_pool)
         client.ping().raise_for_status()
         return client
 
     def setUp(self):
+        # The threads' clients share their connections.
+        self._connection_pool = ConnectionPool()
         self._minutes_to_run = 10
         self._curator_sleep_time_multiplier = 8
         self._number_of_curators = 2
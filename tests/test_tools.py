@@ -30,7 +30,10 @@ def _verify_lock_creation(testinstance, job, collection, key):
             Job._get_lock_collection_key(collection, key),
             None, False)
     response.raise_for_status()
-    testinstance.assertEqual(response.json['job_id'], job._job_id)
+    if response.json.get('mode') == 'read':
+        testinstance.assertTrue(job._job_id in response.json['readers'])
+    else:
+        testinstance.assertEqual(response.json['job_id'], job._job_id)
     testinstance.assertEqual(response.json['collection'], collection)
     testinstance.assertEqual(response.json['key'], key)
 